@@ -15,32 +15,57 @@ version 0.2
 No license (yet), but program is intended for public domain and may
 be considered open source
 
-Note: current version ignores, and will not work properly, with
-transactions such as share splits or share reorganisations.
+Note: share splits, consolidations and other reorganisations must be
+entered as corporate actions (see corporate_actions.py), not as trades.
+Holdings and trades are then counted in shares as at the closing date.
 """
 
 from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import redirect_stdout
 import csv
-from datetime import date, datetime
+from datetime import date, datetime, timedelta
 from decimal import Decimal, ROUND_HALF_UP, ROUND_DOWN, getcontext
-# import json
+import argparse
+import io
+import json
 from operator import attrgetter
 import os.path
 import pickle
 import sys
+import threading
+from time import perf_counter
+import tracemalloc
 from tkinter import Tk
 from tkinter.filedialog import askopenfilename, asksaveasfilename
 import dateutil.parser
+from activity_statement import read_statement
+from columnar import columnar_format, read_rows, write_rows
+from fx_providers import FXProviderError
+from mapped_csv import read_csv_rows
+from preflight import ERROR, print_problems, validate_inputs
+from price_history import PriceHistory, PriceHistoryError
+from holdings import HoldingsTimeline, ShareLots, build_holdings_timelines, reconcile_dividends
+from securities_master import SecuritiesMaster, load_securities_master, save_securities_master
+from share_results import save_share_results, share_rows
+import shared_tables
 
 
 FAIR_DIVIDEND_RATE = '0.05'   # statutory Fair Dividend Rate of 5%
 testing = True
+interactive = True
+# If False, e.g. in fif_service.py, missing information raises an
+# error instead of asking the user for it.
 tax_year = 2018  # hard coded for testing
 opening_test_file = 'opening_test_file.csv'
 trades_test_file = 'trades_test_file.csv'
 dividends_test_file = 'dividends_test_file.csv'
 closing_test_file = 'closing_test_file.csv'
+statement_test_file = 'statement_test_file.csv'
+securities_master_file = 'securities_master.pickle'
+fx_rates_file = 'saved_fx_rates.pickle'
 item_format = namedtuple('item_output_format', 'header, width, precision')
+closing_price_info = namedtuple('closing_price_info', 'code, price')
 outfmt = {'code': item_format('share code', 16, 16),
                  'full_name': item_format('name / description', 28, 28),
                  'price': item_format('price', 10, 999),
@@ -64,6 +89,41 @@ fx_rates = {}
     to arrive at NZD values.
 
 """
+securities = SecuritiesMaster()
+"""
+    The securities master with the full name, currency and ISIN of
+    shares seen before; loaded from securities_master_file by main.
+
+"""
+price_history_directory = None
+"""
+    The directory of a price history store (see price_history.py) to
+    get closing prices from, or None (the default) to read them from a
+    csv file. Closing prices that are read from a file are added to
+    the store at the end of a run.
+
+"""
+corporate_actions = None
+"""
+    A CorporateActionIndex from corporate_actions.py with share splits
+    and other reorganisations, or None (the default) if there are none.
+
+"""
+fx_provider = None
+"""
+    A provider from fx_providers.py for foreign exchange rates that are
+    not in fx_rates yet, or None (the default) to ask the user for
+    them. Rates from the provider are added to fx_rates and saved to
+    fx_rates_file straight away.
+
+"""
+run_stats = None
+"""
+    Instance of RunStatistics if statistics are being collected for the
+    current run; None otherwise (the default). Functions only check
+    that it is not None before counting anything, so there is
+    practically no overhead when statistics are not collected.
+"""
 # Ending date of 31 March for tax periods is hard coded throughout.
 # (Search for   31   if that needs changing.)
 
@@ -95,6 +155,10 @@ class Share:
     closing_value: to be calculated, and remembered, in NZD.
     quick_sale_adjustment: to be calculated,  if needed, and
         remembered. If it has a positive value it will be in NZD.
+    lots: ShareLots with the acquisitions during the tax period that
+        are still held, set up by process_trades. It is None until then
+        (as a class attribute), and it is not saved with the closing
+        positions.
 
     All numerical values are stored as Decimals. It is strongly
     recommended to pass numerical values for them as strings (or
@@ -109,6 +173,8 @@ class Share:
     class.
     """
 
+    lots = None
+
     def __init__(self, code, full_name='', currency='USD', opening_holding='0',
                  opening_price='0.00'):
         """
@@ -164,6 +230,7 @@ class Share:
         self.cost_of_trades = Decimal('0.00')
         self.closing_value = Decimal('0.00')
         self.quick_sale_adjustment = None  # most shares won't need it
+        self.lots = None
         return
 
     def increase_holding(self, increase):
@@ -228,6 +295,13 @@ class Trade:
         it will represent the number of shares that will later be
         part of one or more quick sales. The value will be positive in
         both cases.
+    fills: None for a trade from a single fill. For a trade that was
+        merged from several partial fills by aggregate_fills, a list
+        of (number_of_shares, charge) tuples for each fill, in order.
+        These are kept so that values can still be rounded per fill,
+        exactly as without aggregation.
+    NZD_value: the charge in NZD (rounded per fill), as calculated by
+        process_trades; None until then.
 
     All numerical values are stored as Decimals. It is strongly
     recommended to pass numerical values for them as strings (or
@@ -251,8 +325,19 @@ class Trade:
         self.trade_costs = Decimal(trade_costs)
         self.charge = self.number_of_shares * self.share_price + self.trade_costs
         self.quick_sale_portion = None
+        self.fills = None
+        self.NZD_value = None
         return
 
+    def fill_values(self):
+        """
+        return: list of (number_of_shares, charge) tuples for each fill
+            of the trade.
+        """
+        if self.fills is None:
+            return [(self.number_of_shares, self.charge)]
+        return self.fills
+
     def __repr__(self):
         return 'trade for {:,f} shares of {} on {} at {:,.2f} with costs of {:,.2f}'.format(
             self.number_of_shares, self.code, self.date_time, self.share_price,
@@ -275,6 +360,8 @@ class Dividend:
     gross_paid: the total gross sum paid, before any withholding or
         other taxes, in its native currency, on all eligible shares for
         the dividend.
+    isin: optional International Securities Identification Number of
+        the share, if the source of the dividend information has it.
 
     Other attributes that are available:
     eligible_shares: the number of shares for which the dividend was
@@ -294,7 +381,7 @@ class Dividend:
     for dividends paid.
     """
 
-    def __init__(self, code, date_paid, per_share, gross_paid):
+    def __init__(self, code, date_paid, per_share, gross_paid, isin=None):
         """
         Constructor function. eligible_shares is calculated from the
         other inputs.
@@ -304,6 +391,7 @@ class Dividend:
         return: None
         """
         self.code = code
+        self.isin = isin
         self.date_paid = date_paid
         self.per_share = Decimal(per_share)
         self.gross_paid = Decimal(gross_paid)
@@ -319,6 +407,172 @@ class Dividend:
                self.gross_paid, self.date_paid, self.code, self.per_share)
 
 
+class RunStatistics:
+    """
+    Collects statistics on the stages of a program run: wall time,
+    number of calls and number of rows (records) processed per stage,
+    plus named counters such as the number of foreign exchange rate
+    lookups.
+
+    An instance is only created when statistics are requested. See
+    run_stage and the global run_stats.
+
+    If allocation_top is more than zero, and tracemalloc is tracing,
+    the memory allocations of each (outermost) stage are recorded as
+    well, and the summary will include the allocation_top source lines
+    with the largest net allocations for each stage.
+    """
+
+    def __init__(self, allocation_top=0, profiler=None):
+        self.start_time = perf_counter()
+        self.stages = {}
+        # Dict of dicts with calls, seconds and rows for each stage, in
+        # the order in which the stages first ran.
+        self.counters = {'fx_lookups': 0, 'fx_cache_misses': 0}
+        self.allocation_top = allocation_top
+        self.allocations = {}
+        # Dict by stage, with [size, count] lists of net allocations by
+        # source line, summed over all calls of the stage.
+        self.profiler = profiler
+        # A running cProfile.Profile, if any. It is paused while
+        # allocations are recorded, to keep that out of the profile.
+        self.depth = 0
+        # Number of stages currently running, i.e. nesting depth.
+        self.lock = threading.Lock()
+        # Nested stages may run in several threads at the same time;
+        # see load_input_files.
+        return
+
+    def run(self, name, function, args, rows=None):
+        """
+        Runs function with args as a stage called name, and records its
+        statistics.
+
+        input arguments:
+        name: the name of the stage.
+        function: the function to run.
+        args: tuple with arguments for function.
+        rows: the number of rows processed by the stage. If None, and
+            the function returns a list, the length of that list is
+            used instead.
+
+        return: the return value from function.
+        """
+        with self.lock:
+            tracing_allocations = self.allocation_top > 0 and tracemalloc.is_tracing() and \
+                self.depth == 0
+            # Allocations are only recorded for the outermost stages,
+            # e.g. calc_QSA is included in determine_FDR_income.
+            # Snapshots are too expensive to take for every call of a
+            # nested stage.
+            self.depth += 1
+        if tracing_allocations:
+            self.pause_profiler()
+            snapshot_before = tracemalloc.take_snapshot()
+            self.resume_profiler()
+        start = perf_counter()
+        try:
+            result = function(*args)
+        finally:
+            with self.lock:
+                self.depth -= 1
+        seconds = perf_counter() - start
+        if tracing_allocations:
+            self.pause_profiler()
+            self.record_allocations(name, snapshot_before, tracemalloc.take_snapshot())
+            self.resume_profiler()
+        if rows is None and isinstance(result, list):
+            rows = len(result)
+
+        with self.lock:
+            stage = self.stages.setdefault(name, {'calls': 0, 'seconds': 0.0, 'rows': 0})
+            stage['calls'] += 1
+            stage['seconds'] += seconds
+            if rows is not None:
+                stage['rows'] += rows
+        return result
+
+    def pause_profiler(self):
+        if self.profiler is not None:
+            self.profiler.disable()
+        return
+
+    def resume_profiler(self):
+        if self.profiler is not None:
+            self.profiler.enable()
+        return
+
+    def record_allocations(self, name, snapshot_before, snapshot_after):
+        """
+        Adds the net allocations by source line between two tracemalloc
+        snapshots to the allocations for stage name.
+        """
+        stage_allocations = self.allocations.setdefault(name, {})
+        for statistic in snapshot_after.compare_to(snapshot_before, 'lineno'):
+            frame = statistic.traceback[0]
+            if (statistic.size_diff == 0 and statistic.count_diff == 0) or \
+                    frame.filename == tracemalloc.__file__:
+                continue
+                # Skip allocations by tracemalloc itself.
+            location = '{}:{}'.format(frame.filename, frame.lineno)
+            totals = stage_allocations.setdefault(location, [0, 0])
+            totals[0] += statistic.size_diff
+            totals[1] += statistic.count_diff
+        return
+
+    def count(self, name, increase=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + increase
+        return
+
+    def summary(self):
+        """
+        return: dict with all statistics, suitable for conversion to
+            JSON.
+        """
+        summary = {'tax_year': tax_year,
+                   'total_seconds': perf_counter() - self.start_time,
+                   'stages': self.stages,
+                   'counters': self.counters}
+        if self.allocation_top > 0:
+            summary['allocations'] = {}
+            for name, stage_allocations in self.allocations.items():
+                top = sorted(stage_allocations.items(), key=lambda item: -item[1][0])
+                summary['allocations'][name] = [
+                    {'location': location, 'size': size, 'count': count}
+                    for location, (size, count) in top[:self.allocation_top]]
+        return summary
+
+    def save(self, filename='-'):
+        """
+        Writes the summary as JSON to filename, or prints it if
+        filename is '-'.
+        """
+        if filename == '-':
+            print(json.dumps(self.summary(), indent=2))
+        else:
+            with open(filename, 'w') as stats_file:
+                json.dump(self.summary(), stats_file, indent=2)
+        return
+
+
+def run_stage(function, *args, rows=None):
+    """
+    Runs function with args, as a stage with statistics if run_stats
+    is set, or just as a plain function call otherwise.
+
+    input arguments:
+    function: the function to run. Its name is used as stage name.
+    args: the arguments for function.
+    rows: optional number of rows processed; see RunStatistics.run.
+
+    return: the return value from function.
+    """
+    if run_stats is None:
+        return function(*args)
+    return run_stats.run(function.__name__, function, args, rows)
+
+
 class IntegerError(Exception):
     """Used to raise error in input processing function."""
     pass
@@ -334,6 +588,16 @@ class TooLateError(Exception):
     pass
 
 
+class MissingFXRateError(Exception):
+    """Used to raise error for a missing fx rate when not interactive."""
+    pass
+
+
+class UnknownShareError(Exception):
+    """Used to raise error for unknown share codes when not interactive."""
+    pass
+
+
 def yes_or_no(question):
     """
     Obtains a yes or no response to the question passed as argument.
@@ -517,6 +781,19 @@ def get_new_fx_rate(currency, fx_date, fx_rates):
     return fx_rate
 
 
+def fx_rate_date(fx_date):
+    """
+    return: the date for which a foreign exchange rate is stored in
+        fx_rates, when we need a rate for fx_date.
+    """
+    if fx_date.month == 3 and fx_date.day == 31:
+        # Assume we are dealing with a tax period closing date.
+        return fx_date
+    # Assume we want, and will use, an IRD mid-month rate. This
+    # could be a rolling average rate.
+    return date(fx_date.year, fx_date.month, 15)
+
+
 def FX_rate(currency, fx_date):
     """
 
@@ -525,22 +802,90 @@ def FX_rate(currency, fx_date):
     :param conversion_method:
     :return:
     """
-    if fx_date.month == 3 and fx_date.day == 31:
-        # Assume we are dealing with a tax period closing date.
-        rate_date = fx_date
-    else:
-        # Assume we want, and will use, an IRD mid-month rate. This
-        # could be a rolling average rate.
-        rate_date = date(fx_date.year, fx_date.month, 15)
+    rate_date = fx_rate_date(fx_date)
+
+    if run_stats is not None:
+        run_stats.count('fx_lookups')
 
     if currency in fx_rates and rate_date in fx_rates[currency]:
         fx_rate = fx_rates[currency][rate_date]
     else:
+        if run_stats is not None:
+            run_stats.count('fx_cache_misses')
+        if fx_provider is not None and fetch_fx_rates([(currency, rate_date)]):
+            return Decimal(fx_rates[currency][rate_date])
+        if not interactive:
+            raise MissingFXRateError('No {} rate for {}'.format(currency, rate_date))
         fx_rate = get_new_fx_rate(currency, rate_date, fx_rates)
 
     return Decimal(fx_rate)
 
 
+def fetch_fx_rates(keys):
+    """
+    Gets the rates for keys that are not in fx_rates yet from
+    fx_provider, in as few requests as the provider needs, and adds
+    them to fx_rates. The rates are saved to fx_rates_file at once, so
+    they never have to be fetched again.
+
+    input arguments:
+    keys: iterable of (currency, rate_date) tuples, with rate_date as
+        returned by fx_rate_date.
+
+    return: the number of rates that were added. If the provider fails,
+        FXProviderError is raised when not interactive; otherwise a
+        message is printed and no rates are added, so FX_rate asks the
+        user for them.
+    """
+    missing = [(currency, rate_date) for currency, rate_date in keys
+               if rate_date not in fx_rates.get(currency, {})]
+    if not missing:
+        return 0
+    try:
+        new_rates = fx_provider.get_rates(missing)
+    except FXProviderError as error:
+        if not interactive:
+            raise
+        print('Could not get exchange rates from the provider ({}); '.format(error) +
+              'missing rates will be asked for instead')
+        return 0
+    if run_stats is not None:
+        run_stats.count('fx_provider_calls')
+        run_stats.count('fx_provider_rates', len(new_rates))
+    for (currency, rate_date), fx_rate in new_rates.items():
+        fx_rates.setdefault(currency, {})[rate_date] = fx_rate
+    if new_rates and fx_rates_file:
+        save_fx_rates(fx_rates, fx_rates_file)
+    return len(new_rates)
+
+
+def prefetch_fx_rates(shares, trades, dividends):
+    """
+    Gets all foreign exchange rates that processing shares, trades and
+    dividends will need from fx_provider, before processing starts.
+    Rates for shares with a currency that is not known yet are left to
+    FX_rate.
+
+    return: the number of rates that were added.
+    """
+    currencies = {share.code: share.currency for share in shares}
+    for code in {trade.code for trade in trades} - set(currencies):
+        info = securities.lookup(code)
+        if info is not None:
+            currencies[code] = info.currency
+    keys = []
+    for currency in set(currencies.values()):
+        keys.append((currency, previous_closing_date()))
+        keys.append((currency, closing_date()))
+    for trade in trades:
+        if trade.code in currencies:
+            keys.append((currencies[trade.code], fx_rate_date(trade.date_time.date())))
+    for dividend in dividends:
+        if dividend.code in currencies:
+            keys.append((currencies[dividend.code], fx_rate_date(dividend.date_paid)))
+    return fetch_fx_rates(dict.fromkeys(keys))
+
+
 def get_new_share_currency_and_full_name(trade):
     """
 
@@ -578,6 +923,63 @@ def get_fx_rates(fx_rates, filename='saved_fx_rates.pickle'):
     return fx_rates
 
 
+OPENING_POSITION_COLUMNS = ['code', 'full_name', 'currency', 'holding', 'closing_price']
+TRADE_COLUMNS = ['Header', 'DataDiscriminator', 'Asset Category', 'Symbol', 'Date/Time',
+                 'Quantity', 'T. Price', 'Comm/Fee']
+DIVIDEND_COLUMNS = ['Currency', 'Date', 'Description', 'Amount']
+CLOSING_PRICE_COLUMNS = ['code', 'price']
+# The columns that are read from columnar input files.
+
+
+def input_rows(filename, columns, date_column=None):
+    """
+    Reads the rows of an input file, which can be a csv file or a
+    columnar (Parquet or Arrow IPC) file; see columnar.py.
+
+    input arguments:
+    filename: the name of the input file.
+    columns: the columns to read from a columnar file. A csv file is
+        always read completely.
+    date_column: if not None, rows with a date in this column outside
+        the tax period are skipped while reading. For a csv file this
+        is only a quick check on the raw bytes (see mapped_csv.py), so
+        the caller must still check the rows it gets.
+
+    return: generator of dicts with the fields of each row by name.
+    """
+    first_day = previous_closing_date() + timedelta(days=1)
+    after_last_day = closing_date() + timedelta(days=1)
+    if columnar_format(filename):
+        yield from read_rows(filename, columns, date_column, first_day, after_last_day)
+    elif date_column is not None:
+        yield from read_csv_rows(filename, date_column, first_day, after_last_day)
+    else:
+        with open(filename, newline='') as input_file:
+            yield from csv.DictReader(input_file)
+    return
+
+
+def select_input_file(test_filename, prompt):
+    """
+    Asks the user to select an input file, or uses test_filename when
+    testing.
+
+    input arguments:
+    test_filename: the name of the file to use when testing.
+    prompt: the text printed to tell the user which file to select.
+
+    return: the name of the selected file. This may be an empty string
+        if the user cancelled the selection.
+    """
+    if testing:
+        return test_filename
+    print(prompt)
+    filename = askopenfilename()
+    Tk().withdraw
+    # This is to remove the GUI window that was opened.
+    return filename
+
+
 def get_opening_positions():
     """
     Creates the list of shares with opening positions that will be used
@@ -606,36 +1008,42 @@ def get_opening_positions():
     The function is now designed to only read such information from a
     csv file. It may be extended with additional input methods.
     """
-    opening_positions = []
-    if testing:
-        filename = opening_test_file
-    else:
-        print('Select file with opening positions, i.e. closing share info from the previous year')
-        filename = askopenfilename()
-        Tk().withdraw
-        # This is to remove the GUI window that was opened.
+    filename = select_input_file(opening_test_file, 'Select file with opening positions, ' +
+                                 'i.e. closing share info from the previous year')
+    return read_opening_positions(filename)
+
+
+def read_opening_positions(filename):
+    """
+    Reads the opening positions from a csv file; see
+    get_opening_positions.
 
+    input arguments:
+    filename: the name of the csv file. The program exits if the file
+        does not exist.
+
+    return: list of Share instances.
+    """
+    opening_positions = []
     if not os.path.isfile(filename):
         print('The program does not have an input file to work with. It is now exiting!')
         sys.exit()
         # This is a hard exit. No need to do anything more.
 
-    with open(filename, newline='') as shares_file:
-        reader = csv.DictReader(shares_file)
-        for row in reader:
-            if 'full_name' in row:
-                full_name = row['full_name']
-            else:
-                full_name = ''
+    for row in input_rows(filename, OPENING_POSITION_COLUMNS):
+        if 'full_name' in row:
+            full_name = row['full_name']
+        else:
+            full_name = ''
 
-            if 'currency' in row:
-                currency = row['currency']
-            else:
-                currency = 'USD'
+        if 'currency' in row:
+            currency = row['currency']
+        else:
+            currency = 'USD'
 
-            opening_share = Share(row['code'], full_name, currency,
-                    row['holding'], row['closing_price'])
-            opening_positions.append(opening_share)
+        opening_share = Share(row['code'], full_name, currency,
+                row['holding'], row['closing_price'])
+        opening_positions.append(opening_share)
 
     return opening_positions
 
@@ -735,42 +1143,176 @@ def get_trades():
     The function is now designed to only read such information from a
     csv file. It may be extended with additional input methods.
     """
-    trades = []
-    if testing:
-        filename = trades_test_file
-    else:
-        print('Select csv file with information on trades')
-        filename = askopenfilename()
-        Tk().withdraw
+    filename = select_input_file(trades_test_file, 'Select csv file with information on trades')
+    return read_trades(filename)
+
+
+def read_trades(filename):
+    """
+    Reads the trades from a csv file; see get_trades.
+
+    input arguments:
+    filename: the name of the csv file.
 
+    return: list of Trade instances; empty if the file does not exist.
+    """
+    trades = []
     if not os.path.isfile(filename):
         return []
         # Early return with empty list
 
-    with open(filename, newline='') as trades_file:
-        reader = csv.DictReader(trades_file)
-        for row in reader:
-            # use row fields as defined in Interactive Brokers csv output
-            if row['Header'] != 'Data':
-                continue
-                # skip rows with sub-totals and totals
+    for row in input_rows(filename, TRADE_COLUMNS, 'Date/Time'):
+        trade = trade_from_row(row)
+        if trade is not None:
+            trades.append(trade)
 
-            trade_date_time = dateutil.parser.parse(row['Date/Time'], yearfirst=True)
+    return trades
 
-            if previous_closing_date() < trade_date_time.date() <= closing_date():
-                # Strictly speaking this test should be unnecssary, but
-                # we just want to make sure we only deal with trades
-                # falling inside the tax year.
-                trade_costs = -Decimal(row['Comm/Fee'])
-                # Interactive Brokers has Comm/Fee as negative value,
-                # so we need to convert it here from the string that is
-                # being read.
 
-                trade = Trade(row['Symbol'], trade_date_time, row['Quantity'],
-                              row['T. Price'], trade_costs)
-                trades.append(trade)
+def trade_from_row(row):
+    """
+    Creates a Trade from a row of trade information, as exported by
+    Interactive Brokers, either as a separate trades csv file or as
+    part of an activity statement.
 
-    return trades
+    input arguments:
+    row: dict with (at least) the Header, Date/Time, Symbol, Quantity,
+        T. Price and Comm/Fee fields of the row.
+
+    return: a Trade instance, or None if the row is not for a trade in
+        shares during the tax period.
+    """
+    # use row fields as defined in Interactive Brokers csv output
+    if row.get('Header', 'Data') != 'Data':
+        return None
+        # skip rows with sub-totals and totals
+    if row.get('DataDiscriminator', 'Order') not in ('Order', 'Trade') or \
+            row.get('Asset Category') == 'Forex':
+        return None
+        # skip rows with details of closed lots, and currency
+        # conversions, which are not share trades.
+
+    trade_date_time = dateutil.parser.parse(row['Date/Time'], yearfirst=True)
+
+    if not previous_closing_date() < trade_date_time.date() <= closing_date():
+        return None
+        # Strictly speaking this test should be unnecssary, but
+        # we just want to make sure we only deal with trades
+        # falling inside the tax year.
+
+    trade_costs = -Decimal(row['Comm/Fee'].replace(',', ''))
+    # Interactive Brokers has Comm/Fee as negative value,
+    # so we need to convert it here from the string that is
+    # being read. Activity statements may include thousands
+    # separators in numbers.
+
+    return Trade(row['Symbol'], trade_date_time, row['Quantity'].replace(',', ''),
+                 row['T. Price'].replace(',', ''), trade_costs)
+
+
+def aggregate_fills(trades):
+    """
+    Merges partial fills of the same order into single trades, so that
+    fewer trades go through all later stages.
+
+    Trades are merged if they are for the same share, at the same date
+    and time, in the same direction (acquisition or disposal), and
+    follow each other directly among the trades for that share.
+    Quasi-trades with a share price of zero are never merged.
+
+    A merged trade has the total number of shares, trade costs and
+    charge of its fills, and the volume-weighted average share price.
+    The fills are kept in its fills attribute, so that all values that
+    are rounded per trade can still be rounded per fill; results are
+    therefore the same as without aggregation.
+
+    input arguments:
+    trades: list of Trade instances.
+
+    return: new list of trades, sorted by date and time.
+    """
+    aggregated = []
+    last_by_code = {}
+    # The position in aggregated of the last trade for each share code.
+    for trade in sorted(trades, key=attrgetter('date_time')):
+        position = last_by_code.get(trade.code)
+        last = None if position is None else aggregated[position]
+        if last is None or last.date_time != trade.date_time or \
+                last.share_price == 0 or trade.share_price == 0 or \
+                last.number_of_shares * trade.number_of_shares <= 0:
+            last_by_code[trade.code] = len(aggregated)
+            aggregated.append(trade)
+            continue
+
+        number_of_shares = last.number_of_shares + trade.number_of_shares
+        value = last.number_of_shares * last.share_price + \
+            trade.number_of_shares * trade.share_price
+        merged = Trade(trade.code, trade.date_time, number_of_shares,
+                       value / number_of_shares, last.trade_costs + trade.trade_costs)
+        merged.charge = last.charge + trade.charge
+        # Exact, unlike the charge from the (rounded) average price.
+        merged.fills = last.fill_values() + trade.fill_values()
+        aggregated[position] = merged
+    return aggregated
+
+
+def add_new_shares(shares, trades):
+    """
+    Adds a Share instance to shares for every share code in trades that
+    does not have one yet, i.e. for shares that were not held at the
+    start of the tax period.
+
+    The full name and currency of new shares are taken from the
+    securities master. The user is only asked for those of shares
+    that are not in the securities master either; all such shares are
+    listed first and then asked for in one batch, and the answers are
+    added to the securities master so they are not asked again.
+
+    input arguments:
+    shares: list of shares. New shares are appended to it, in the
+        order of their first trade.
+    trades: list of trades.
+
+    return: None
+    """
+    known_codes = {share.code for share in shares}
+    first_trades = []
+    # The first trade for each new share code.
+    for trade in trades:
+        if trade.code not in known_codes:
+            known_codes.add(trade.code)
+            first_trades.append(trade)
+
+    unknown_trades = [trade for trade in first_trades if trade.code not in securities]
+    if unknown_trades and not interactive:
+        raise UnknownShareError('Currency and full name unknown for ' +
+                                ', '.join(trade.code for trade in unknown_trades))
+    if unknown_trades:
+        print('\nThe following shares are not yet in the system: ' +
+              ', '.join(trade.code for trade in unknown_trades))
+        for trade in unknown_trades:
+            full_name, currency = get_new_share_currency_and_full_name(trade)
+            securities.add(trade.code, full_name, currency)
+
+    for trade in first_trades:
+        info = securities.lookup(trade.code)
+        shares.append(Share(trade.code, info.full_name, info.currency))
+    return
+
+
+def update_securities_master(shares, dividends):
+    """
+    Adds the full name and currency of all shares, and the ISINs found
+    in dividends, to the securities master.
+
+    return: None
+    """
+    for share in shares:
+        securities.add(share.code, share.full_name, share.currency)
+    for dividend in dividends:
+        if dividend.isin is not None:
+            securities.add(dividend.code, '', '', dividend.isin)
+    return
 
 
 def process_trades(shares, trades):
@@ -790,15 +1332,7 @@ def process_trades(shares, trades):
     # outside this function as well.
 
     # First, ensure there are share instances for every trade
-    for trade in trades:
-        # Check if we do not have a matching share code.
-        # consider changing the if to a while, in order to ensure
-        # we can never process unmatching trades. That may require
-        # some revamping of the code in such a while loop.
-        if not any(share.code == trade.code for share in shares):
-            full_name, currency = get_new_share_currency_and_full_name(trade)
-            new_share = Share(trade.code, full_name, currency)
-            shares.append(new_share)
+    add_new_shares(shares, trades)
 
     # After this we should have a share instance to match every trade.
     # For cosmetic output reasons, and probably greater efficiency,
@@ -825,13 +1359,32 @@ def process_trades(shares, trades):
     for share in shares:
         share_cost_of_trades = Decimal('0.00')
         shares_acquired = False
+        adjust = corporate_actions is not None and corporate_actions.has_actions(
+            share.code, previous_closing_date(), closing_date())
+        if adjust:
+            share.holding = corporate_actions.adjusted_holding(
+                share.code, share.holding, previous_closing_date(), closing_date())
+        # With corporate actions during the year, the holding and lots
+        # are counted in shares as at the closing date.
+        share.lots = ShareLots(share.holding)
         for trade in filter(lambda trade: trade.code == share.code, trades):
+            adjusted_trade = corporate_actions.adjusted_trade(trade, closing_date()) if adjust \
+                else trade
 
-            share.increase_holding(trade.number_of_shares)
+            share.increase_holding(adjusted_trade.number_of_shares)
 
             fx_rate = FX_rate(share.currency, trade.date_time.date())
-            NZD_value = (trade.charge / fx_rate).quantize(
-                Decimal('0.01'), ROUND_HALF_UP)
+            NZD_value = sum((charge / fx_rate).quantize(Decimal('0.01'), ROUND_HALF_UP)
+                            for _, charge in trade.fill_values())
+            # Rounded per fill, so the result does not depend on
+            # whether fills were aggregated.
+            trade.NZD_value = NZD_value
+            quick_sale_portion = share.lots.add_trade(adjusted_trade, NZD_value)
+            if quick_sale_portion is not None:
+                trade.quick_sale_portion = quick_sale_portion
+            # The lots give the quick sale portion of each disposal
+            # straight away, so calc_QSA does not need to work it out
+            # again.
 
             # This is why there is an outer loop. If a separate
             # total by share is not needed then the inner loop
@@ -898,62 +1451,96 @@ def get_dividends():
     dividends: list of Dividend instances with information for each
         dividend received during the tax period. The list may be empty.
     """
-    dividends = []
-    if testing:
-        filename = dividends_test_file
-    else:
-        filename = askopenfilename()
-        Tk().withdraw
+    filename = select_input_file(dividends_test_file,
+                                 'Select csv file with information on dividends')
+    return read_dividends(filename)
+
 
+def read_dividends(filename):
+    """
+    Reads the dividends from a csv file; see get_dividends.
+
+    input arguments:
+    filename: the name of the csv file.
+
+    return: list of Dividend instances; empty if the file does not
+        exist.
+    """
+    dividends = []
     if not os.path.isfile(filename):
         return []
         # Early return with empty list
 
-    with open(filename, newline='') as dividends_file:
-        reader = csv.DictReader(dividends_file)
-        for row in reader:
-            # use row fields as defined in Interactive Brokers csv output
-            date_paid = dateutil.parser.parse(row['Date'], yearfirst=True).date()
-            if previous_closing_date() < date_paid <= closing_date():
-                # Strictly speaking this test should be unnecssary, but
-                # we just want to make sure we only deal with dividends
-                # falling inside the tax year.
-
-                gross_paid = row['Amount']
-                description = row['Description']
-                # Next 2 statements assume that share code is first item
-                # in description, followed by something between
-                # brackets. There may not be a space before the bracket.
-                # If there is a space before the bracket we need to
-                # strip it from the code.
-                first_split = description.split('(')
-                code = first_split[0].strip()
-                # Following assumes that the value of dividend per
-                # share is the only floating point item in the
-                # text after the first bracket of the description, and
-                # before any next bracket, with a space separating the
-                # items.
-                second_split = first_split[1].split()
-                for item in second_split:
-                    try:
-                        per_share = float(item)
-                        # If we do NOT get a ValueError we have found
-                        # what we are looking for. However, we actually
-                        # want the string value, in order to convert
-                        # it to Decimal in the Dividend constructor.
-                        per_share = item
-                        break
-                        # When we find it
-                    except ValueError:
-                        continue
-                        # Try the next item
-
-                dividend = Dividend(code, date_paid, per_share, gross_paid)
-                dividends.append(dividend)
+    for row in input_rows(filename, DIVIDEND_COLUMNS, 'Date'):
+        dividend = dividend_from_row(row)
+        if dividend is not None:
+            dividends.append(dividend)
 
     return dividends
 
 
+def dividend_from_row(row):
+    """
+    Creates a Dividend from a row of dividend information, as exported
+    by Interactive Brokers, either as a separate dividends csv file or
+    as part of an activity statement.
+
+    input arguments:
+    row: dict with (at least) the Date, Description and Amount fields
+        of the row.
+
+    return: a Dividend instance, or None if the row is not for a
+        dividend paid during the tax period (e.g. a row with totals).
+    """
+    # use row fields as defined in Interactive Brokers csv output
+    if not row['Date'] or row.get('Currency', '').startswith('Total'):
+        return None
+        # skip rows with totals
+
+    date_paid = dateutil.parser.parse(row['Date'], yearfirst=True).date()
+    if not previous_closing_date() < date_paid <= closing_date():
+        return None
+        # Strictly speaking this test should be unnecssary, but
+        # we just want to make sure we only deal with dividends
+        # falling inside the tax year.
+
+    gross_paid = row['Amount'].replace(',', '')
+    description = row['Description']
+    # Next 2 statements assume that share code is first item
+    # in description, followed by something between
+    # brackets. There may not be a space before the bracket.
+    # If there is a space before the bracket we need to
+    # strip it from the code.
+    first_split = description.split('(')
+    code = first_split[0].strip()
+    # Following assumes that the value of dividend per
+    # share is the only floating point item in the
+    # text after the first bracket of the description, and
+    # before any next bracket, with a space separating the
+    # items.
+    second_split = first_split[1].split()
+    for item in second_split:
+        try:
+            per_share = float(item)
+            # If we do NOT get a ValueError we have found
+            # what we are looking for. However, we actually
+            # want the string value, in order to convert
+            # it to Decimal in the Dividend constructor.
+            per_share = item
+            break
+            # When we find it
+        except ValueError:
+            continue
+            # Try the next item
+
+    isin = first_split[1].split(')')[0].strip()
+    if len(isin) != 12 or not isin[:2].isalpha():
+        isin = None
+    # Interactive Brokers has the ISIN between the brackets.
+
+    return Dividend(code, date_paid, per_share, gross_paid, isin)
+
+
 def process_dividends(shares, dividends):
     """
 
@@ -1014,6 +1601,46 @@ def process_dividends(shares, dividends):
     return total_income_from_dividends
 
 
+def print_dividend_reconciliation(discrepancies):
+    """
+    Prints the dividends for which the number of eligible shares does
+    not match the number of shares held, as found by
+    reconcile_dividends.
+
+    input arguments:
+    discrepancies: list of dividend_discrepancy namedtuples.
+
+    return: None
+    """
+    print('\nDividend reconciliation against holdings at the start of the payment date')
+    if not discrepancies:
+        print('The eligible shares for all dividends match the shares held.\n')
+        return
+
+    header_format_string = '{v1:{w1}}' + '{v2:{w2}}' + '{v3:>{w3}}' + '{v4:>{w4}}' + \
+        '{v5:>{w5}}'
+    print(header_format_string.format(
+        v1=outfmt['code'].header, w1=outfmt['code'].width,
+        v2='payment date', w2=outfmt['date'].width,
+        v3='eligible shares', w3=outfmt['value'].width,
+        v4='shares held', w4=outfmt['value'].width,
+        v5='difference', w5=outfmt['value'].width))
+    print(outfmt['total width'] * '-')
+    for dividend, shares_held, difference in discrepancies:
+        if shares_held is None:
+            shares_held = 'unknown share'
+            difference = ''
+        print(header_format_string.format(
+            v1=dividend.code, w1=outfmt['code'].width,
+            v2=dividend.date_paid.strftime('%d %b %Y'), w2=outfmt['date'].width,
+            v3=dividend.eligible_shares, w3=outfmt['value'].width,
+            v4=shares_held, w4=outfmt['value'].width,
+            v5=difference, w5=outfmt['value'].width))
+    print('Differences can be caused by trades between the ex-dividend date and the ' +
+          'payment date,\nbut may also indicate missing or misread dividends.\n')
+    return
+
+
 def get_closing_prices(shares):
     """
     Creates the list with closing prices for shares.
@@ -1038,26 +1665,129 @@ def get_closing_prices(shares):
     tax period. It may also be provided for shares with a zero holding
     at the end of the tax period, but is not required for those shares.
 
-    The function is now designed to only read information from a
-    csv file. It may be extended with additional input methods.
+    The prices are read from a csv file, or from the price history
+    store if price_history_directory is set.
     """
-    closing_prices = []
-    closing_price_info = namedtuple('closing_price_info', 'code, price')
-    if testing:
-        filename = closing_test_file
-    else:
-        filename = askopenfilename()
-        Tk().withdraw
+    if price_history_directory is not None:
+        return closing_prices_from_history([share.code for share in shares])
+    filename = select_input_file(closing_test_file, 'Select csv file with closing prices')
+    return read_closing_prices(filename)
+
+
+def closing_prices_from_history(codes=None):
+    """
+    Looks up the prices on the closing date in the price history store,
+    for all codes at once.
+
+    input arguments:
+    codes: list of codes; None for all codes in the store.
+
+    return: list of closing_price_info named tuples, for the codes with
+        a price.
+    """
+    history = PriceHistory(price_history_directory)
+    prices = history.prices_on(closing_date(), codes)
+    history.close()
+    return [closing_price_info(code=code, price=price) for code, price in prices.items()]
+
 
+def complete_closing_prices(shares, trades, closing_prices):
+    """
+    Adds prices from the price history store for shares that will have
+    a closing holding but are not in closing_prices, e.g. for shares
+    that are not in an activity statement.
+
+    input arguments:
+    shares: list of shares with their opening positions.
+    trades: list of trades.
+    closing_prices: list of closing_price_info named tuples.
+
+    return: closing_prices with the prices from the store added, in one
+        lookup.
+    """
+    holdings = {}
+    for share in shares:
+        holdings.setdefault(share.code, share.opening_holding)
+    for trade in trades:
+        holdings[trade.code] = holdings.get(trade.code, Decimal('0')) + trade.number_of_shares
+    # Corporate actions only scale holdings, so they cannot make a
+    # holding zero or not zero.
+    priced = {price_info.code for price_info in closing_prices}
+    return list(closing_prices) + closing_prices_from_history(
+        [code for code, holding in holdings.items() if holding and code not in priced])
+
+
+def record_closing_prices(closing_prices):
+    """
+    Adds closing prices to the price history store, if there is one.
+    A corrected closing price replaces the one stored before for the
+    same date, if that is the last date in the store. Any other
+    conflict with the store is printed as a warning instead of stopping
+    the run; the prices of the shares before the conflicting one may
+    have been added by then.
+
+    return: the number of prices that were added or replaced; 0 after
+        a conflict.
+    """
+    if price_history_directory is None:
+        return 0
+    history = PriceHistory(price_history_directory)
+    try:
+        return history.append(((price_info.code, closing_date(), price_info.price)
+                               for price_info in closing_prices), replace_last=True)
+    except PriceHistoryError as error:
+        print('Warning: closing prices not added to the price history: {}'.format(error))
+        return 0
+    finally:
+        history.close()
+
+
+def check_inputs(shares, trades, dividends, closing_prices, check_only=False):
+    """
+    Checks all inputs at once before processing starts, and prints the
+    problems found; see preflight.py.
+
+    input arguments:
+    shares, trades, dividends, closing_prices: as returned by
+        load_input_files.
+    check_only: True if nothing will be processed after the check.
+        Otherwise, in an interactive run, unknown shares and missing
+        exchange rates are only warnings, as the user will be asked for
+        them.
+
+    return: list of input_problem named tuples.
+    """
+    new_currencies = {}
+    known_codes = {share.code for share in shares}
+    for code in {trade.code for trade in trades} - known_codes:
+        info = securities.lookup(code)
+        if info is not None:
+            new_currencies[code] = info.currency
+    problems = validate_inputs(shares, trades, dividends, closing_prices, fx_rates,
+                               previous_closing_date() + timedelta(days=1), closing_date(),
+                               fx_rate_date, new_currencies, corporate_actions,
+                               interactive and not check_only)
+    print_problems(problems)
+    return problems
+
+
+def read_closing_prices(filename):
+    """
+    Reads the closing prices from a csv file; see get_closing_prices.
+
+    input arguments:
+    filename: the name of the csv file.
+
+    return: list of closing_price_info named tuples.
+    """
+    closing_prices = []
     if not os.path.isfile(filename):
         pass
         # Still need to figure out what to do in this case.
 
-    with open(filename, newline='') as closing_prices_file:
-        reader = csv.DictReader(closing_prices_file)
-        for row in reader:
-            row_info = closing_price_info(code=row['code'], price=row['price'])
-            closing_prices.append(row_info)
+    for row in input_rows(filename, CLOSING_PRICE_COLUMNS):
+        row_info = closing_price_info(code=row['code'], price=row['price'])
+        closing_prices.append(row_info)
 
     # Consider adding functionality to check that we have a closing
     # price for every share with a closing holding, and to ensure we
@@ -1066,6 +1796,135 @@ def get_closing_prices(shares):
     return closing_prices
 
 
+def closing_price_from_open_position(row):
+    """
+    return: closing_price_info from a row of the Open Positions section
+        of an activity statement, or None for rows with details of
+        individual lots.
+    """
+    if row.get('DataDiscriminator', 'Summary') != 'Summary':
+        return None
+    return closing_price_info(code=row['Symbol'], price=row['Close Price'].replace(',', ''))
+
+
+def closing_price_from_mark_to_market(row):
+    """
+    return: closing_price_info from a row of the Mark-to-Market
+        Performance Summary section of an activity statement, or None
+        for rows with totals or for shares that are no longer held.
+    """
+    if not row.get('Symbol') or row.get('Asset Category', '').startswith('Total'):
+        return None
+    if not row.get('Current Quantity') or Decimal(row['Current Quantity'].replace(',', '')) == 0:
+        return None
+    return closing_price_info(code=row['Symbol'], price=row['Current Price'].replace(',', ''))
+
+
+def get_activity_statement(filename=None):
+    """
+    Reads trades, dividends and closing prices from an Interactive
+    Brokers activity statement, in one pass over the file. This can be
+    used instead of get_trades, get_dividends and get_closing_prices.
+
+    input arguments:
+    filename: the name of the activity statement csv file. If None,
+        the user is asked to select it (or statement_test_file is used
+        when testing).
+
+    return: (tuple with)
+    trades: list of Trade instances, as from get_trades.
+    dividends: list of Dividend instances, as from get_dividends.
+    closing_prices: list of closing_price_info, as from
+        get_closing_prices. Prices come from the Open Positions
+        section, supplemented by the Mark-to-Market Performance Summary
+        for shares that are not in Open Positions.
+
+    The statement should cover the tax period. Trades and dividends
+    outside the tax period are ignored, but closing prices are those
+    at the end of the period covered by the statement.
+    """
+    if filename is None:
+        filename = select_input_file(statement_test_file,
+                                     'Select csv file with the activity statement')
+
+    if not os.path.isfile(filename):
+        print('The program does not have an activity statement to work with. It is now exiting!')
+        sys.exit()
+        # This is a hard exit. No need to do anything more.
+
+    records = read_statement(filename, {
+        'Trades': trade_from_row,
+        'Dividends': dividend_from_row,
+        'Open Positions': closing_price_from_open_position,
+        'Mark-to-Market Performance Summary': closing_price_from_mark_to_market})
+
+    closing_prices = records['Open Positions']
+    codes_with_price = {price_info.code for price_info in closing_prices}
+    for price_info in records['Mark-to-Market Performance Summary']:
+        if price_info.code not in codes_with_price:
+            closing_prices.append(price_info)
+            codes_with_price.add(price_info.code)
+
+    return records['Trades'], records['Dividends'], closing_prices
+
+
+def load_input_files(statement_file=None):
+    """
+    Reads all input files concurrently: the opening positions, and
+    either the separate files with trades, dividends and closing prices
+    or a single activity statement.
+
+    The user is first asked to select all files, one after the other
+    (file dialogs must run in the main thread). The files are then read
+    and parsed in a pool of threads, so the waiting time for each file
+    overlaps with that for the others. This matters most for files on
+    network storage, where the total time comes close to that for the
+    slowest file.
+
+    input arguments:
+    statement_file: if not None, trades, dividends and closing prices
+        are all read from this activity statement.
+
+    Closing prices come from the price history store instead, if
+    price_history_directory is set. Prices that are missing from an
+    activity statement are then added from the store as well; see
+    complete_closing_prices.
+
+    return: (tuple with) the lists from get_opening_positions,
+        get_trades, get_dividends and get_closing_prices, in that order.
+    """
+    opening_filename = select_input_file(opening_test_file, 'Select file with opening ' +
+                                         'positions, i.e. closing share info from the ' +
+                                         'previous year')
+    if statement_file is None:
+        trades_filename = select_input_file(trades_test_file,
+                                            'Select csv file with information on trades')
+        dividends_filename = select_input_file(dividends_test_file,
+                                               'Select csv file with information on dividends')
+        if price_history_directory is None:
+            closing_filename = select_input_file(closing_test_file,
+                                                 'Select csv file with closing prices')
+
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        shares = executor.submit(run_stage, read_opening_positions, opening_filename)
+        if statement_file is None:
+            trades = executor.submit(run_stage, read_trades, trades_filename)
+            dividends = executor.submit(run_stage, read_dividends, dividends_filename)
+            if price_history_directory is None:
+                closing_prices = executor.submit(run_stage, read_closing_prices,
+                                                 closing_filename)
+            else:
+                closing_prices = executor.submit(run_stage, closing_prices_from_history)
+            return (shares.result(), trades.result(), dividends.result(),
+                    closing_prices.result())
+        statement = executor.submit(run_stage, get_activity_statement, statement_file)
+        shares = shares.result()
+        trades, dividends, closing_prices = statement.result()
+    if price_history_directory is not None:
+        closing_prices = run_stage(complete_closing_prices, shares, trades, closing_prices)
+    return shares, trades, dividends, closing_prices
+
+
 def process_closing_prices(shares, closing_prices):
     """
 
@@ -1095,46 +1954,46 @@ def process_closing_prices(shares, closing_prices):
         v8='NZD value', w8=outfmt['value'].width))
     print(outfmt['total width'] * '-')
 
+    shares_by_code = {}
+    for share in shares:
+        shares_by_code.setdefault(share.code, share)
+    # A hashed lookup of the share for each price, instead of searching
+    # the list of shares (which is not sorted by share code).
+
     for closing_price_info in closing_prices:
-        # Assume that we did indeed obtain a closing price for every
-        # share with a closing holding > 0. This functionality can be
-        # forced in get_closing_prices.
-        # Don't use filter function here because there is only one
-        # share per closing price so we can break out of the inner loop
-        # as soon as we find it.
-        for share in shares:
-            # assume the lists are not sorted by share code
-            if share.code == closing_price_info.code:
-                share.closing_price = Decimal(closing_price_info.price)
-
-                foreign_value = (share.holding * share.closing_price).quantize(
-                    Decimal('0.01'), ROUND_HALF_UP)
-                # Note that we are first rounding off the value in foreign
-                # currency, before additional rounding below. This can only
-                # be an issue for shares with fractional holdings.
+        # Shares without a closing price are reported by check_inputs
+        # (see preflight.py) before processing starts.
+        share = shares_by_code.get(closing_price_info.code)
+        if share is None:
+            continue
+        share.closing_price = Decimal(closing_price_info.price)
 
-                fx_rate = FX_rate(share.currency, closing_date())
-                NZD_value = (foreign_value / fx_rate).quantize(
-                    Decimal('0.01'), ROUND_HALF_UP)
-                # Make this a separate rounding as well.
+        foreign_value = (share.holding * share.closing_price).quantize(
+            Decimal('0.01'), ROUND_HALF_UP)
+        # Note that we are first rounding off the value in foreign
+        # currency, before additional rounding below. This can only
+        # be an issue for shares with fractional holdings.
 
-                # Next statement stores the result in Share object
-                share.closing_value = NZD_value
-                total_closing_value += NZD_value
+        fx_rate = FX_rate(share.currency, closing_date())
+        NZD_value = (foreign_value / fx_rate).quantize(
+            Decimal('0.01'), ROUND_HALF_UP)
+        # Make this a separate rounding as well.
 
-                print(share_format_string.format(
-                    v1=share.code, w1=outfmt['code'].width, p1=outfmt['code'].precision,
-                    v2=share.full_name, w2=outfmt['full_name'].width,
-                    p2=outfmt['full_name'].precision,
-                    v3=share.closing_price, w3=outfmt['price'].width,
-                    v4=share.holding, w4=outfmt['holding'].width,
-                    v5=foreign_value, w5=outfmt['value'].width, p5=outfmt['value'].precision,
-                    v6=share.currency, w6=outfmt['currency'].width,
-                    v7=fx_rate, w7=outfmt['FX rate'].width,
-                        p7=outfmt['FX rate'].precision,
-                    v8=NZD_value, w8=outfmt['value'].width, p8=outfmt['value'].precision))
+        # Next statement stores the result in Share object
+        share.closing_value = NZD_value
+        total_closing_value += NZD_value
 
-                break   # the inner loop after matching share is found
+        print(share_format_string.format(
+            v1=share.code, w1=outfmt['code'].width, p1=outfmt['code'].precision,
+            v2=share.full_name, w2=outfmt['full_name'].width,
+            p2=outfmt['full_name'].precision,
+            v3=share.closing_price, w3=outfmt['price'].width,
+            v4=share.holding, w4=outfmt['holding'].width,
+            v5=foreign_value, w5=outfmt['value'].width, p5=outfmt['value'].precision,
+            v6=share.currency, w6=outfmt['currency'].width,
+            v7=fx_rate, w7=outfmt['FX rate'].width,
+                p7=outfmt['FX rate'].precision,
+            v8=NZD_value, w8=outfmt['value'].width, p8=outfmt['value'].precision))
 
     # Also print shares that do not have a closing price or value.
     # This could risk double printing if a zero price is included in
@@ -1164,32 +2023,45 @@ def process_closing_prices(shares, closing_prices):
     return total_closing_value
 
 
-def save_closing_positions(shares):
+def save_closing_positions(shares, filename=None):
     """
+    Saves the closing positions, so they can be used as opening
+    positions for the next tax year.
 
-    :param shares:
-    :return:
+    input arguments:
+    shares: list of shares with their closing positions.
+    filename: the name of the file to save to. If None the user is
+        asked for it (nothing is saved when testing). A filename
+        ending in .parquet, .arrow or .feather is saved as a columnar
+        file; see columnar.py. Otherwise a csv file is saved.
+
+    return: None
     """
     if len(shares) == 0:
         print('nothing to save')
         return  # early exit
 
-    if testing:
-        filename = None
-    else:
+    if filename is None and not testing:
         filename = asksaveasfilename()
         Tk().withdraw
 
-    if not os.path.isfile(filename):
+    if not filename:
+        return
+        # Do nothing, e.g. if the user cancelled
+
+    share_rows = [{name: value for name, value in share.__dict__.items() if name != 'lots'}
+                  for share in shares]
+    # The lots only matter during the tax period.
+    share_fields = share_rows[0].keys()
+    if columnar_format(filename):
+        write_rows(filename, list(share_fields), share_rows)
         return
-        # Do nothing
 
-    share_fields = shares[0].__dict__.keys()
     with open(filename, 'w', newline='') as shares_save_file:
         writer = csv.DictWriter(shares_save_file, fieldnames=share_fields)
         writer.writeheader()
-        for share in shares:
-            writer.writerow(share.__dict__)
+        for row in share_rows:
+            writer.writerow(row)
 
     # for share in shares:
     #     json_item = json.dumps(share, default = lambda x: x.__dict__)
@@ -1249,58 +2121,107 @@ def calc_comparative_value_income(opening_value, cost_of_trades,
     return CV_income
 
 
-def calc_QSA(share, trades, dividends):
+def fill_portions(trade, portion):
     """
+    Divides the quick sale portion of a trade over its fills, in the
+    order of the fills. This gives the same portion for each fill as
+    calc_QSA would have found with the fills as separate trades.
 
-    :return:
+    input arguments:
+    trade: the trade.
+    portion: the quick sale portion (positive) for the whole trade.
+
+    return: list of (portion, number_of_shares, charge) tuples for each
+        fill.
+    """
+    result = []
+    for number_of_shares, charge in trade.fill_values():
+        fill_portion = min(abs(number_of_shares), portion)
+        portion -= fill_portion
+        result.append((fill_portion, number_of_shares, charge))
+    return result
+
+
+def calc_QSA(share, trades, dividends, timeline=None):
+    """
+    Calculates and prints the Quick Sale Adjustment for a share.
+
+    input arguments:
+    share: the share, after all trades have been processed.
+    trades: list of trades; only those for share are used.
+    dividends: list of dividends; only those for share are used.
+    timeline: optional HoldingsTimeline for share, as built by
+        build_holdings_timelines. It is used to find the peak holding.
+        If it is not provided, or if the trades include quasi-trades
+        with a zero price, or if there are corporate actions for share
+        during the year, a timeline is built here.
+
+    With corporate actions during the year, all numbers of shares are
+    in shares as at the closing date, including the quick_sale_portion
+    of trades.
+
+    return: quick_sale_adjustment
     """
     share_trades = []
     for trade in filter(lambda trade: trade.code == share.code, trades):
         share_trades.append(trade)
     share_trades.sort(reverse=False, key = attrgetter('date_time'))
 
+    opening_holding = share.opening_holding
+    original_trades = share_trades
+    adjust = corporate_actions is not None and corporate_actions.has_actions(
+        share.code, previous_closing_date(), closing_date())
+    if adjust:
+        opening_holding = corporate_actions.adjusted_holding(
+            share.code, opening_holding, previous_closing_date(), closing_date())
+        share_trades = [corporate_actions.adjusted_trade(trade, closing_date())
+                        for trade in share_trades]
+        timeline = None
+        # The copies count in shares as at the closing date; their
+        # quick sale portions are copied back at the end.
+
     closing_holding = share.holding
     # Because we already traversed all trades when processing them
     # the first time.
-    holding = share.opening_holding
-    peak_holding = Decimal('0')
-    acquired_shares = Decimal('0')
-    quick_sale_shares = Decimal('0')
-    for trade in share_trades:
-        if trade.share_price == Decimal('0'):
-            continue
-            # This is intended to weed out quasi-trades, if entered,
-            # that represent transactions such as share splits.
-
-        holding += trade.number_of_shares
-        if holding > peak_holding:
-            peak_holding = holding
-
-        if trade.number_of_shares > Decimal('0'):
-            acquired_shares += trade.number_of_shares
-        else:
-            quick_sale_portion = min(-trade.number_of_shares, acquired_shares - quick_sale_shares)
-            # At this point, quick_sale_shares has the previous balance
-            # of (the portions of) shares sold as a quick sale.
-            # Note the minus sign in front of trade.number of shares.
-            # The quick_sale_portion will have a non-negative value.
-            trade.quick_sale_portion = quick_sale_portion
-            # After this, trade.quick_sale_portion for each share
-            # disposal has a Decimal value (which could be zero). It
-            # will no longer be None.
-            quick_sale_shares += quick_sale_portion
-
-    if holding != closing_holding:
-        # It normally should be equal after we have run through all
-        # trades again.
+    lots = share.lots
+    if lots is None or lots.trade_count != len(share_trades):
+        lots = ShareLots(opening_holding)
+        for trade in share_trades:
+            NZD_value = trade.NZD_value
+            if NZD_value is None:
+                fx_rate = FX_rate(share.currency, trade.date_time.date())
+                NZD_value = sum((charge / fx_rate).quantize(Decimal('0.01'), ROUND_HALF_UP)
+                                for _, charge in trade.fill_values())
+            quick_sale_portion = lots.add_trade(trade, NZD_value)
+            if quick_sale_portion is not None:
+                trade.quick_sale_portion = quick_sale_portion
+        # Only needed if process_trades did not set up the lots for
+        # these trades, e.g. when called for other trades.
+    acquired_shares = lots.acquired_shares
+    quick_sale_shares = lots.quick_sale_shares
+
+    if lots.real_holding != closing_holding:
+        # It normally should be equal, because the lots leave out the
+        # same quasi-trades.
         print('Trades included a transaction with a share price of zero, probably for ' +
               'a transaction such as a share split.')
         print('The program cannot calculate the quick sale adjustment for this situation.')
+        print('Enter such transactions as corporate actions instead.')
         return Decimal('0.00')
         # Exiting early
         # We could also return a very large number to mess up all
         # calculations, but that could be annoying.
 
+    real_trades = [trade for trade in share_trades if trade.share_price != Decimal('0')]
+    if timeline is None or len(real_trades) < len(share_trades):
+        timeline = HoldingsTimeline(opening_holding, real_trades)
+        # Quasi-trades must not count for the peak holding.
+    peak_holding = timeline.peak_in_interval(include_start=False)
+    # This is the peak of the holdings after each trade. The opening
+    # holding itself is not included.
+    if peak_holding is None or peak_holding < Decimal('0'):
+        peak_holding = Decimal('0')
+
     share_trades.sort(reverse=True, key = attrgetter('date_time'))
     # We are now going to traverse the share trades again, but this
     # time in reverse order by date so that we can find the portion of
@@ -1309,7 +2230,8 @@ def calc_QSA(share, trades, dividends):
     # holding balances.
     share_dividends = []
     for dividend in filter(lambda dividend: dividend.code == share.code, dividends):
-        share_dividends.append(dividend)
+        share_dividends.append(corporate_actions.adjusted_dividend(dividend, closing_date())
+                               if adjust else dividend)
     # This is a first filter on dividends. It may save time for the
     # second filter we will use later.
     share_dividends.sort(reverse=True, key = attrgetter('date_paid'))
@@ -1367,8 +2289,11 @@ def calc_QSA(share, trades, dividends):
         fx_rate = FX_rate(share.currency, trade.date_time.date())
 
         if trade.number_of_shares < Decimal('0'):
-            quick_sale_result = ((trade.quick_sale_portion / -trade.number_of_shares) *
-                    -trade.charge / fx_rate).quantize(Decimal('0.01'), ROUND_HALF_UP)
+            quick_sale_result = sum(
+                ((fill_portion / -number_of_shares) * -charge / fx_rate).quantize(
+                    Decimal('0.01'), ROUND_HALF_UP)
+                for fill_portion, number_of_shares, charge in fill_portions(
+                    trade, trade.quick_sale_portion))
             # This will be a positive value, assuming that the trade
             # charge will always be negative.
             quick_sale_total += quick_sale_result
@@ -1381,7 +2306,8 @@ def calc_QSA(share, trades, dividends):
                 v5=quick_sale_result, w5 = 15,
                 v6=quick_sale_balance, w6=10))
         else:
-            acquisition_cost = (trade.charge / fx_rate).quantize(Decimal('0.01'), ROUND_HALF_UP)
+            acquisition_cost = sum((charge / fx_rate).quantize(Decimal('0.01'), ROUND_HALF_UP)
+                                   for _, charge in trade.fill_values())
             acquisitions_total += acquisition_cost
             quick_sale_portion = min(trade.number_of_shares, quick_sale_balance)
             trade.quick_sale_portion = quick_sale_portion
@@ -1398,6 +2324,10 @@ def calc_QSA(share, trades, dividends):
 
         end_date = start_date
 
+    if adjust:
+        for trade, adjusted_trade in zip(original_trades, share_trades):
+            trade.quick_sale_portion = adjusted_trade.quick_sale_portion
+
     print(113*'-')
     print('{v1:{w1}}{v2:{w2},.2f}{v3:{w3},}{v4:>{w4},.2f}{v5:>{w5},.2f}\n'.format(
         v1='total values (NZD)', w1=38,
@@ -1406,8 +2336,8 @@ def calc_QSA(share, trades, dividends):
         v4=quick_sale_total, w4=15,
         v5=dividends_gain, w5=35))
 
-    peak_differential = min(peak_holding - share.opening_holding, peak_holding - closing_holding)
-    average_cost_of_acquisition = acquisitions_total / acquired_shares
+    peak_differential = min(peak_holding - opening_holding, peak_holding - closing_holding)
+    average_cost_of_acquisition = lots.average_cost()
     peak_holding_adjustment = (Decimal(FAIR_DIVIDEND_RATE) * peak_differential *
             average_cost_of_acquisition).quantize(Decimal('0.01'), ROUND_HALF_UP)
     quick_sale_costs = (quick_sale_shares * average_cost_of_acquisition).quantize(
@@ -1438,7 +2368,7 @@ def calc_QSA(share, trades, dividends):
 
     print('{v1:{w1}}{v2:>{w2},}'.format(
             v1 = 'opening holding: ', w1 = width1,
-            v2 = share.opening_holding, w2 = 10))
+            v2 = opening_holding, w2 = 10))
     print('{v1:{w1}}{v2:>{w2},}'.format(
             v1 = 'closing holding: ', w1 = width1,
             v2 = closing_holding, w2 = 10))
@@ -1468,14 +2398,142 @@ def calc_QSA(share, trades, dividends):
     return quick_sale_adjustment
 
 
-def determine_FDR_income(FDR_basic_income, any_quick_sale_adjustment, shares, trades, dividends):
+def calc_QSA_in_worker(share, share_trades, share_dividends, rates, year, timeline=None,
+                       actions=None):
+    """
+    Runs calc_QSA in a worker process of calc_QSAs_in_parallel.
+
+    input arguments:
+    share, share_trades, share_dividends: as for calc_QSA, but with
+        only the trades and dividends for this share.
+    rates: fx_rates with (at least) every rate that calc_QSA will need
+        for this share, so that it never has to ask for one; or the
+        handle of a SharedTable with them (see shared_tables.py).
+    year: the tax year.
+    timeline: optional HoldingsTimeline for share.
+    actions: corporate_actions of the main process.
+
+    return: (tuple with)
+    quick_sale_adjustment: as returned by calc_QSA.
+    quick_sale_portions: list with quick_sale_portion for each trade in
+        share_trades, in the same order.
+    report: the output that calc_QSA printed.
+    """
+    global fx_rates
+    global tax_year
+    global corporate_actions
+    if isinstance(rates, dict):
+        fx_rates = rates
+    else:
+        fx_rates = shared_tables.SharedFXRates(shared_tables.attach(rates))
+    tax_year = year
+    corporate_actions = actions
+    report = io.StringIO()
+    with redirect_stdout(report):
+        quick_sale_adjustment = calc_QSA(share, share_trades, share_dividends, timeline)
+    quick_sale_portions = [trade.quick_sale_portion for trade in share_trades]
+    return quick_sale_adjustment, quick_sale_portions, report.getvalue()
+
+
+def calc_QSAs_in_parallel(QSA_shares, trades, dividends, workers, timelines=None):
+    """
+    Calculates the quick sale adjustments for several shares in a pool
+    of worker processes. Results are exactly the same as those from
+    calling calc_QSA for each share in turn, and the output of each
+    calculation is printed in the order of QSA_shares.
+
+    All foreign exchange rates that will be needed are obtained first,
+    because the workers cannot ask for them. They are then published
+    once in shared memory, which the workers attach to, instead of
+    being pickled for every task. Each worker only receives the trades
+    and dividends for its own share.
+
+    input arguments:
+    QSA_shares: list of shares that need a quick sale adjustment.
+    trades: list with all trades.
+    dividends: list with all dividends.
+    workers: maximum number of worker processes.
+    timelines: optional dict with a HoldingsTimeline by share code.
+
+    return: list with the quick sale adjustment for each share in
+        QSA_shares.
+
+    other data changes (to mutable objects in arguments):
+    quick_sale_adjustment is set for each share in QSA_shares, and
+    quick_sale_portion for each of their trades, as calc_QSA would do.
+    """
+    trades_by_code = {share.code: [] for share in QSA_shares}
+    for trade in trades:
+        if trade.code in trades_by_code:
+            trades_by_code[trade.code].append(trade)
+    dividends_by_code = {share.code: [] for share in QSA_shares}
+    for dividend in dividends:
+        if dividend.code in dividends_by_code:
+            dividends_by_code[dividend.code].append(dividend)
+
+    for share in QSA_shares:
+        for trade in trades_by_code[share.code]:
+            FX_rate(share.currency, trade.date_time.date())
+        for dividend in dividends_by_code[share.code]:
+            FX_rate(share.currency, dividend.date_paid)
+        # This obtains any rate that is not yet known.
+
+    with shared_tables.publish_fx_rates(fx_rates) as rates_table:
+        tasks = []
+        for share in QSA_shares:
+            timeline = timelines.get(share.code) if timelines is not None else None
+            tasks.append((share, trades_by_code[share.code], dividends_by_code[share.code],
+                          rates_table.handle, tax_year, timeline, corporate_actions))
+
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(calc_QSA_in_worker, *zip(*tasks)))
+            # map returns results in the order of the tasks, regardless
+            # of the order in which workers finish them.
+
+    quick_sale_adjustments = []
+    for share, (quick_sale_adjustment, quick_sale_portions, report) in zip(QSA_shares,
+                                                                           results):
+        print('\nQuick Sale Adjustment calculations for ' + share.code)
+        print(report, end='')
+        share.quick_sale_adjustment = quick_sale_adjustment
+        for trade, quick_sale_portion in zip(trades_by_code[share.code], quick_sale_portions):
+            trade.quick_sale_portion = quick_sale_portion
+        quick_sale_adjustments.append(quick_sale_adjustment)
+    return quick_sale_adjustments
+
+
+def determine_FDR_income(FDR_basic_income, any_quick_sale_adjustment, shares, trades, dividends,
+                         workers=None, timelines=None):
+    """
+    Calculates and prints Fair Dividend Rate income, including quick
+    sale adjustments where needed.
+
+    input arguments:
+    FDR_basic_income, any_quick_sale_adjustment: as returned by
+        process_opening_positions and process_trades.
+    shares, trades, dividends: lists after all processing.
+    workers: if more than 1, quick sale adjustments for different
+        shares are calculated in parallel by up to this number of
+        worker processes. See calc_QSAs_in_parallel.
+    timelines: optional dict with a HoldingsTimeline by share code, as
+        built by build_holdings_timelines.
+
+    return: FDR_income
+    """
     print('\nFair Dividend Rate income calculation')
     if any_quick_sale_adjustment:
         quick_sale_adjustments = Decimal('0.00')
-        for share in shares:
-            if share.quick_sale_adjustment:
+        QSA_shares = [share for share in shares if share.quick_sale_adjustment]
+        if workers is not None and workers > 1 and len(QSA_shares) > 1:
+            for share_adjustment in run_stage(calc_QSAs_in_parallel, QSA_shares, trades,
+                                              dividends, workers, timelines,
+                                              rows=len(QSA_shares)):
+                quick_sale_adjustments += share_adjustment
+        else:
+            for share in QSA_shares:
                 print('\nQuick Sale Adjustment calculations for ' + share.code)
-                share_adjustment = calc_QSA(share, trades, dividends)
+                timeline = timelines.get(share.code) if timelines is not None else None
+                share_adjustment = run_stage(calc_QSA, share, trades, dividends, timeline)
                 quick_sale_adjustments += share_adjustment
 
         print('\n{v1:{w1}}{v2:>{w2},.2f}'.format(
@@ -1501,9 +2559,10 @@ def determine_FDR_income(FDR_basic_income, any_quick_sale_adjustment, shares, tr
 
 def print_FIF_income(CV_income, FDR_income):
     """
+    Determines and prints the final FIF income, as the minimum of
+    Comparative Value and Fair Dividend Rate income.
 
-    :param CV_income:
-    :return:
+    return: FIF_income
     """
     if FDR_income <= CV_income:
         print('\nUse Fair Dividend Rate income as basis for FIF income')
@@ -1512,50 +2571,224 @@ def print_FIF_income(CV_income, FDR_income):
         print('\nUse Comparative Value income as basis for FIF income')
         if CV_income < 0:
             print('However, FIF income cannot be negative.')
-            FIF_income = 0
+            FIF_income = Decimal('0.00')
         else:
             FIF_income = CV_income
 
     print('{v1:{w1}}{v2:>{w2},.2f}\n'.format(
             v1 = 'FIF income is:', w1 = 93, v2 = FIF_income, w2 = 20))
-    return
+    return FIF_income
 
 
-def main():
-    global fx_rates
-    global tax_year
-
-    if not testing:
-        tax_year = get_tax_year()
+FIF_result = namedtuple('FIF_result', 'FIF_income, CV_income, FDR_income, FDR_basic_income, '
+                        'opening_value, cost_of_trades, gross_income_from_dividends, '
+                        'closing_value, shares')
 
-    fx_rates = get_fx_rates(fx_rates)
 
-    shares = get_opening_positions()
-    opening_value, FDR_basic_income = process_opening_positions(shares)
+def calculate_FIF_income(shares, trades, dividends, closing_prices, workers=None,
+                         aggregate=False):
+    """
+    Runs all processing stages on the input that has been read, and
+    prints the report on the way.
 
+    input arguments:
+    shares, trades, dividends, closing_prices: as returned by
+        load_input_files. shares and trades are updated in place.
+    workers: see determine_FDR_income.
+    aggregate: if True, partial fills of the same order are merged into
+        single trades first; see aggregate_fills.
+
+    return: FIF_result namedtuple with the results of all stages, and
+        the shares with their values at the end of the tax period.
+    """
+    if aggregate:
+        trades = run_stage(aggregate_fills, trades)
+    if fx_provider is not None:
+        run_stage(prefetch_fx_rates, shares, trades, dividends)
+    run_stage(check_inputs, shares, trades, dividends, closing_prices)
+
+    opening_value, FDR_basic_income = run_stage(process_opening_positions, shares,
+                                                rows=len(shares))
     # Need to process trades first, to get info on shares purchased
     # during the year, which might receive dividends later.
-    trades = get_trades()
-    cost_of_trades, any_quick_sale_adjustment = process_trades(shares, trades)
-
-    dividends = get_dividends()
-    gross_income_from_dividends = process_dividends(shares, dividends)
-
-    closing_prices = get_closing_prices(shares)
-    closing_value = process_closing_prices(shares, closing_prices)
+    cost_of_trades, any_quick_sale_adjustment = run_stage(process_trades, shares, trades,
+                                                          rows=len(trades))
+    timelines = run_stage(build_holdings_timelines, shares, trades, corporate_actions,
+                          previous_closing_date(), closing_date(), rows=len(trades))
+
+    gross_income_from_dividends = run_stage(process_dividends, shares, dividends,
+                                            rows=len(dividends))
+    print_dividend_reconciliation(run_stage(reconcile_dividends, dividends, timelines,
+                                            Decimal('0.5'), corporate_actions, closing_date(),
+                                            rows=len(dividends)))
+
+    closing_value = run_stage(process_closing_prices, shares, closing_prices,
+                              rows=len(closing_prices))
 # uncomment next when ready to actually save
 #     save_closing_positions(shares)
 
-    CV_income = calc_comparative_value_income(opening_value, cost_of_trades,
+    CV_income = run_stage(calc_comparative_value_income, opening_value, cost_of_trades,
             gross_income_from_dividends, closing_value)
 
-    FDR_income = determine_FDR_income(FDR_basic_income, any_quick_sale_adjustment,
-           shares, trades, dividends)
+    FDR_income = run_stage(determine_FDR_income, FDR_basic_income, any_quick_sale_adjustment,
+           shares, trades, dividends, workers, timelines, rows=len(shares))
+
+    FIF_income = print_FIF_income(CV_income, FDR_income)
+    return FIF_result(FIF_income, CV_income, FDR_income, FDR_basic_income, opening_value,
+                      cost_of_trades, gross_income_from_dividends, closing_value, shares)
+
+
+def main(stats_file=None, allocation_top=0, profiler=None, workers=None,
+         statement_file=None, aggregate=False, provider=None, actions=None,
+         price_history=None, check_only=False, results_file=None):
+    """
+    Runs the complete FIF income calculation.
 
-    print_FIF_income(CV_income, FDR_income)
-    save_fx_rates(fx_rates)
+    input arguments:
+    stats_file: if not None, statistics are collected for each stage
+        of the run and written as JSON to this file at the end of the
+        run ('-' prints them instead).
+    allocation_top: number of source lines with the largest memory
+        allocations to include in the statistics for each stage. Only
+        used if tracemalloc is tracing; see RunStatistics.
+    profiler: the cProfile.Profile instance that is profiling this
+        run, if any; see RunStatistics.
+    workers: number of worker processes for quick sale adjustments;
+        see determine_FDR_income.
+    statement_file: if not None, trades, dividends and closing prices
+        are all read from this activity statement, instead of from
+        separate files.
+    aggregate: if True, partial fills of the same order are merged into
+        single trades before processing; see aggregate_fills.
+    provider: if not None, the provider (from fx_providers.py) for
+        missing foreign exchange rates; see fx_provider.
+    actions: if not None, the CorporateActionIndex for the run; see
+        corporate_actions.
+    price_history: if not None, the directory of the price history
+        store; see price_history_directory.
+    check_only: if True, the inputs are only checked (see
+        check_inputs), and nothing is calculated. Rates fetched from
+        the provider are still written through to fx_rates_file, as
+        fetch_fx_rates always does.
+    results_file: if not None, the results for each share are saved to
+        this file, to compare them with those of another run; see
+        share_results.py.
+
+    return: None; or the list of problems in the inputs if check_only.
+    """
+    global fx_rates
+    global fx_provider
+    global corporate_actions
+    global price_history_directory
+    global tax_year
+    global run_stats
+    global securities
+
+    if stats_file is not None:
+        run_stats = RunStatistics(allocation_top, profiler)
+    saved_settings = (fx_provider, corporate_actions, price_history_directory)
+    # The settings from the arguments only apply to this run.
+
+    try:
+        if not testing:
+            tax_year = get_tax_year()
+
+        if provider is not None:
+            fx_provider = provider
+        if actions is not None:
+            corporate_actions = actions
+        if price_history is not None:
+            price_history_directory = price_history
+        fx_rates = run_stage(get_fx_rates, fx_rates, fx_rates_file)
+        securities = run_stage(load_securities_master, securities_master_file)
+        shares, trades, dividends, closing_prices = run_stage(load_input_files, statement_file)
+        if check_only:
+            if fx_provider is not None:
+                prefetch_fx_rates(shares, trades, dividends)
+            return check_inputs(shares, trades, dividends, closing_prices, check_only=True)
+        result = calculate_FIF_income(shares, trades, dividends, closing_prices, workers, aggregate)
+        if results_file is not None:
+            run_stage(save_share_results, results_file, share_rows(result.shares))
+        save_fx_rates(fx_rates, fx_rates_file)
+        update_securities_master(shares, dividends)
+        save_securities_master(securities, securities_master_file)
+        record_closing_prices(closing_prices)
+        # Last, so a conflict with the price history cannot cost the
+        # exchange rates and securities that were just obtained.
+    finally:
+        if run_stats is not None:
+            if stats_file is not None:
+                run_stats.save(stats_file)
+            run_stats = None
+        fx_provider, corporate_actions, price_history_directory = saved_settings
+        # Also after an error or a check only, so the statistics and
+        # settings of this run do not carry over to the next run in
+        # this process.
     return
 
 
 if __name__ == '__main__':
-    main()
+    parser = argparse.ArgumentParser(description='Calculate FIF income')
+    parser.add_argument('--stats', metavar='FILE', nargs='?', const='-',
+                        help='write per-stage timings and counters as JSON to FILE ' +
+                             '(or print them if FILE is omitted)')
+    parser.add_argument('--profile', metavar='PREFIX',
+                        help='run under cProfile and tracemalloc, and write PREFIX.pstats, ' +
+                             'PREFIX.collapsed (for flame graphs), PREFIX.txt and ' +
+                             'PREFIX.stats.json (with allocations per stage)')
+    parser.add_argument('--profile-top', metavar='N', type=int, default=25,
+                        help='number of functions and allocation sites to report (default 25)')
+    parser.add_argument('--workers', metavar='N', type=int,
+                        help='calculate quick sale adjustments in up to N worker processes')
+    parser.add_argument('--statement', metavar='FILE',
+                        help='read trades, dividends and closing prices from an ' +
+                             'Interactive Brokers activity statement')
+    parser.add_argument('--aggregate-fills', action='store_true',
+                        help='merge partial fills of the same order into single trades')
+    parser.add_argument('--fx-provider', metavar='SOURCE',
+                        help='get missing exchange rates from SOURCE: file:FILENAME ' +
+                             '(csv or pickle) or the http URL of a rate service')
+    parser.add_argument('--corporate-actions', metavar='FILE',
+                        help='csv file with share splits and other reorganisations; ' +
+                             'see corporate_actions.py')
+    parser.add_argument('--price-history', metavar='DIRECTORY',
+                        help='get closing prices from, and add them to, the price history ' +
+                             'in DIRECTORY; see price_history.py')
+    parser.add_argument('--check', action='store_true',
+                        help='only check all inputs and list every problem found; the exit ' +
+                             'status is 1 if there are errors')
+    parser.add_argument('--save-results', metavar='FILE',
+                        help='save the results for each share to FILE, to compare runs with ' +
+                             'share_results.py')
+    args = parser.parse_args()
+    provider = None
+    if args.fx_provider:
+        import fx_providers
+        provider = fx_providers.provider_from_spec(args.fx_provider)
+    actions = None
+    if args.corporate_actions:
+        from corporate_actions import read_corporate_actions
+        actions = read_corporate_actions(args.corporate_actions)
+    if args.check:
+        problems = main(statement_file=args.statement, provider=provider, actions=actions,
+                        price_history=args.price_history, check_only=True)
+        if not problems:
+            print('No problems found in the inputs')
+        if provider is not None:
+            provider.close()
+        sys.exit(1 if any(problem.severity == ERROR for problem in problems) else 0)
+    if args.profile:
+        import profile_FIF
+        profile_FIF.profile_run(main, args.profile, args.profile_top,
+                                stats_file=args.profile + '.stats.json',
+                                allocation_top=args.profile_top, workers=args.workers,
+                                statement_file=args.statement, aggregate=args.aggregate_fills,
+                                provider=provider, actions=actions,
+                                price_history=args.price_history,
+                                results_file=args.save_results)
+    else:
+        main(stats_file=args.stats, workers=args.workers, statement_file=args.statement,
+             aggregate=args.aggregate_fills, provider=provider, actions=actions,
+             price_history=args.price_history, results_file=args.save_results)
+    if provider is not None:
+        provider.close()
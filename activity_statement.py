@@ -0,0 +1,68 @@
+"""
+Single pass reader for Interactive Brokers activity statements.
+
+An activity statement is one csv file with many sections. Each row
+starts with the name of its section (e.g. Trades, Dividends, Open
+Positions), followed by the kind of row: Header, Data, SubTotal or
+Total. A Header row gives the field names for the Data rows that
+follow it, until the next Header row of the same section. For example:
+
+    Trades,Header,DataDiscriminator,Asset Category,Currency,Symbol,...
+    Trades,Data,Order,Stocks,USD,VEU,"2017-05-03, 09:30:00",...
+    Trades,SubTotal,,Stocks,USD,VEU,,...
+
+The reader goes through the file once, and passes each Data row of the
+requested sections, as a dict keyed by the field names of its Header
+row, to a record builder for that section. Rows of all other sections
+are skipped without being split into a dict.
+
+The module does not depend on FIF.py; the record builders are provided
+by the caller.
+"""
+
+import csv
+
+
+def read_statement(filename, builders):
+    """
+    Reads an activity statement and builds records from the rows of
+    the requested sections.
+
+    input arguments:
+    filename: the name of the activity statement csv file.
+    builders: dict with a function for each section that is needed, by
+        section name. Each function is called with a dict for a Data
+        row and returns a record, or None if the row must be skipped.
+        The dict includes the section name under the first field name
+        and 'Data' under 'Header', just like a row of a separate csv
+        file exported for that section.
+
+    return: dict with a list of records for each section in builders,
+        in the order of the rows in the file.
+    """
+    records = {section: [] for section in builders}
+    field_names = {}
+
+    with open(filename, newline='', encoding='utf-8-sig') as statement_file:
+        for fields in csv.reader(statement_file):
+            if len(fields) < 2:
+                continue
+            section = fields[0]
+            builder = builders.get(section)
+            if builder is None:
+                continue
+                # A section we do not need.
+
+            if fields[1] == 'Header':
+                field_names[section] = fields
+                continue
+            if fields[1] != 'Data' or section not in field_names:
+                continue
+                # Skip sub-totals and totals, and (invalid) data rows
+                # before any header.
+
+            record = builder(dict(zip(field_names[section], fields)))
+            if record is not None:
+                records[section].append(record)
+
+    return records
@@ -0,0 +1,322 @@
+"""
+Audit mode for FIF.py: recomputes every stored tax year of one or more
+portfolios, e.g. after a correction of the FDR rules or of the foreign
+exchange rates, and compares the results with those saved before.
+
+Each portfolio is a directory with a subdirectory for each tax year
+(from 2008), holding the inputs of that year as they were used:
+    portfolio/
+        corporate_actions.csv       (optional; see corporate_actions.py)
+        2017/opening_positions.csv
+             trades.csv
+             dividends.csv
+             closing_prices.csv
+             results.json           (written with --save)
+             share_results.csv      (written with --save)
+        2018/...
+These are the same files as written by synthetic_portfolio.py.
+
+The opening positions of a year are the closing positions of the year
+before, so the years of a portfolio form a chain. All years are first
+recomputed at the same time, in a pool of worker processes, each from
+its stored opening positions. A year whose stored opening positions
+turn out to differ from the recomputed closing positions of the year
+before (e.g. after a correction of a trade) is then recomputed from
+those closing positions, as soon as the year before is final. Only
+such years wait for each other, so the total time is at most that of
+the longest chain of years that changed, and normally that of the
+slowest single year.
+The results of each share are compared as well (see share_results.py),
+to show which shares changed and why.
+
+Example:
+    python audit_FIF.py client_a client_b --fx-rates saved_fx_rates.pickle
+    python audit_FIF.py client_a --save
+"""
+
+import argparse
+from collections import namedtuple
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from contextlib import redirect_stdout
+from decimal import Decimal
+import io
+import json
+import os.path
+
+import FIF
+from corporate_actions import read_corporate_actions
+import fif_service
+from share_results import diff_share_results, print_diff, read_share_results, \
+    save_share_results, share_rows
+
+
+INPUT_FILES = {'opening': 'opening_positions.csv', 'trades': 'trades.csv',
+               'dividends': 'dividends.csv', 'closing': 'closing_prices.csv'}
+ACTIONS_FILE = 'corporate_actions.csv'
+RESULTS_FILE = 'results.json'
+SHARE_RESULTS_FILE = 'share_results.csv'
+FIRST_TAX_YEAR = 2008
+RESULT_FIELDS = [field for field in FIF.FIF_result._fields if field != 'shares']
+position = namedtuple('position', 'code, full_name, currency, holding, price')
+# A closing position, or an opening position of the next year.
+year_result = namedtuple('year_result', 'portfolio, tax_year, totals, opening_positions, '
+                         'closing_positions, share_rows, report, error')
+# The result of recomputing one year. totals is a dict with the
+# values of RESULT_FIELDS, as strings; it is None if there was an
+# error. share_rows are as returned by share_results.share_rows.
+year_audit = namedtuple('year_audit', 'portfolio, tax_year, changes, reopened, saved, '
+                        'share_diff, result')
+# changes is a list of (field, saved value, recomputed value) tuples.
+# share_diff is the result of share_results.diff_share_results for the
+# saved and recomputed share results, or None.
+
+
+def stored_years(portfolio, years=None):
+    """
+    return: sorted list of the tax years with a directory in portfolio,
+        limited to years if that is not None.
+    """
+    found = [int(name) for name in os.listdir(portfolio)
+             if name.isdigit() and os.path.isdir(os.path.join(portfolio, name))
+             and int(name) >= FIRST_TAX_YEAR]
+    return sorted(year for year in found if years is None or year in years)
+
+
+def year_file(portfolio, tax_year, name):
+    return os.path.join(portfolio, str(tax_year), name)
+
+
+def recompute_year(portfolio, tax_year, opening_positions=None):
+    """
+    Recomputes one tax year, in a worker process that has been
+    prepared by fif_service.start_worker.
+
+    input arguments:
+    portfolio: the directory of the portfolio.
+    tax_year: the tax year.
+    opening_positions: list of positions to start from, or None to
+        start from the stored opening positions.
+
+    return: year_result namedtuple.
+    """
+    FIF.tax_year = tax_year
+    actions_file = os.path.join(portfolio, ACTIONS_FILE)
+    FIF.corporate_actions = read_corporate_actions(actions_file) \
+        if os.path.isfile(actions_file) else None
+    filenames = {item: year_file(portfolio, tax_year, name)
+                 for item, name in INPUT_FILES.items()}
+    if opening_positions is None:
+        if not os.path.isfile(filenames['opening']):
+            return year_result(portfolio, tax_year, None, [], [], [], '',
+                               'no stored opening positions')
+        shares = FIF.read_opening_positions(filenames['opening'])
+    else:
+        shares = [FIF.Share(*opening_position) for opening_position in opening_positions]
+    used_positions = [position(share.code, share.full_name, share.currency,
+                               str(share.opening_holding), str(share.opening_price))
+                      for share in shares]
+    trades = FIF.read_trades(filenames['trades'])
+    dividends = FIF.read_dividends(filenames['dividends'])
+    closing_prices = FIF.read_closing_prices(filenames['closing']) \
+        if os.path.isfile(filenames['closing']) else []
+
+    report = io.StringIO()
+    try:
+        with redirect_stdout(report):
+            result = FIF.calculate_FIF_income(shares, trades, dividends, closing_prices)
+    except (FIF.MissingFXRateError, FIF.UnknownShareError) as error:
+        return year_result(portfolio, tax_year, None, used_positions, [], [],
+                           report.getvalue(), str(error))
+    totals = {field: str(getattr(result, field)) for field in RESULT_FIELDS}
+    closing_positions = [position(share.code, share.full_name, share.currency,
+                                  str(share.holding), str(share.closing_price))
+                         for share in result.shares]
+    return year_result(portfolio, tax_year, totals, used_positions, closing_positions,
+                       share_rows(result.shares), report.getvalue(), None)
+
+
+def held_positions(positions):
+    """return: dict with the holding and price of each share held."""
+    return {item.code: (Decimal(item.holding), Decimal(item.price))
+            for item in positions if Decimal(item.holding) != Decimal('0')}
+
+
+def same_positions(closing_positions, opening_positions):
+    """
+    return: whether the opening positions are the closing positions,
+        as far as shares are held.
+    """
+    return held_positions(closing_positions) == held_positions(opening_positions)
+
+
+def recompute_all(portfolios, years=None, workers=None, fx_rates_file=FIF.fx_rates_file,
+                  securities_master_file=FIF.securities_master_file):
+    """
+    Recomputes all stored years of the portfolios; see the module
+    docstring.
+
+    input arguments:
+    portfolios: list of portfolio directories.
+    years: optional collection of tax years to limit the audit to.
+    workers: the number of worker processes; None for the number of
+        processors.
+    fx_rates_file, securities_master_file: the files each worker loads
+        when it starts.
+
+    return: (tuple with) dict with the final year_result by (portfolio,
+        tax year), and the set of (portfolio, tax year) keys of years
+        that were recomputed from the closing positions of the year
+        before instead of from their stored opening positions.
+    """
+    chains = {portfolio: stored_years(portfolio, years) for portfolio in portfolios}
+    results = {}
+    final = set()
+    reopened = set()
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=fif_service.start_worker,
+                             initargs=(fx_rates_file, securities_master_file)) as executor:
+        pending = {executor.submit(recompute_year, portfolio, tax_year): (portfolio, tax_year)
+                   for portfolio, chain in chains.items() for tax_year in chain}
+
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                portfolio, tax_year = pending.pop(future)
+                results[(portfolio, tax_year)] = future.result()
+                chain = chains[portfolio]
+                # Settle the years from here on, for as long as the year
+                # before each of them is final.
+                for index in range(chain.index(tax_year), len(chain)):
+                    key = (portfolio, chain[index])
+                    if key in final or key not in results:
+                        break
+                    previous_key = (portfolio, chain[index] - 1)
+                    if index > 0 and chain[index - 1] == chain[index] - 1:
+                        if previous_key not in final:
+                            break
+                        previous = results[previous_key]
+                        if previous.error is None and not same_positions(
+                                previous.closing_positions, results[key].opening_positions):
+                            del results[key]
+                            reopened.add(key)
+                            pending[executor.submit(recompute_year, portfolio, chain[index],
+                                                    previous.closing_positions)] = key
+                            break
+                    final.add(key)
+    return results, reopened
+
+
+def read_saved_results(portfolio, tax_year):
+    """return: dict with the saved totals of a year, or None."""
+    filename = year_file(portfolio, tax_year, RESULTS_FILE)
+    if not os.path.isfile(filename):
+        return None
+    with open(filename) as results_file:
+        return json.load(results_file)
+
+
+def read_saved_share_results(portfolio, tax_year):
+    """return: dict with the saved results of each share of a year, or None."""
+    filename = year_file(portfolio, tax_year, SHARE_RESULTS_FILE)
+    if not os.path.isfile(filename):
+        return None
+    return read_share_results(filename)
+
+
+def save_results(result):
+    """
+    Saves the totals and share results of a year_result as the results
+    of its year.
+    """
+    with open(year_file(result.portfolio, result.tax_year, RESULTS_FILE), 'w') as results_file:
+        json.dump(result.totals, results_file, indent=1)
+    save_share_results(year_file(result.portfolio, result.tax_year, SHARE_RESULTS_FILE),
+                       result.share_rows)
+    return
+
+
+def compare_totals(saved, totals):
+    """
+    return: list of (field, saved value, recomputed value) tuples for
+        the fields in RESULT_FIELDS that differ.
+    """
+    changes = []
+    for field in RESULT_FIELDS:
+        saved_value = saved.get(field)
+        value = totals.get(field)
+        if saved_value is None or value is None or Decimal(saved_value) != Decimal(value):
+            changes.append((field, saved_value, value))
+    return changes
+
+
+def audit(portfolios, years=None, workers=None, fx_rates_file=FIF.fx_rates_file,
+          securities_master_file=FIF.securities_master_file, save=False):
+    """
+    Recomputes all stored years and compares them with their saved
+    results.
+
+    input arguments: as for recompute_all, and
+    save: if True, the recomputed results are saved as the results of
+        each year (except for years with an error).
+
+    return: list of year_audit namedtuples, by portfolio and tax year.
+    """
+    results, reopened = recompute_all(portfolios, years, workers, fx_rates_file,
+                                      securities_master_file)
+    audits = []
+    for key in sorted(results):
+        result = results[key]
+        saved = read_saved_results(*key)
+        changes = [] if saved is None or result.error is not None else \
+            compare_totals(saved, result.totals)
+        saved_shares = read_saved_share_results(*key)
+        share_diff = None if saved_shares is None or result.error is not None else \
+            diff_share_results(saved_shares, {row.code: row for row in result.share_rows})
+        audits.append(year_audit(key[0], key[1], changes, key in reopened, saved, share_diff,
+                                 result))
+        if save and result.error is None:
+            save_results(result)
+    return audits
+
+
+def print_audits(audits):
+    """Prints the differences for each year; see audit."""
+    for year in audits:
+        print('\n{} {}'.format(year.portfolio, year.tax_year))
+        if year.reopened:
+            print('    opening positions differ from the closing positions of {}; '
+                  'recomputed from those'.format(year.tax_year - 1))
+        if year.result.error is not None:
+            print('    error: ' + year.result.error)
+        elif year.saved is None:
+            print('    no saved results')
+        elif not year.changes:
+            print('    no changes')
+        for field, saved_value, value in year.changes:
+            difference = '' if saved_value is None or value is None else \
+                '{:>20,.2f}'.format(Decimal(value) - Decimal(saved_value))
+            print('    {:30}{:>20}{:>20}{}'.format(field, saved_value or '-', value or '-',
+                                                   difference))
+        if year.share_diff is not None and year.share_diff[0]:
+            print('    changes by share:')
+            print_diff(*year.share_diff, indent='    ')
+    return
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Recompute and compare all stored tax years')
+    parser.add_argument('portfolios', nargs='+', metavar='PORTFOLIO',
+                        help='directory with a subdirectory of inputs for each tax year')
+    parser.add_argument('--years', type=int, nargs='+', metavar='YEAR',
+                        help='only audit these tax years')
+    parser.add_argument('--workers', metavar='N', type=int,
+                        help='number of worker processes (default: number of processors)')
+    parser.add_argument('--fx-rates', default=FIF.fx_rates_file, metavar='FILE',
+                        help='file with the saved exchange rates')
+    parser.add_argument('--securities-master', default=FIF.securities_master_file,
+                        metavar='FILE', help='file with the securities master')
+    parser.add_argument('--save', action='store_true',
+                        help='save the recomputed results as the results of each year')
+    args = parser.parse_args()
+    print_audits(audit(args.portfolios, args.years, args.workers, args.fx_rates,
+                       args.securities_master, args.save))
@@ -0,0 +1,215 @@
+"""
+Benchmark suite for the processing stages of FIF.py.
+
+Synthetic portfolios of several sizes are generated with
+synthetic_portfolio.py, and every stage of FIF.main() is timed on
+them. Results can be saved as a JSON baseline, and later runs can be
+compared against such a baseline to detect performance regressions.
+
+Sizes are given as SHARESxTRADESxDIVIDENDS, i.e. the number of shares,
+the number of trades per share and the number of dividends per share.
+
+Example:
+    python benchmark_FIF.py --sizes 10x10x4 100x20x4 --save baseline.json
+    python benchmark_FIF.py --sizes 10x10x4 100x20x4 --compare baseline.json
+"""
+
+import argparse
+from contextlib import redirect_stdout
+import json
+import os
+import platform
+import sys
+import tempfile
+from time import perf_counter
+
+import FIF
+from synthetic_portfolio import generate_portfolio
+
+
+STAGES = ('get_opening_positions', 'process_opening_positions', 'get_trades',
+          'process_trades', 'get_dividends', 'process_dividends', 'get_closing_prices',
+          'process_closing_prices', 'calc_comparative_value_income',
+          'determine_FDR_income')
+DEFAULT_SIZES = ('10x10x4', '100x20x4', '300x50x4')
+DEFAULT_TOLERANCE = 1.25
+# A stage is reported as a regression if it takes more than 25% longer
+# than in the baseline.
+
+
+def parse_size(size):
+    """
+    Converts a size string such as '100x20x4' into a tuple of integers
+    (number_of_shares, trades_per_share, dividends_per_share).
+    """
+    try:
+        number_of_shares, trades_per_share, dividends_per_share = (
+            int(item) for item in size.lower().split('x'))
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            '{} is not a valid size; use SHARESxTRADESxDIVIDENDS'.format(size))
+    return number_of_shares, trades_per_share, dividends_per_share
+
+
+def run_pipeline(files, tax_year):
+    """
+    Runs all stages of FIF.main() once on the input files, with all
+    print output suppressed.
+
+    input arguments:
+    files: a portfolio_files namedtuple as returned by
+        generate_portfolio.
+    tax_year: the tax year for which the files were generated.
+
+    return: dict with the wall time, in seconds, for every stage.
+    """
+    FIF.testing = True
+    FIF.tax_year = tax_year
+    FIF.opening_test_file = files.opening
+    FIF.trades_test_file = files.trades
+    FIF.dividends_test_file = files.dividends
+    FIF.closing_test_file = files.closing
+    FIF.fx_rates = FIF.get_fx_rates(FIF.fx_rates, files.fx_rates)
+    timings = {}
+
+    def timed(stage, *args):
+        start = perf_counter()
+        result = getattr(FIF, stage)(*args)
+        timings[stage] = perf_counter() - start
+        return result
+
+    with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+        shares = timed('get_opening_positions')
+        opening_value, FDR_basic_income = timed('process_opening_positions', shares)
+        trades = timed('get_trades')
+        cost_of_trades, any_quick_sale_adjustment = timed('process_trades', shares, trades)
+        dividends = timed('get_dividends')
+        gross_income_from_dividends = timed('process_dividends', shares, dividends)
+        closing_prices = timed('get_closing_prices', shares)
+        closing_value = timed('process_closing_prices', shares, closing_prices)
+        timed('calc_comparative_value_income', opening_value, cost_of_trades,
+              gross_income_from_dividends, closing_value)
+        timed('determine_FDR_income', FDR_basic_income, any_quick_sale_adjustment, shares,
+              trades, dividends)
+
+    return timings
+
+
+def benchmark(sizes, repeat=3, tax_year=2018, seed=0):
+    """
+    Times every stage for every size. The best (i.e. lowest) time out
+    of repeat runs is kept for each stage, because that is the least
+    affected by other activity on the machine.
+
+    input arguments:
+    sizes: iterable of size strings, such as '100x20x4'.
+    repeat: number of times the whole pipeline is run for each size.
+    tax_year: the tax year for the synthetic portfolios.
+    seed: seed for the synthetic portfolio generator.
+
+    return: dict with results by size, and by stage within each size.
+    """
+    results = {}
+    for size in sizes:
+        number_of_shares, trades_per_share, dividends_per_share = parse_size(size)
+        with tempfile.TemporaryDirectory() as directory:
+            files = generate_portfolio(directory, tax_year, number_of_shares,
+                                       trades_per_share, dividends_per_share, seed)
+            best = {}
+            for _ in range(repeat):
+                for stage, seconds in run_pipeline(files, tax_year).items():
+                    best[stage] = min(seconds, best.get(stage, seconds))
+        best['total'] = sum(best[stage] for stage in STAGES)
+        results[size] = best
+    return results
+
+
+def compare(results, baseline, tolerance=DEFAULT_TOLERANCE):
+    """
+    Compares benchmark results with a baseline.
+
+    input arguments:
+    results: dict as returned by benchmark.
+    baseline: dict as returned by benchmark, or as read from a saved
+        baseline file.
+    tolerance: ratio of current to baseline time above which a stage
+        is reported as a regression.
+
+    return: list of (size, stage, baseline seconds, current seconds)
+        tuples for every regression. Sizes and stages that are not in
+        both results and baseline are ignored.
+    """
+    regressions = []
+    for size, timings in results.items():
+        if size not in baseline:
+            continue
+        for stage, seconds in timings.items():
+            baseline_seconds = baseline[size].get(stage)
+            if baseline_seconds is not None and seconds > baseline_seconds * tolerance:
+                regressions.append((size, stage, baseline_seconds, seconds))
+    return regressions
+
+
+def print_results(results, baseline=None):
+    header_format_string = '{v1:32}' + '{v2:>14}' + '{v3:>14}' + '{v4:>10}'
+    line_format_string = '{v1:32}' + '{v2:>14}' + '{v3:>14.6f}' + '{v4:>10}'
+    for size, timings in results.items():
+        print('\nsize {} (shares x trades per share x dividends per share)'.format(size))
+        print(header_format_string.format(v1='stage', v2='baseline (s)', v3='current (s)',
+                                          v4='ratio'))
+        print(70 * '-')
+        for stage, seconds in timings.items():
+            baseline_seconds = None
+            if baseline is not None and size in baseline:
+                baseline_seconds = baseline[size].get(stage)
+            if baseline_seconds:
+                shown_baseline = '{:.6f}'.format(baseline_seconds)
+                ratio = '{:.2f}'.format(seconds / baseline_seconds)
+            else:
+                shown_baseline = ratio = '-'
+            print(line_format_string.format(v1=stage, v2=shown_baseline, v3=seconds,
+                                            v4=ratio))
+    return
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the stages of FIF.py')
+    parser.add_argument('--sizes', nargs='+', default=DEFAULT_SIZES,
+                        help='portfolio sizes as SHARESxTRADESxDIVIDENDS')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--tax-year', type=int, default=2018)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--save', metavar='FILE', help='save results as JSON baseline')
+    parser.add_argument('--compare', metavar='FILE', help='compare with JSON baseline')
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE)
+    args = parser.parse_args(argv)
+    for size in args.sizes:
+        parse_size(size)
+        # Fail early on an invalid size.
+
+    results = benchmark(args.sizes, args.repeat, args.tax_year, args.seed)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            baseline = json.load(baseline_file)['results']
+    print_results(results, baseline)
+
+    if args.save:
+        with open(args.save, 'w') as baseline_file:
+            json.dump({'python': platform.python_version(), 'machine': platform.machine(),
+                       'repeat': args.repeat, 'results': results},
+                      baseline_file, indent=2)
+
+    if baseline is not None:
+        regressions = compare(results, baseline, args.tolerance)
+        for size, stage, baseline_seconds, seconds in regressions:
+            print('Regression for size {}, stage {}: {:.6f}s against {:.6f}s'.format(
+                size, stage, seconds, baseline_seconds))
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
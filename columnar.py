@@ -0,0 +1,135 @@
+"""
+Columnar (Parquet and Arrow IPC) input and output for FIF.py.
+
+Large trade histories can be kept as Parquet or Arrow IPC (Feather)
+files instead of csv files. Only the columns that FIF.py needs are
+read, and rows outside the tax period are filtered out by pyarrow
+before they are converted to Python objects. For Parquet files that
+filter uses the statistics of each row group, so row groups entirely
+outside the tax period are not read at all.
+
+Rows are returned as dicts of strings, just like the rows of a
+csv.DictReader, so the same record builders in FIF.py can be used for
+csv and columnar input. The columns may be stored as strings or with
+native types (numbers, dates or timestamps).
+
+pyarrow is only needed when a columnar file is actually read or
+written; it is imported at that moment.
+"""
+
+from datetime import date, datetime, time
+import os.path
+
+
+COLUMNAR_FORMATS = {'.parquet': 'parquet', '.pq': 'parquet', '.arrow': 'ipc',
+                    '.feather': 'ipc', '.ipc': 'ipc'}
+# File formats by file name extension.
+
+
+def columnar_format(filename):
+    """
+    return: 'parquet' or 'ipc' if filename has the extension of a
+        columnar file, or None otherwise.
+    """
+    return COLUMNAR_FORMATS.get(os.path.splitext(str(filename))[1].lower())
+
+
+def import_pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.dataset
+    except ImportError:
+        raise ImportError('pyarrow is needed to read or write Parquet and Arrow files; ' +
+                          'install it with: pip install pyarrow') from None
+    return pyarrow
+
+
+def bound_for(field_type, day):
+    """
+    return: day converted to a value that can be compared with a column
+        of field_type, i.e. a string for string columns (which must
+        then hold dates in ISO format), a datetime for timestamps, or a
+        date otherwise.
+    """
+    pyarrow = import_pyarrow()
+    if pyarrow.types.is_string(field_type) or pyarrow.types.is_large_string(field_type):
+        return day.isoformat()
+    if pyarrow.types.is_timestamp(field_type):
+        return pyarrow.scalar(datetime.combine(day, time.min), type=field_type)
+    return day
+
+
+def as_text(value):
+    """
+    return: value as the text that a csv file would hold for it.
+    """
+    if value is None:
+        return ''
+    if isinstance(value, datetime):
+        return value.strftime('%Y-%m-%d, %H:%M:%S')
+    if isinstance(value, date):
+        return value.isoformat()
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+def read_rows(filename, columns, date_column=None, first_day=None, after_last_day=None):
+    """
+    Reads rows from a Parquet or Arrow IPC file.
+
+    input arguments:
+    filename: the name of the file; see columnar_format.
+    columns: the names of the columns to read. Columns that are not in
+        the file are left out of the rows, just like optional fields of
+        a csv file.
+    date_column: the name of the column with the date (or date and
+        time) of each row, if rows must be filtered on date.
+    first_day: the first day of rows to include.
+    after_last_day: the day after the last day of rows to include.
+
+    return: generator of dicts, with the text for each column by
+        column name.
+    """
+    pyarrow = import_pyarrow()
+    dataset = pyarrow.dataset.dataset(filename, format=columnar_format(filename))
+    schema = dataset.schema
+    selected = [column for column in columns if column in schema.names]
+
+    row_filter = None
+    if date_column is not None and date_column in schema.names:
+        field_type = schema.field(date_column).type
+        field = pyarrow.dataset.field(date_column)
+        row_filter = (field >= bound_for(field_type, first_day)) & \
+                     (field < bound_for(field_type, after_last_day))
+
+    scanner = dataset.scanner(columns=selected, filter=row_filter)
+    for batch in scanner.to_batches():
+        for row in batch.to_pylist():
+            yield {name: as_text(value) for name, value in row.items()}
+    return
+
+
+def write_rows(filename, fieldnames, rows):
+    """
+    Writes rows to a Parquet or Arrow IPC file, with every column
+    stored as a string so that Decimals are kept exactly.
+
+    input arguments:
+    filename: the name of the file; see columnar_format.
+    fieldnames: the names of the columns, in order.
+    rows: list of dicts with a value for each column by name.
+
+    return: None
+    """
+    pyarrow = import_pyarrow()
+    table = pyarrow.table({name: pyarrow.array([as_text(row.get(name)) for row in rows],
+                                               type=pyarrow.string())
+                           for name in fieldnames})
+    if columnar_format(filename) == 'parquet':
+        import pyarrow.parquet
+        pyarrow.parquet.write_table(table, filename)
+    else:
+        import pyarrow.feather
+        pyarrow.feather.write_feather(table, filename)
+    return
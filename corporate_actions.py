@@ -0,0 +1,201 @@
+"""
+Corporate actions for FIF.py: share splits, consolidations and other
+reorganisations that change the number of shares held without a trade.
+
+Each action has a ratio of new shares for old shares, e.g. 2 for 1 for
+a split or 1 for 10 for a consolidation, and takes effect at the start
+of its effective date. A CorporateActionIndex keeps, for each share
+code, the effective moments of its actions in date order and the
+cumulative product of their ratios. The factor between any two moments
+is then the ratio of two cumulative products, found with a binary
+search (bisect), so holdings and prices can be expressed in the shares
+of any other date without rewriting trades or replaying earlier
+actions.
+
+FIF.py expresses all holdings and trades during the tax period in
+shares as at the closing date. A trade for 100 shares before a 2 for 1
+split then counts as 200 shares at half the price; its charge does not
+change.
+
+The file for read_corporate_actions is a csv file with code, date,
+kind, new_shares and old_shares columns, e.g.
+    code,date,kind,new_shares,old_shares
+    AAPL,2020-08-31,split,4,1
+Do not also enter quasi-trades with a price of zero for the same
+actions.
+"""
+
+from bisect import bisect_right
+import copy
+import csv
+from datetime import date, datetime, time
+from decimal import Decimal
+from fractions import Fraction
+
+
+ACTION_KINDS = ('split', 'consolidation', 'reorganisation')
+
+
+class CorporateAction:
+    """
+    Holds information on one corporate action.
+
+    Input arguments:
+    code: the share code.
+    effective_date: the first date on which the new number of shares
+        applies, as a date object.
+    kind: one of ACTION_KINDS; only for information.
+    new_shares, old_shares: the ratio of the action, as new_shares for
+        every old_shares. Best passed as strings.
+
+    Other attributes that are available:
+    ratio: new_shares / old_shares, as an exact Fraction.
+    """
+
+    def __init__(self, code, effective_date, kind, new_shares, old_shares='1'):
+        if kind not in ACTION_KINDS:
+            raise ValueError('unknown kind of corporate action: {}'.format(kind))
+        self.code = code
+        self.effective_date = effective_date
+        self.kind = kind
+        self.new_shares = Decimal(new_shares)
+        self.old_shares = Decimal(old_shares)
+        if self.new_shares <= Decimal('0') or self.old_shares <= Decimal('0'):
+            raise ValueError('the ratio of a corporate action must be positive')
+        self.ratio = Fraction(self.new_shares) / Fraction(self.old_shares)
+        return
+
+    def __repr__(self):
+        return '{} of {} on {}: {:f} for {:f}'.format(self.kind, self.code,
+                                                     self.effective_date, self.new_shares,
+                                                     self.old_shares)
+
+
+def as_moment(moment):
+    """return: moment as a datetime; a date is taken as the end of that day."""
+    if isinstance(moment, datetime):
+        return moment
+    return datetime.combine(moment, time.max)
+
+
+def scale(value, factor):
+    """return: Decimal value multiplied by the Fraction factor."""
+    if factor == 1:
+        return value
+    return value * factor.numerator / factor.denominator
+    # Multiplying first keeps the result exact whenever it can be.
+
+
+class CorporateActionIndex:
+    """
+    Holds all corporate actions, indexed by share code.
+
+    Input arguments:
+    actions: iterable of CorporateActions, in any order.
+
+    Other attributes that are available:
+    moments: dict with a sorted list of effective moments (the start of
+        the effective date) by code.
+    cumulative: dict with a list by code, of which item i is the
+        product of the ratios of the first i actions.
+    """
+
+    def __init__(self, actions=()):
+        by_code = {}
+        for action in actions:
+            by_code.setdefault(action.code, []).append(action)
+        self.actions = {}
+        self.moments = {}
+        self.cumulative = {}
+        for code, code_actions in by_code.items():
+            code_actions.sort(key=lambda action: action.effective_date)
+            self.actions[code] = code_actions
+            self.moments[code] = [datetime.combine(action.effective_date, time.min)
+                                  for action in code_actions]
+            cumulative = [Fraction(1)]
+            for action in code_actions:
+                cumulative.append(cumulative[-1] * action.ratio)
+            self.cumulative[code] = cumulative
+        return
+
+    def factor(self, code, start, end):
+        """
+        return: the Fraction by which a number of shares at start must
+            be multiplied to give the number at end, i.e. the product
+            of the ratios of actions after start up to and including
+            end. start and end are dates (meaning the end of the day)
+            or datetimes; end may be before start.
+        """
+        moments = self.moments.get(code)
+        if not moments:
+            return Fraction(1)
+        cumulative = self.cumulative[code]
+        return (cumulative[bisect_right(moments, as_moment(end))] /
+                cumulative[bisect_right(moments, as_moment(start))])
+
+    def has_actions(self, code, start, end):
+        """return: whether code has any action after start up to end."""
+        moments = self.moments.get(code)
+        if not moments:
+            return False
+        return bisect_right(moments, as_moment(start)) < bisect_right(moments, as_moment(end))
+
+    def adjusted_holding(self, code, holding, moment, to):
+        """
+        return: holding, a number of shares at moment, as the number of
+            shares at to.
+        """
+        return scale(Decimal(holding), self.factor(code, moment, to))
+
+    def adjusted_price(self, code, price, moment, to):
+        """
+        return: price, a price per share at moment, as the price per
+            share at to.
+        """
+        return scale(Decimal(price), 1 / self.factor(code, moment, to))
+
+    def adjusted_trade(self, trade, to):
+        """
+        return: trade itself if no action applies, or otherwise a copy
+            with the number of shares (also of each fill) and the share
+            price as at to. The charge is not changed.
+        """
+        factor = self.factor(trade.code, trade.date_time, to)
+        if factor == 1:
+            return trade
+        adjusted = copy.copy(trade)
+        adjusted.number_of_shares = scale(trade.number_of_shares, factor)
+        adjusted.share_price = scale(trade.share_price, 1 / factor)
+        if trade.fills is not None:
+            adjusted.fills = [(scale(number_of_shares, factor), charge)
+                              for number_of_shares, charge in trade.fills]
+        return adjusted
+
+    def adjusted_dividend(self, dividend, to):
+        """
+        return: dividend itself if no action applies, or otherwise a
+            copy with the dividend per share and the eligible shares as
+            at to. Shares at the start of the payment date count.
+        """
+        factor = self.factor(dividend.code, datetime.combine(dividend.date_paid, time.min), to)
+        if factor == 1:
+            return dividend
+        adjusted = copy.copy(dividend)
+        adjusted.per_share = scale(dividend.per_share, 1 / factor)
+        adjusted.eligible_shares = scale(dividend.eligible_shares, factor)
+        return adjusted
+
+    def __len__(self):
+        return sum(len(actions) for actions in self.actions.values())
+
+
+def read_corporate_actions(filename):
+    """
+    return: CorporateActionIndex with the actions in a csv file; see
+        the module docstring.
+    """
+    with open(filename, newline='') as actions_file:
+        return CorporateActionIndex(
+            CorporateAction(row['code'], date.fromisoformat(row['date']), row['kind'],
+                            row['new_shares'], row.get('old_shares') or '1')
+            for row in csv.DictReader(actions_file))
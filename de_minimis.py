@@ -0,0 +1,213 @@
+"""
+Monitor for the NZ$50,000 de minimis test for FIF income.
+
+A natural person does not have FIF income from shares if the total
+cost of the shares that they held did not exceed NZ$50,000 at any time
+during the income year. This module keeps the running NZD cost of all
+holdings of a taxpayer, trade by trade in date order, and reports the
+peak cost and the first moment (if any) when the threshold was
+exceeded, in one pass over the trades.
+
+The cost of an acquisition is its NZD value as calculated by
+FIF.process_trades (trade.NZD_value, converted at the exchange rate for
+the trade date, including trade costs). A disposal removes the average
+cost of the shares sold. The cost of opening holdings cannot be found
+in the input files of FIF.py, so it should be given per share code;
+for shares without it the opening value (the market value at the start
+of the year) is used, and the report lists those codes.
+
+Example, for several portfolios each in its own directory with
+opening_positions.csv, trades.csv and optionally opening_costs.csv
+(with code and cost columns):
+    python de_minimis.py clients/*
+"""
+
+import argparse
+from collections import namedtuple
+from contextlib import redirect_stdout
+import csv
+from datetime import datetime, time, timedelta
+from decimal import Decimal, ROUND_HALF_UP
+import io
+from operator import attrgetter
+import os.path
+
+import FIF
+
+
+DE_MINIMIS_THRESHOLD = Decimal('50000.00')
+cost_base_report = namedtuple('cost_base_report',
+                              'name, opening_cost, peak_cost, peak_moment, first_breach, '
+                              'closing_cost, estimated_codes')
+taxpayer_portfolio = namedtuple('taxpayer_portfolio', 'name, shares, trades, opening_costs')
+
+
+class CostBaseTracker:
+    """
+    Holds the number of shares held and their cost in NZD, for each
+    share of one taxpayer, and the total cost of all holdings.
+
+    Input arguments:
+    shares: list of shares with their opening_holding (and
+        opening_value, for shares without an opening cost).
+    opening_costs: dict with the NZD cost of the opening holding by
+        share code.
+    """
+
+    def __init__(self, shares, opening_costs=None):
+        opening_costs = opening_costs or {}
+        self.holdings = {}
+        self.costs = {}
+        self.estimated_codes = []
+        for share in shares:
+            self.holdings[share.code] = share.opening_holding
+            if share.code in opening_costs:
+                self.costs[share.code] = Decimal(opening_costs[share.code])
+            else:
+                self.costs[share.code] = share.opening_value
+                if share.opening_holding:
+                    self.estimated_codes.append(share.code)
+        self.total_cost = sum(self.costs.values(), Decimal('0.00'))
+        self.opening_cost = self.total_cost
+        return
+
+    def add_trade(self, trade, NZD_value):
+        """
+        Updates the holding and cost for a trade.
+
+        return: the total cost of all holdings after the trade.
+        """
+        holding = self.holdings.get(trade.code, Decimal('0'))
+        cost = self.costs.get(trade.code, Decimal('0.00'))
+        if trade.number_of_shares > Decimal('0'):
+            new_cost = cost + NZD_value
+        elif holding > Decimal('0'):
+            sold = min(-trade.number_of_shares, holding)
+            new_cost = cost - (cost * sold / holding).quantize(Decimal('0.01'), ROUND_HALF_UP)
+        else:
+            new_cost = cost
+        holding += trade.number_of_shares
+        if holding <= Decimal('0'):
+            new_cost = Decimal('0.00')
+        self.holdings[trade.code] = holding
+        self.costs[trade.code] = new_cost
+        self.total_cost += new_cost - cost
+        return self.total_cost
+
+
+def trade_NZD_value(trade, currency):
+    """
+    return: trade.NZD_value, or the same value calculated here if
+        process_trades has not set it.
+    """
+    if trade.NZD_value is not None:
+        return trade.NZD_value
+    fx_rate = FIF.FX_rate(currency, trade.date_time.date())
+    return sum((charge / fx_rate).quantize(Decimal('0.01'), ROUND_HALF_UP)
+               for _, charge in trade.fill_values())
+
+
+def check_de_minimis(name, shares, trades, opening_costs=None,
+                     threshold=DE_MINIMIS_THRESHOLD):
+    """
+    Tracks the cost of all holdings of one taxpayer over the year.
+
+    input arguments:
+    name: a name for the taxpayer or portfolio, for the report.
+    shares: list of shares (including shares acquired during the year,
+        as after process_trades, for their currency).
+    trades: list of trades; sorted by date and time, as after
+        process_trades, or they are sorted here.
+    opening_costs: dict with the NZD cost of opening holdings by code.
+    threshold: the de minimis threshold.
+
+    return: cost_base_report.
+    """
+    currencies = {share.code: share.currency for share in shares}
+    tracker = CostBaseTracker(shares, opening_costs)
+    start = datetime.combine(FIF.previous_closing_date() + timedelta(days=1), time.min)
+    # The opening holdings count from the start of the year.
+    peak_cost = tracker.total_cost
+    peak_moment = start
+    first_breach = start if tracker.total_cost > threshold else None
+    if any(later.date_time < earlier.date_time for earlier, later in zip(trades, trades[1:])):
+        trades = sorted(trades, key=attrgetter('date_time'))
+    for trade in trades:
+        total_cost = tracker.add_trade(trade, trade_NZD_value(trade, currencies[trade.code]))
+        if total_cost > peak_cost:
+            peak_cost = total_cost
+            peak_moment = trade.date_time
+        if first_breach is None and total_cost > threshold:
+            first_breach = trade.date_time
+    return cost_base_report(name, tracker.opening_cost, peak_cost, peak_moment, first_breach,
+                            tracker.total_cost, tracker.estimated_codes)
+
+
+def check_portfolios(portfolios, threshold=DE_MINIMIS_THRESHOLD):
+    """
+    return: list with a cost_base_report for each taxpayer_portfolio in
+        portfolios.
+    """
+    return [check_de_minimis(portfolio.name, portfolio.shares, portfolio.trades,
+                             portfolio.opening_costs, threshold)
+            for portfolio in portfolios]
+
+
+def print_de_minimis_reports(reports, threshold=DE_MINIMIS_THRESHOLD):
+    print('\nDe minimis test: cost of shares held must not exceed {:,.2f} NZD'.format(threshold))
+    print('{v1:{w1}}{v2:>{w2}}{v3:>{w2}}{v4:>{w3}}{v5:>{w2}}  {v6}'.format(
+        v1='portfolio', w1=24, v2='opening cost', v3='peak cost', v4='peak on', w2=16,
+        w3=12, v5='closing cost', v6='first exceeded'))
+    for report in reports:
+        print('{v1:{w1}.{w1}}{v2:>{w2},.2f}{v3:>{w2},.2f}{v4:>{w3}}{v5:>{w2},.2f}  {v6}'.format(
+            v1=report.name, w1=24, v2=report.opening_cost, v3=report.peak_cost, w2=16,
+            v4=report.peak_moment.strftime('%d %b %Y'), w3=12, v5=report.closing_cost,
+            v6=report.first_breach.strftime('%d %b %Y') if report.first_breach
+            else 'never (exempt)'))
+        if report.estimated_codes:
+            print('    opening value used as cost for ' + ', '.join(report.estimated_codes))
+    return
+
+
+def read_opening_costs(filename):
+    """return: dict with the cost by code from a csv file, or {} if it does not exist."""
+    if not os.path.isfile(filename):
+        return {}
+    with open(filename, newline='') as costs_file:
+        return {row['code']: Decimal(row['cost']) for row in csv.DictReader(costs_file)}
+
+
+def read_portfolio(directory):
+    """
+    Reads the opening positions and trades of a portfolio from a
+    directory, and processes them as FIF.py does (without printing).
+
+    return: taxpayer_portfolio.
+    """
+    shares = FIF.read_opening_positions(os.path.join(directory, 'opening_positions.csv'))
+    trades = FIF.read_trades(os.path.join(directory, 'trades.csv'))
+    with redirect_stdout(io.StringIO()):
+        FIF.process_opening_positions(shares)
+        FIF.process_trades(shares, trades)
+    return taxpayer_portfolio(os.path.basename(os.path.normpath(directory)), shares, trades,
+                              read_opening_costs(os.path.join(directory, 'opening_costs.csv')))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Check the FIF de minimis test for portfolios')
+    parser.add_argument('directories', nargs='+', metavar='DIRECTORY',
+                        help='directory with opening_positions.csv, trades.csv and optionally '
+                             'opening_costs.csv')
+    parser.add_argument('--tax-year', type=int, default=FIF.tax_year)
+    parser.add_argument('--fx-rates', default=FIF.fx_rates_file)
+    parser.add_argument('--securities', default=FIF.securities_master_file)
+    parser.add_argument('--threshold', type=Decimal, default=DE_MINIMIS_THRESHOLD)
+    args = parser.parse_args()
+
+    FIF.tax_year = args.tax_year
+    FIF.interactive = False
+    FIF.fx_rates = FIF.get_fx_rates(FIF.fx_rates, args.fx_rates)
+    FIF.securities = FIF.load_securities_master(args.securities)
+    print_de_minimis_reports(check_portfolios((read_portfolio(directory)
+                                               for directory in args.directories),
+                                              args.threshold), args.threshold)
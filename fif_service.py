@@ -0,0 +1,368 @@
+"""
+Local service for FIF income calculations, so that other tools do not
+have to start FIF.py as a new process for every portfolio.
+
+The service listens on a local TCP port (HTTP/1.1 with JSON) or on a
+Unix socket. It uses asyncio for the connections, and calculates in a
+pool of worker processes. Each worker loads the foreign exchange rates
+and the securities master once, when it starts, and keeps them (and
+everything else FIF.py caches) for all the portfolios it calculates.
+Calculations never ask for input: a missing foreign exchange rate or
+an unknown share gives an error response instead.
+
+Requests:
+    GET /health
+        returns {"status": "ok"}.
+    POST /fif
+        with a JSON portfolio, for example:
+        {"tax_year": 2018,
+         "opening_positions": [{"code": "VEU", "full_name": "Vanguard",
+                                "currency": "USD", "holding": "100",
+                                "closing_price": "50.00"}],
+         "trades": [{"code": "VEU", "date_time": "2017-05-03T09:30:00",
+                     "number_of_shares": "10", "share_price": "51.00",
+                     "trade_costs": "1.00"}],
+         "dividends": [{"code": "VEU", "date_paid": "2017-06-30",
+                        "per_share": "0.25", "gross_paid": "27.50"}],
+         "closing_prices": [{"code": "VEU", "price": "55.00"}]}
+        All numbers should be strings, so they convert exactly to
+        Decimals. Trades, dividends and closing prices are optional.
+        The response has the results as strings, the values per share
+        and the printed report. Optionally "aggregate_fills": true
+        merges partial fills first.
+
+Example:
+    python fif_service.py --port 8765 --workers 4
+    python fif_service.py --unix /tmp/fif.sock
+"""
+
+import argparse
+import asyncio
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import redirect_stdout
+from datetime import date, datetime
+from decimal import Decimal, InvalidOperation
+import io
+import json
+import os
+
+import FIF
+from securities_master import load_securities_master
+
+
+MAXIMUM_BODY_SIZE = 64 * 1024 * 1024
+REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed',
+           413: 'Payload Too Large', 422: 'Unprocessable Entity',
+           500: 'Internal Server Error'}
+
+
+class PayloadError(Exception):
+    """Used to raise error for an invalid portfolio payload."""
+    pass
+
+
+class RequestError(Exception):
+    """Used to raise error for an HTTP request that cannot be read."""
+    pass
+
+
+def start_worker(fx_rates_file, securities_master_file):
+    """
+    Prepares FIF.py in a worker process (or in the service process
+    itself): loads the resident data and switches off all prompts.
+    """
+    FIF.testing = True
+    FIF.interactive = False
+    FIF.run_stats = None
+    FIF.fx_rates = FIF.get_fx_rates(FIF.fx_rates, fx_rates_file)
+    FIF.securities = load_securities_master(securities_master_file)
+    return
+
+
+def portfolio_from_payload(payload):
+    """
+    Converts a JSON portfolio into the input for
+    FIF.calculate_FIF_income.
+
+    return: (tuple with) tax_year and the lists of shares, trades,
+        dividends and closing prices.
+    """
+    try:
+        tax_year = int(payload['tax_year'])
+        shares = [FIF.Share(row['code'], row.get('full_name', ''), row.get('currency', 'USD'),
+                            row.get('holding', '0'), row.get('closing_price', '0.00'))
+                  for row in payload.get('opening_positions', [])]
+        trades = [FIF.Trade(row['code'], datetime.fromisoformat(row['date_time']),
+                            row['number_of_shares'], row['share_price'],
+                            row.get('trade_costs', '0.00'))
+                  for row in payload.get('trades', [])]
+        dividends = [FIF.Dividend(row['code'], date.fromisoformat(row['date_paid']),
+                                  row['per_share'], row['gross_paid'], row.get('isin'))
+                     for row in payload.get('dividends', [])]
+        closing_prices = [FIF.closing_price_info(row['code'], str(Decimal(row['price'])))
+                          for row in payload.get('closing_prices', [])]
+    except KeyError as error:
+        raise PayloadError('missing field {}'.format(error)) from None
+    except (TypeError, ValueError, InvalidOperation, AttributeError) as error:
+        raise PayloadError('invalid value: {}'.format(error)) from None
+    return tax_year, shares, trades, dividends, closing_prices
+
+
+def share_values(share):
+    """return: dict with the values of a share, as strings."""
+    return {name: None if value is None else str(value)
+            for name, value in vars(share).items() if name != 'lots'}
+
+
+def calculate(payload):
+    """
+    Calculates the FIF income for a portfolio, in a worker process
+    that has been prepared by start_worker.
+
+    input arguments:
+    payload: dict with the portfolio, as described in the module
+        docstring.
+
+    return: (tuple with) the HTTP status and a dict for the response.
+    """
+    try:
+        tax_year, shares, trades, dividends, closing_prices = portfolio_from_payload(payload)
+    except PayloadError as error:
+        return 400, {'error': str(error)}
+
+    FIF.tax_year = tax_year
+    report = io.StringIO()
+    try:
+        with redirect_stdout(report):
+            result = FIF.calculate_FIF_income(shares, trades, dividends, closing_prices,
+                                              aggregate=bool(payload.get('aggregate_fills')))
+    except (FIF.MissingFXRateError, FIF.UnknownShareError) as error:
+        return 422, {'error': str(error)}
+
+    response = {name: str(value) for name, value in result._asdict().items()
+                if name != 'shares'}
+    response['tax_year'] = tax_year
+    response['shares'] = [share_values(share) for share in result.shares]
+    response['report'] = report.getvalue()
+    return 200, response
+
+
+class FIFService:
+    """
+    The asyncio part of the service: accepts connections, reads HTTP
+    requests and passes portfolios to the pool of workers.
+
+    Input arguments:
+    workers: number of worker processes. With 0, portfolios are
+        calculated in the service process itself, one at a time in a
+        separate thread; that is mainly useful for tests.
+    fx_rates_file: the saved foreign exchange rates.
+    securities_master_file: the saved securities master.
+    """
+
+    def __init__(self, workers=os.cpu_count(), fx_rates_file='saved_fx_rates.pickle',
+                 securities_master_file='securities_master.pickle'):
+        self.workers = workers
+        self.fx_rates_file = fx_rates_file
+        self.securities_master_file = securities_master_file
+        self.executor = None
+        self.server = None
+        self.connections = set()
+        # The tasks handling open connections, to end them on stop.
+        return
+
+    async def start(self, host='127.0.0.1', port=0, unix_path=None):
+        """
+        Starts the workers and the server.
+
+        return: the port number (useful with port 0), or None for a
+            Unix socket.
+        """
+        if self.workers > 0:
+            self.executor = ProcessPoolExecutor(
+                self.workers, initializer=start_worker,
+                initargs=(self.fx_rates_file, self.securities_master_file))
+        else:
+            start_worker(self.fx_rates_file, self.securities_master_file)
+            self.executor = ThreadPoolExecutor(max_workers=1)
+            # FIF.py keeps its state in module globals, so calculations
+            # in the same process must not overlap.
+        if unix_path is not None:
+            self.server = await asyncio.start_unix_server(self.handle_connection, unix_path)
+            return None
+        self.server = await asyncio.start_server(self.handle_connection, host, port)
+        return self.server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        for task in list(self.connections):
+            task.cancel()
+        await asyncio.gather(*self.connections, return_exceptions=True)
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+        if self.executor is not None:
+            self.executor.shutdown()
+        return
+
+    async def handle_connection(self, reader, writer):
+        """
+        Handles the requests on one connection, which is kept open
+        between requests unless the client asks to close it.
+        """
+        task = asyncio.current_task()
+        self.connections.add(task)
+        try:
+            while True:
+                try:
+                    request = await read_request(reader)
+                except RequestError as error:
+                    write_response(writer, 400, {'error': str(error)}, keep_alive=False)
+                    await writer.drain()
+                    break
+                    # Where the next request would start is not known.
+                if request is None:
+                    break
+                method, path, headers, body = request
+                status, response = await self.respond(method, path, body)
+                keep_alive = body is not None and \
+                    headers.get('connection', '').lower() != 'close'
+                # The body of a request that is too large is not read,
+                # so the connection cannot be used for another request.
+                write_response(writer, status, response, keep_alive)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        except asyncio.CancelledError:
+            pass
+            # Only cancelled by stop, for connections that were kept
+            # open; ending normally keeps asyncio from logging it.
+        finally:
+            self.connections.discard(task)
+            writer.close()
+        return
+
+    async def respond(self, method, path, body):
+        """return: (tuple with) the HTTP status and a dict for the response."""
+        if path == '/health':
+            return 200, {'status': 'ok'}
+        if path != '/fif':
+            return 404, {'error': 'unknown path ' + path}
+        if method != 'POST':
+            return 405, {'error': 'use POST for /fif'}
+        if body is None:
+            return 413, {'error': 'request is too large'}
+        try:
+            payload = json.loads(body)
+        except ValueError as error:
+            return 400, {'error': 'invalid JSON: {}'.format(error)}
+        if not isinstance(payload, dict):
+            return 400, {'error': 'the portfolio must be a JSON object'}
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self.executor, calculate,
+                                                                    payload)
+        except Exception as error:
+            return 500, {'error': '{}: {}'.format(type(error).__name__, error)}
+
+
+async def read_request(reader):
+    """
+    Reads one HTTP request.
+
+    return: (tuple with) method, path, dict with headers (with lower
+        case names) and the body as bytes (None if it is too large, in
+        which case it is left unread); or None if the connection was
+        closed. Raises RequestError for a malformed request line or
+        Content-Length.
+    """
+    request_line = await reader.readline()
+    if not request_line.strip():
+        return None
+    parts = request_line.decode('latin-1').split()
+    if len(parts) != 3 or not parts[2].startswith('HTTP/'):
+        raise RequestError('malformed request line {!r}'.format(request_line.decode(
+            'latin-1').strip()))
+    method, path = parts[:2]
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+    try:
+        length = int(headers.get('content-length', 0))
+    except ValueError:
+        length = -1
+    if length < 0:
+        raise RequestError('invalid Content-Length {!r}'.format(headers['content-length']))
+    if length > MAXIMUM_BODY_SIZE:
+        return method, path, headers, None
+    body = await reader.readexactly(length) if length else b''
+    return method, path, headers, body
+
+
+def write_response(writer, status, response, keep_alive=True):
+    body = json.dumps(response).encode('utf-8')
+    writer.write('HTTP/1.1 {} {}\r\nContent-Type: application/json\r\n'
+                 'Content-Length: {}\r\nConnection: {}\r\n\r\n'.format(
+                     status, REASONS.get(status, ''), len(body),
+                     'keep-alive' if keep_alive else 'close').encode('latin-1') + body)
+    return
+
+
+async def post(reader, writer, path, payload):
+    """
+    Minimal client for the service, e.g. for tests: sends one request on
+    an open connection and reads the response.
+
+    input arguments:
+    reader, writer: the streams of a connection, as from
+        asyncio.open_connection or asyncio.open_unix_connection.
+    path: the path of the request.
+    payload: dict to send as JSON, or None for a GET request.
+
+    return: (tuple with) the HTTP status and the decoded response.
+    """
+    body = b'' if payload is None else json.dumps(payload).encode('utf-8')
+    writer.write('{} {} HTTP/1.1\r\nHost: localhost\r\nContent-Type: application/json\r\n'
+                 'Content-Length: {}\r\n\r\n'.format('GET' if payload is None else 'POST',
+                                                    path, len(body)).encode('latin-1') + body)
+    await writer.drain()
+    status = int((await reader.readline()).split()[1])
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+    response = await reader.readexactly(int(headers['content-length']))
+    return status, json.loads(response)
+
+
+async def serve(args):
+    service = FIFService(args.workers, args.fx_rates, args.securities)
+    port = await service.start(args.host, args.port, args.unix)
+    print('FIF service listening on ' +
+          (args.unix if args.unix else '{}:{}'.format(args.host, port)))
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await service.stop()
+    return
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run a local FIF calculation service')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--unix', metavar='PATH', help='listen on a Unix socket instead')
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--fx-rates', default='saved_fx_rates.pickle')
+    parser.add_argument('--securities', default='securities_master.pickle')
+    try:
+        asyncio.run(serve(parser.parse_args()))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,258 @@
+"""
+Providers of foreign exchange rates for FIF.py, as an alternative to
+entering missing rates by hand.
+
+A provider gets rates for many (currency, date) keys at once. FIF.py
+first collects all rates it will need for a portfolio and asks the
+provider for the missing ones in one go (see FIF.prefetch_fx_rates);
+rates are then written through to the saved rates, so they are only
+fetched once.
+
+Available providers:
+- FileProvider: reads rates from a csv file with currency, date and
+  rate columns, or from a pickle file like saved_fx_rates.pickle. Use
+  it for tests and offline work.
+- HTTPProvider: gets rates from a rate service over HTTP/1.1 with JSON.
+  It sends up to batch_size keys per request, over a small pool of
+  connections that are kept open between requests, with a timeout per
+  request and retries with exponential backoff for connection errors,
+  timeouts and server errors (5xx).
+
+The rate service must accept
+    POST <path> {"rates": [{"currency": "USD", "date": "2017-05-15"}, ...]}
+and answer with
+    {"rates": [{"currency": "USD", "date": "2017-05-15", "rate": "0.7254"}, ...]}
+leaving out keys it has no rate for. Rates are strings, as in
+saved_fx_rates.pickle, to keep them exact.
+
+Use provider_from_spec to create a provider from a command line
+argument such as file:rates.csv or http://localhost:8080/rates.
+"""
+
+from abc import ABC, abstractmethod
+import asyncio
+import csv
+from datetime import date
+import json
+import pickle
+from urllib.parse import urlsplit
+
+
+class FXProviderError(Exception):
+    """Used to raise error when a provider cannot get rates."""
+    pass
+
+
+class FXProvider(ABC):
+    """
+    Base class for providers. Subclasses implement fetch, as a
+    coroutine; get_rates is the (blocking) function for FIF.py.
+    """
+
+    @abstractmethod
+    async def fetch(self, keys):
+        """
+        return: dict with the rate (as a string) by (currency, date)
+            key, for those of keys that the provider has a rate for.
+        """
+
+    def get_rates(self, keys):
+        """
+        Blocking version of fetch, for use outside of asyncio.
+
+        input arguments:
+        keys: iterable of (currency, date) tuples.
+
+        return: dict with the rate by (currency, date) key.
+        """
+        keys = list(dict.fromkeys(keys))
+        # Without duplicates, but in the same order.
+        if not keys:
+            return {}
+        return asyncio.run(self.fetch(keys))
+
+    def close(self):
+        return
+
+
+class FileProvider(FXProvider):
+    """
+    Provides rates from a file, which is read once.
+
+    Input arguments:
+    filename: a csv file with currency, date (in ISO format) and rate
+        columns, or a pickle file (ending in .pickle) with the same
+        nested dictionary as saved_fx_rates.pickle.
+    """
+
+    def __init__(self, filename):
+        self.rates = {}
+        if filename.endswith('.pickle'):
+            with open(filename, 'rb') as rates_file:
+                for currency, rates in pickle.load(rates_file).items():
+                    for rate_date, rate in (rates or {}).items():
+                        self.rates[(currency, rate_date)] = str(rate)
+        else:
+            with open(filename, newline='') as rates_file:
+                for row in csv.DictReader(rates_file):
+                    self.rates[(row['currency'], date.fromisoformat(row['date']))] = row['rate']
+        return
+
+    async def fetch(self, keys):
+        return {key: self.rates[key] for key in keys if key in self.rates}
+
+
+class HTTPProvider(FXProvider):
+    """
+    Provides rates from a rate service; see the module docstring.
+
+    Input arguments:
+    url: the URL for requests, e.g. http://localhost:8080/rates.
+    timeout: seconds to wait for each response.
+    retries: number of times a failed request is tried again.
+    backoff: seconds to wait before the first retry; doubled for each
+        next retry.
+    batch_size: maximum number of keys per request.
+    connections: maximum number of connections used at the same time.
+    """
+
+    def __init__(self, url, timeout=10.0, retries=3, backoff=0.5, batch_size=500,
+                 connections=4):
+        parts = urlsplit(url)
+        if parts.scheme != 'http':
+            raise ValueError('only http URLs are supported, not ' + url)
+        self.host = parts.hostname
+        self.port = parts.port or 80
+        self.path = parts.path or '/'
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.batch_size = batch_size
+        self.connections = connections
+        self.requests = 0
+        # Number of requests sent, including retries.
+        self.loop = None
+        self.idle = []
+        # Open connections, as (reader, writer) tuples, that can be
+        # used for the next request.
+        return
+
+    def get_rates(self, keys):
+        """
+        Like FXProvider.get_rates, but with an event loop that is kept
+        between calls, so connections can be reused as well.
+        """
+        keys = list(dict.fromkeys(keys))
+        if not keys:
+            return {}
+        if self.loop is None:
+            self.loop = asyncio.new_event_loop()
+        return self.loop.run_until_complete(self.fetch(keys))
+
+    async def fetch(self, keys):
+        batches = [keys[start:start + self.batch_size]
+                   for start in range(0, len(keys), self.batch_size)]
+        limit = asyncio.Semaphore(self.connections)
+
+        async def limited(batch):
+            async with limit:
+                return await self.fetch_batch(batch)
+
+        rates = {}
+        for batch_rates in await asyncio.gather(*(limited(batch) for batch in batches)):
+            rates.update(batch_rates)
+        return rates
+
+    async def fetch_batch(self, keys):
+        """
+        return: dict with rates for one batch of keys, after retries if
+            needed.
+        """
+        body = json.dumps({'rates': [{'currency': currency, 'date': rate_date.isoformat()}
+                                     for currency, rate_date in keys]}).encode('utf-8')
+        for attempt in range(self.retries + 1):
+            connection = None
+            try:
+                connection = self.idle.pop() if self.idle else \
+                    await asyncio.wait_for(asyncio.open_connection(self.host, self.port),
+                                           self.timeout)
+                self.requests += 1
+                status, response, keep_alive = await asyncio.wait_for(
+                    self.request(connection, body), self.timeout)
+                if keep_alive:
+                    self.idle.append(connection)
+                else:
+                    connection[1].close()
+                connection = None
+                if status >= 500:
+                    raise ConnectionError('rate service answered with status {}'.format(status))
+                if status != 200:
+                    raise FXProviderError('rate service answered with status {}'.format(status))
+                return {(row['currency'], date.fromisoformat(row['date'])): str(row['rate'])
+                        for row in json.loads(response)['rates']}
+            except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError,
+                    ValueError) as error:
+                if connection is not None:
+                    connection[1].close()
+                    # A connection in an unknown state is never reused.
+                if attempt == self.retries:
+                    raise FXProviderError('could not get rates from {}:{}: {}'.format(
+                        self.host, self.port, error)) from None
+                await asyncio.sleep(self.backoff * 2 ** attempt)
+        return {}
+
+    async def request(self, connection, body):
+        """
+        Sends one request on an open connection.
+
+        return: (tuple with) the status, the response body and whether
+            the connection can be kept open.
+        """
+        reader, writer = connection
+        writer.write('POST {} HTTP/1.1\r\nHost: {}\r\nContent-Type: application/json\r\n'
+                     'Content-Length: {}\r\n\r\n'.format(self.path, self.host,
+                                                         len(body)).encode('latin-1') + body)
+        await writer.drain()
+        status_line = await reader.readline()
+        if not status_line:
+            raise ConnectionError('connection closed by the rate service')
+        status = int(status_line.split()[1])
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+        response = await reader.readexactly(int(headers.get('content-length', 0)))
+        return status, response, headers.get('connection', '').lower() != 'close'
+
+    def close(self):
+        if self.loop is not None:
+            self.loop.run_until_complete(self.close_connections())
+            self.loop.close()
+            self.loop = None
+        return
+
+    async def close_connections(self):
+        for _, writer in self.idle:
+            writer.close()
+        for _, writer in self.idle:
+            try:
+                await writer.wait_closed()
+            except OSError:
+                pass
+        self.idle = []
+        return
+
+
+def provider_from_spec(spec):
+    """
+    return: a provider for spec, which is either an http URL or
+        file:FILENAME.
+    """
+    if spec.startswith('http://'):
+        return HTTPProvider(spec)
+    if spec.startswith('file:'):
+        return FileProvider(spec[len('file:'):])
+    raise ValueError('unknown rate provider {}; use file:FILENAME or an http URL'.format(spec))
@@ -0,0 +1,403 @@
+"""
+Data structures for the holdings of shares over time, for use by
+FIF.py.
+
+A HoldingsTimeline is built once for each share, from its opening
+holding and its trades. After that it answers questions such as "how
+many shares were held at this moment" or "what was the peak holding in
+this period" with a binary search (bisect), instead of replaying all
+trades again.
+
+ShareLots holds the shares acquired during the tax period as separate
+lots, which disposals use up in the order they were acquired. It is
+kept up to date trade by trade, while FIF.process_trades runs, so the
+quick sale portions and the average cost of acquisitions are known
+without walking the trades again.
+
+The module only depends on the attributes of trades (code, date_time,
+number_of_shares, share_price and optionally fills), not on FIF.py
+itself.
+"""
+
+from bisect import bisect_left, bisect_right
+from collections import deque, namedtuple
+from datetime import date, datetime, time
+from decimal import Decimal
+from operator import attrgetter
+
+
+dividend_discrepancy = namedtuple('dividend_discrepancy', 'dividend, shares_held, difference')
+
+
+def as_moment(moment, end_of_day=True):
+    """
+    return: moment as a datetime. A date without time is taken as the
+        end of that day, or as its start if end_of_day is False, so it
+        can be compared with the date and time of trades.
+    """
+    if isinstance(moment, datetime):
+        return moment
+    if isinstance(moment, date):
+        return datetime.combine(moment, time.max if end_of_day else time.min)
+    raise TypeError('moment must be a date or datetime, not {}'.format(type(moment)))
+
+
+def fill_sizes(trade):
+    """
+    return: list with the number_of_shares of each fill of trade.
+    """
+    fills = getattr(trade, 'fills', None)
+    if not fills:
+        return [trade.number_of_shares]
+    return [fill[0] for fill in fills]
+
+
+class RangeExtremes:
+    """
+    Sparse table for minimum and maximum queries over ranges of a fixed
+    list of values. Building takes O(n log n) time; each query takes
+    O(1) time.
+    """
+
+    def __init__(self, values):
+        self.maximums = [list(values)]
+        self.minimums = [list(values)]
+        width = 1
+        while 2 * width <= len(values):
+            previous_max = self.maximums[-1]
+            previous_min = self.minimums[-1]
+            self.maximums.append([max(previous_max[i], previous_max[i + width])
+                                  for i in range(len(previous_max) - width)])
+            self.minimums.append([min(previous_min[i], previous_min[i + width])
+                                  for i in range(len(previous_min) - width)])
+            width *= 2
+        return
+
+    def maximum(self, first, last):
+        """return: the maximum of values[first:last]; last > first."""
+        level = (last - first).bit_length() - 1
+        return max(self.maximums[level][first], self.maximums[level][last - (1 << level)])
+
+    def minimum(self, first, last):
+        """return: the minimum of values[first:last]; last > first."""
+        level = (last - first).bit_length() - 1
+        return min(self.minimums[level][first], self.minimums[level][last - (1 << level)])
+
+
+class HoldingsTimeline:
+    """
+    Holds the number of shares held of one share at any moment of the
+    tax period.
+
+    Input arguments:
+    opening_holding: number of shares held at the start of the tax
+        period.
+    trades: the trades for this share (only). They do not need to be
+        sorted; trades at the same moment are kept in the order given.
+        A trade that was merged from several fills (see
+        FIF.aggregate_fills) counts as its separate fills, so the
+        holdings are the same with or without aggregation.
+
+    Other attributes that are available:
+    moments: sorted list with the date and time of each trade.
+    holdings: list with the holding after each trade, i.e. prefix sums
+        of number_of_shares on top of opening_holding.
+    closing_holding: the holding after all trades.
+    """
+
+    def __init__(self, opening_holding, trades):
+        self.opening_holding = Decimal(opening_holding)
+        sorted_trades = sorted(trades, key=lambda trade: as_moment(trade.date_time, False))
+        self.moments = []
+        self.holdings = []
+        holding = self.opening_holding
+        for trade in sorted_trades:
+            moment = as_moment(trade.date_time, False)
+            for number_of_shares in fill_sizes(trade):
+                holding += number_of_shares
+                self.moments.append(moment)
+                self.holdings.append(holding)
+        self.closing_holding = holding
+        self.extremes = RangeExtremes(self.holdings)
+        return
+
+    def holding_at(self, moment):
+        """
+        return: the holding after all trades up to and including
+            moment. If moment is a date, that is the holding at the end
+            of that day.
+        """
+        position = bisect_right(self.moments, as_moment(moment))
+        if position == 0:
+            return self.opening_holding
+        return self.holdings[position - 1]
+
+    def holding_before(self, moment):
+        """
+        return: the holding just before moment, i.e. before any trades
+            at that moment. If moment is a date, that is the holding at
+            the start of that day.
+        """
+        position = bisect_left(self.moments, as_moment(moment, False))
+        if position == 0:
+            return self.opening_holding
+        return self.holdings[position - 1]
+
+    def trade_range(self, start, end):
+        """
+        return: (tuple with) the first and one past the last position of
+            trades from start up to and including end. None for start
+            or end means the start or end of the tax period.
+        """
+        first = 0 if start is None else bisect_left(self.moments, as_moment(start, False))
+        last = len(self.moments) if end is None else bisect_right(self.moments,
+                                                                  as_moment(end))
+        return first, max(first, last)
+
+    def peak_in_interval(self, start=None, end=None, include_start=True):
+        """
+        return: the highest holding from start up to and including end.
+            This is the highest of the holding just before start and the
+            holding after each trade in the interval, so it includes
+            any intermediate holding between trades at the same moment.
+            None for start or end means the start or end of the tax
+            period. If include_start is False, only holdings after
+            trades count, and None is returned if there are no trades
+            in the interval.
+        """
+        first, last = self.trade_range(start, end)
+        candidates = []
+        if include_start:
+            candidates.append(self.opening_holding if first == 0 else self.holdings[first - 1])
+        if last > first:
+            candidates.append(self.extremes.maximum(first, last))
+        return max(candidates) if candidates else None
+
+    def min_in_interval(self, start=None, end=None, include_start=True):
+        """
+        return: the lowest holding from start up to and including end;
+            see peak_in_interval.
+        """
+        first, last = self.trade_range(start, end)
+        candidates = []
+        if include_start:
+            candidates.append(self.opening_holding if first == 0 else self.holdings[first - 1])
+        if last > first:
+            candidates.append(self.extremes.minimum(first, last))
+        return min(candidates) if candidates else None
+
+    def __repr__(self):
+        return 'holdings timeline from {} to {} shares with {} trades'.format(
+            self.opening_holding, self.closing_holding, len(self.moments))
+
+
+def build_holdings_timelines(shares, trades, actions=None, start=None, end=None):
+    """
+    Builds a HoldingsTimeline for every share, in one pass over trades.
+
+    input arguments:
+    shares: list of shares, with their opening_holding.
+    trades: list of all trades. Trades for codes that are not in shares
+        are ignored.
+    actions: optional CorporateActionIndex (see corporate_actions.py).
+        If given, holdings are in shares as at end, for opening
+        holdings at start.
+
+    return: dict with a HoldingsTimeline for each share code.
+    """
+    trades_by_code = {share.code: [] for share in shares}
+    for trade in trades:
+        if trade.code in trades_by_code:
+            trades_by_code[trade.code].append(
+                trade if actions is None else actions.adjusted_trade(trade, end))
+    return {share.code: HoldingsTimeline(
+                share.opening_holding if actions is None else
+                actions.adjusted_holding(share.code, share.opening_holding, start, end),
+                trades_by_code[share.code])
+            for share in shares}
+
+
+def reconcile_dividends(dividends, timelines, tolerance=Decimal('0.5'), actions=None,
+                        end=None):
+    """
+    Checks the eligible shares of every dividend against the shares
+    actually held at the start of its payment date.
+
+    Dividends are grouped by share and sorted by date, and each group
+    is then matched against the (already sorted) trades of that share's
+    timeline in a single merge sweep, so no trades are replayed and no
+    binary search is needed per dividend.
+
+    input arguments:
+    dividends: list of dividends, in any order.
+    timelines: dict with a HoldingsTimeline by share code.
+    tolerance: largest acceptable difference between eligible shares
+        and shares held. The default allows for eligible_shares being
+        rounded to whole shares.
+    actions, end: optional CorporateActionIndex and the moment for the
+        shares of timelines, as for build_holdings_timelines. Eligible
+        shares are then converted to shares as at end, and so are
+        shares_held and difference in the result.
+
+    return: list of dividend_discrepancy namedtuples, sorted by code and
+        payment date, for each dividend where the difference exceeds
+        tolerance. For a dividend on a share without a timeline,
+        shares_held and difference are None.
+
+    Note that a difference is not necessarily an error: eligibility is
+    based on the holding at the ex-dividend date, and trades between
+    that date and the payment date can explain a difference.
+    """
+    dividends_by_code = {}
+    for dividend in dividends:
+        dividends_by_code.setdefault(dividend.code, []).append(
+            dividend if actions is None else actions.adjusted_dividend(dividend, end))
+
+    discrepancies = []
+    for code in sorted(dividends_by_code):
+        share_dividends = sorted(dividends_by_code[code], key=attrgetter('date_paid'))
+        timeline = timelines.get(code)
+        if timeline is None:
+            discrepancies.extend(dividend_discrepancy(dividend, None, None)
+                                 for dividend in share_dividends)
+            continue
+
+        position = 0
+        holding = timeline.opening_holding
+        for dividend in share_dividends:
+            start_of_day = as_moment(dividend.date_paid, False)
+            while position < len(timeline.moments) and \
+                    timeline.moments[position] < start_of_day:
+                holding = timeline.holdings[position]
+                position += 1
+            difference = dividend.eligible_shares - holding
+            if abs(difference) > tolerance:
+                discrepancies.append(dividend_discrepancy(dividend, holding, difference))
+    return discrepancies
+
+
+class Lot:
+    """
+    Shares acquired in one trade during the tax period.
+
+    Input arguments:
+    trade: the acquisition.
+    NZD_cost: the cost of the acquisition in NZD.
+
+    Other attributes that are available:
+    remaining: the number of shares of the lot that have not been
+        disposed of yet.
+    """
+
+    def __init__(self, trade, NZD_cost):
+        self.trade = trade
+        self.NZD_cost = NZD_cost
+        self.remaining = trade.number_of_shares
+        return
+
+    def remaining_cost(self):
+        """return: the part of NZD_cost for the remaining shares."""
+        return self.NZD_cost * self.remaining / self.trade.number_of_shares
+
+    def __repr__(self):
+        return 'lot of {} of {:,f} shares acquired on {}'.format(
+            self.remaining, self.trade.number_of_shares, self.trade.date_time)
+
+
+class ShareLots:
+    """
+    Holds the holding of one share as the opening holding plus lots for
+    the acquisitions during the tax period.
+
+    A disposal uses up lots first, in the order they were acquired
+    (first in, first out), and only then the opening holding. The
+    shares taken from lots are the quick sale portion of the disposal:
+    this is the same as the quick sale portion in FIF.calc_QSA, i.e.
+    the shares disposed of, up to the shares acquired during the period
+    that were not part of an earlier quick sale. A lot that is used up
+    is removed, and a lot that is partly used up is split by reducing
+    its remaining shares, so each trade takes O(1) amortised time.
+
+    Quasi-trades with a share price of zero, e.g. for share splits, do
+    not create or use lots.
+
+    Input arguments:
+    opening_holding: number of shares held at the start of the tax
+        period.
+
+    Other attributes that are available:
+    lots: deque with the Lots that have remaining shares, oldest first.
+    opening_remaining: the part of the opening holding that has not
+        been disposed of yet.
+    real_holding: the holding after all trades except quasi-trades.
+    acquired_shares, acquisitions_total: the number of shares acquired
+        during the period, and their total cost in NZD.
+    quick_sale_shares: the total of the quick sale portions.
+    trade_count: the number of trades added, including quasi-trades.
+    """
+
+    def __init__(self, opening_holding):
+        self.lots = deque()
+        self.opening_remaining = Decimal(opening_holding)
+        self.real_holding = Decimal(opening_holding)
+        self.acquired_shares = Decimal('0')
+        self.acquisitions_total = Decimal('0.00')
+        self.quick_sale_shares = Decimal('0')
+        self.trade_count = 0
+        return
+
+    def add_trade(self, trade, NZD_value):
+        """
+        Adds an acquisition as a new lot, or uses up lots for a
+        disposal.
+
+        input arguments:
+        trade: the next trade for this share, in date and time order.
+        NZD_value: the charge of the trade in NZD.
+
+        return: the quick sale portion for a disposal; None for an
+            acquisition or a quasi-trade.
+        """
+        self.trade_count += 1
+        if trade.share_price == Decimal('0'):
+            return None
+        self.real_holding += trade.number_of_shares
+        if trade.number_of_shares > Decimal('0'):
+            self.lots.append(Lot(trade, NZD_value))
+            self.acquired_shares += trade.number_of_shares
+            self.acquisitions_total += NZD_value
+            return None
+
+        needed = -trade.number_of_shares
+        portion = Decimal('0')
+        while needed > Decimal('0') and self.lots:
+            lot = self.lots[0]
+            taken = min(needed, lot.remaining)
+            lot.remaining -= taken
+            if lot.remaining == Decimal('0'):
+                self.lots.popleft()
+            needed -= taken
+            portion += taken
+        self.opening_remaining -= needed
+        self.quick_sale_shares += portion
+        return portion
+
+    def average_cost(self):
+        """
+        return: the average NZD cost per share acquired during the
+            period, or None if none were acquired.
+        """
+        if self.acquired_shares == Decimal('0'):
+            return None
+        return self.acquisitions_total / self.acquired_shares
+
+    def remaining_cost(self):
+        """
+        return: the NZD cost of the shares acquired during the period
+            that are still held.
+        """
+        return sum((lot.remaining_cost() for lot in self.lots), Decimal('0.00'))
+
+    def __repr__(self):
+        return 'opening holding of {} shares plus {} lots'.format(self.opening_remaining,
+                                                                  len(self.lots))
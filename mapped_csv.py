@@ -0,0 +1,142 @@
+"""
+Memory-mapped reader for very large csv input files of FIF.py.
+
+csv.DictReader decodes every line of a file and builds a dict for it,
+even when the row is skipped right away, e.g. for sub-total rows or
+for trades and dividends in other tax years. On multi-year exports
+those are most of the rows.
+
+This reader maps the file into memory and first checks each record on
+the raw bytes:
+- if the file has a Header column, as the trades export of Interactive
+  Brokers has, the record must start with the marker for a Data row,
+  e.g. b'Trades,Data,';
+- the record must contain a date, at the start of a field, in one of
+  the year-months of the requested period, e.g. b'2017-04'.
+Only records that pass both checks are decoded and split into a dict.
+The checks are deliberately loose (a date in another field also
+passes), so the caller must still check every row it gets; they only
+make sure that no row is dropped that the caller would have used.
+
+The date check assumes dates in ISO format (year first, with dashes).
+If the first data row has its date in another format the date check is
+switched off for the whole file.
+"""
+
+import csv
+from datetime import timedelta
+import mmap
+import re
+
+
+RECORD = re.compile(rb'[^"\n]*(?:"[^"]*"[^"\n]*)*\n')
+# One csv record up to and including its newline. Quoted fields may
+# contain newlines and (doubled) quotes. The pattern is unrolled so it
+# runs in linear time, even on a malformed last record.
+ISO_DATE = re.compile(r'\s*\d{4}-\d{2}')
+
+
+def year_months(first_day, after_last_day):
+    """
+    return: list with the 'YYYY-MM' text of every month with at least
+        one day from first_day up to (but not including)
+        after_last_day.
+    """
+    months = []
+    year, month = first_day.year, first_day.month
+    last_day = after_last_day - timedelta(days=1)
+    while (year, month) <= (last_day.year, last_day.month):
+        months.append('{:04d}-{:02d}'.format(year, month))
+        year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+    return months
+
+
+def read_csv_rows(filename, date_column, first_day, after_last_day):
+    """
+    Reads the rows of a csv file that may have a date in date_column
+    from first_day up to (but not including) after_last_day.
+
+    input arguments:
+    filename: the name of the csv file, with field names in its first
+        line.
+    date_column: the name of the column with the date (or date and
+        time) of each row.
+    first_day: the first day of rows to include.
+    after_last_day: the day after the last day of rows to include.
+
+    return: generator of dicts, as from csv.DictReader, for the rows
+        that pass the checks described in the module docstring.
+    """
+    with open(filename, 'rb') as csv_file:
+        try:
+            mapped = mmap.mmap(csv_file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            return
+            # An empty file cannot be mapped, and has no rows anyway.
+        try:
+            yield from mapped_rows(mapped, date_column, first_day, after_last_day)
+        finally:
+            mapped.close()
+    return
+
+
+def mapped_rows(mapped, date_column, first_day, after_last_day):
+    """
+    Does the work for read_csv_rows, on a memory-mapped file (or on
+    bytes).
+    """
+    size = len(mapped)
+    pos = 0
+    if mapped[:3] == b'\xef\xbb\xbf':
+        pos = 3
+        # Skip the byte order mark that some programs write.
+    match = RECORD.match(mapped, pos)
+    end = match.end() if match else size
+    field_names = next(csv.reader([mapped[pos:end].decode('utf-8')]), [])
+    pos = end
+
+    marker = None
+    if len(field_names) > 1 and field_names[1] == 'Header':
+        marker = (field_names[0] + ',Data,').encode('utf-8')
+    dates = re.compile(b'(?:^|[,"])(?:' +
+                       b'|'.join(month.encode('ascii')
+                                 for month in year_months(first_day, after_last_day)) +
+                       b')', re.MULTILINE)
+    check_dates = None
+    # Unknown until the first data row with a date has been seen.
+
+    while pos < size:
+        match = RECORD.match(mapped, pos)
+        end = match.end() if match else size
+        # The last record may not end with a newline.
+        start, pos = pos, end
+        if marker is not None and mapped.find(marker, start, start + len(marker)) != start:
+            continue
+        if check_dates and not dates.search(mapped, start, end):
+            continue
+
+        fields = next(csv.reader([mapped[start:end].decode('utf-8')]), [])
+        if not fields:
+            continue
+            # An empty line
+        row = dict_row(field_names, fields)
+        if check_dates is None and row.get(date_column):
+            check_dates = ISO_DATE.match(row[date_column]) is not None
+            if check_dates and not dates.search(mapped, start, end):
+                continue
+        yield row
+    return
+
+
+def dict_row(field_names, fields):
+    """
+    return: dict for a row, with the same keys and values that
+        csv.DictReader would give.
+    """
+    row = dict(zip(field_names, fields))
+    if len(fields) > len(field_names):
+        row[None] = fields[len(field_names):]
+    elif len(fields) < len(field_names):
+        for name in field_names[len(fields):]:
+            row[name] = None
+    return row
@@ -0,0 +1,198 @@
+"""
+Pre-flight validation of all inputs for FIF.py, before any processing
+starts.
+
+Without it, problems with the data are found one at a time, late in a
+run or not at all: a held share without a closing price ends up with a
+closing value of zero, and a missing rate or a trade outside the tax
+year stops the run halfway. validate_inputs goes over the shares,
+trades, dividends, closing prices and exchange rates once, with dicts
+and sets for every lookup, and returns the complete list of problems.
+
+Each problem is an error (the results would be wrong) or a warning
+(the results may be wrong, or something looks odd). The checks are:
+- opening positions: duplicate share codes, negative holdings, shares
+  in a currency without any exchange rates;
+- trades: unknown shares, dates outside the tax year, trades for zero
+  shares or at a price of zero, holdings that become negative;
+- dividends: unknown shares, dates outside the tax year, shares that
+  were not held at all during the year;
+- closing prices: held shares without a price, prices that are not
+  numbers or are zero or less, different prices for the same share;
+- exchange rates: every rate that processing will need.
+In an interactive run FIF.py asks the user for the currency of a new
+share and for a missing exchange rate, so those are only warnings
+there (see the asked argument of validate_inputs).
+
+The module does not depend on FIF.py; FIF.check_inputs calls it with
+the settings of a run.
+"""
+
+from collections import namedtuple
+from datetime import timedelta
+from decimal import Decimal, InvalidOperation
+from operator import attrgetter
+
+
+input_problem = namedtuple('input_problem', 'severity, source, code, description')
+ERROR = 'error'
+WARNING = 'warning'
+
+
+def validate_inputs(shares, trades, dividends, closing_prices, fx_rates, first_day, last_day,
+                    rate_date, new_currencies=None, actions=None, asked=False):
+    """
+    Checks all inputs for a tax year at once; see the module docstring.
+
+    input arguments:
+    shares: list of shares with their opening positions.
+    trades: list of trades, in any order.
+    dividends: list of dividends.
+    closing_prices: list of closing_price_info named tuples.
+    fx_rates: dict with a dict of rates by date for each currency, as
+        FIF.fx_rates.
+    first_day, last_day: the first and last date of the tax year.
+    rate_date: function that returns the date of the rate in fx_rates
+        that is used for a date (FIF.fx_rate_date).
+    new_currencies: dict with the currency of shares that are not in
+        shares, e.g. from the securities master.
+    actions: optional CorporateActionIndex; holdings are then counted
+        in shares as at last_day, as FIF.process_trades does.
+    asked: if True, unknown shares in trades and missing exchange rates
+        are warnings instead of errors, because the user will be asked
+        for them.
+
+    return: list of input_problem named tuples, errors first.
+    """
+    problems = []
+    missing = WARNING if asked else ERROR
+    # The severity of information that the user can still provide.
+    currencies = dict(new_currencies or {})
+    holdings = {}
+    for share in shares:
+        if share.code in holdings:
+            problems.append(input_problem(ERROR, 'opening positions', share.code,
+                                          'the share is listed more than once'))
+            continue
+        holdings[share.code] = share.opening_holding if actions is None else \
+            actions.adjusted_holding(share.code, share.opening_holding,
+                                     first_day - timedelta(days=1), last_day)
+        currencies[share.code] = share.currency
+        if share.opening_holding < Decimal('0'):
+            problems.append(input_problem(ERROR, 'opening positions', share.code,
+                                          'negative opening holding of {}'.format(
+                                              share.opening_holding)))
+
+    for currency in sorted(set(currencies.values())):
+        if not fx_rates.get(currency):
+            problems.append(input_problem(missing, 'exchange rates', None,
+                                          'no rates at all for currency {}'.format(currency)))
+    needed_rates = {}
+    # The first use of each rate, by (currency, rate date).
+    for currency in set(currencies.values()):
+        needed_rates.setdefault((currency, rate_date(first_day - timedelta(days=1))),
+                                'opening values')
+        needed_rates.setdefault((currency, rate_date(last_day)), 'closing values')
+
+    negative_codes = set()
+    for trade in sorted(trades, key=attrgetter('date_time')):
+        trade_day = trade.date_time.date()
+        if trade.code not in currencies:
+            problems.append(input_problem(missing, 'trades', trade.code,
+                                          'unknown share (no currency) for trade on {}'.format(
+                                              trade_day)))
+            currencies[trade.code] = None
+        if not first_day <= trade_day <= last_day:
+            problems.append(input_problem(ERROR, 'trades', trade.code,
+                                          'trade on {} is outside the tax year'.format(
+                                              trade_day)))
+        if trade.number_of_shares == Decimal('0'):
+            problems.append(input_problem(WARNING, 'trades', trade.code,
+                                          'trade on {} is for zero shares'.format(trade_day)))
+        elif trade.share_price == Decimal('0'):
+            problems.append(input_problem(WARNING, 'trades', trade.code,
+                                          'trade on {} has a price of zero; enter splits as '
+                                          'corporate actions'.format(trade_day)))
+        number_of_shares = trade.number_of_shares if actions is None else \
+            actions.adjusted_trade(trade, last_day).number_of_shares
+        holding = holdings.get(trade.code, Decimal('0')) + number_of_shares
+        holdings[trade.code] = holding
+        if holding < Decimal('0') and trade.code not in negative_codes:
+            negative_codes.add(trade.code)
+            problems.append(input_problem(ERROR, 'trades', trade.code,
+                                          'holding becomes {} after the trade at {}'.format(
+                                              holding, trade.date_time)))
+        if currencies[trade.code] is not None:
+            needed_rates.setdefault((currencies[trade.code], rate_date(trade_day)),
+                                    'trade on {}'.format(trade_day))
+
+    held_codes = {share.code for share in shares if share.opening_holding} | \
+        {trade.code for trade in trades if trade.number_of_shares > Decimal('0')}
+    for dividend in dividends:
+        if dividend.code not in currencies:
+            problems.append(input_problem(ERROR, 'dividends', dividend.code,
+                                          'unknown share (no currency) for dividend on '
+                                          '{}'.format(dividend.date_paid)))
+            continue
+        if not first_day <= dividend.date_paid <= last_day:
+            problems.append(input_problem(ERROR, 'dividends', dividend.code,
+                                          'dividend on {} is outside the tax year'.format(
+                                              dividend.date_paid)))
+        if dividend.code not in held_codes:
+            problems.append(input_problem(WARNING, 'dividends', dividend.code,
+                                          'dividend on {} for a share that was not held'.format(
+                                              dividend.date_paid)))
+        if currencies[dividend.code] is not None:
+            needed_rates.setdefault((currencies[dividend.code], rate_date(dividend.date_paid)),
+                                    'dividend on {}'.format(dividend.date_paid))
+
+    prices = {}
+    for price_info in closing_prices:
+        try:
+            price = Decimal(price_info.price)
+        except InvalidOperation:
+            problems.append(input_problem(ERROR, 'closing prices', price_info.code,
+                                          'invalid closing price {!r}'.format(price_info.price)))
+            continue
+        if price_info.code in prices and prices[price_info.code] != price:
+            problems.append(input_problem(ERROR, 'closing prices', price_info.code,
+                                          'different closing prices {} and {}'.format(
+                                              prices[price_info.code], price)))
+        prices.setdefault(price_info.code, price)
+    for code, holding in holdings.items():
+        if holding == Decimal('0'):
+            continue
+        if code not in prices:
+            problems.append(input_problem(ERROR, 'closing prices', code,
+                                          'no closing price for a closing holding of {}'.format(
+                                              holding)))
+        elif prices[code] <= Decimal('0'):
+            problems.append(input_problem(ERROR, 'closing prices', code,
+                                          'closing price of {}'.format(prices[code])))
+
+    for (currency, day), use in needed_rates.items():
+        if currency in fx_rates and day not in (fx_rates[currency] or {}):
+            problems.append(input_problem(missing, 'exchange rates', None,
+                                          'no {} rate for {} ({})'.format(currency, day, use)))
+
+    problems.sort(key=lambda problem: problem.severity != ERROR)
+    # A stable sort, so problems keep their order within each severity.
+    return problems
+
+
+def print_problems(problems):
+    """
+    Prints the problems found by validate_inputs, if any.
+
+    return: None
+    """
+    if not problems:
+        return
+    errors = sum(problem.severity == ERROR for problem in problems)
+    print('\nPre-flight check: {} errors and {} warnings in the input'.format(
+        errors, len(problems) - errors))
+    for problem in problems:
+        print('{v1:{w1}}{v2:{w2}}{v3:{w3}}{v4}'.format(
+            v1=problem.severity, w1=9, v2=problem.source, w2=18, v3=problem.code or '', w3=16,
+            v4=problem.description))
+    return
@@ -0,0 +1,247 @@
+"""
+A local store with the history of share prices, for FIF.py and the
+tools around it (projections, valuations of lots, audits), so prices
+are not only known for 31 March of the current tax year.
+
+The store is a directory with a file for each share code. A file holds
+the prices of that code in date order, as records of three 64-bit
+integers: the date ordinal and the coefficient and exponent of the
+price (see shared_tables.decimal_parts), so prices keep their exact
+Decimal value. Files are only ever appended to, with dates after the
+last one; a price is never changed, except that the price on the last
+date can be corrected (see PriceHistory.append). Files are
+memory-mapped for reading, and a price is found with a binary search
+over the dates, without reading the rest of the file.
+
+Prices are imported in bulk from csv files with code, date (in ISO
+format) and price columns:
+    python price_history.py price_history prices_2018.csv
+Rows for dates that are already in the store are skipped if they have
+the same price, so the same file can be imported again.
+"""
+
+import argparse
+from bisect import bisect_right
+import csv
+from datetime import date
+from decimal import Decimal
+import mmap
+import os
+import struct
+from urllib.parse import quote, unquote
+
+from shared_tables import decimal_parts, from_parts
+
+
+RECORD = struct.Struct('=qqq')
+SUFFIX = '.prices'
+
+
+class PriceHistoryError(Exception):
+    """Used to raise error when a price conflicts with the store."""
+    pass
+
+
+class PriceSeries:
+    """
+    Holds the memory-mapped prices of one share code.
+
+    Input arguments:
+    filename: the file with the records of the code.
+
+    Other attributes that are available:
+    dates, coefficients, exponents: views on the columns of the
+        records, without copying them.
+    """
+
+    def __init__(self, filename):
+        with open(filename, 'rb') as prices_file:
+            self.map = mmap.mmap(prices_file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.view = memoryview(self.map)[:len(self.map) // RECORD.size * RECORD.size].cast('q')
+        self.dates = self.view[0::3]
+        self.coefficients = self.view[1::3]
+        self.exponents = self.view[2::3]
+        return
+
+    def price_on(self, day, exact=True):
+        """
+        return: the price on day as a Decimal; if exact is False, the
+            last price on or before day. None if there is no price.
+        """
+        position = bisect_right(self.dates, day.toordinal()) - 1
+        if position < 0 or (exact and self.dates[position] != day.toordinal()):
+            return None
+        return from_parts(self.coefficients[position], self.exponents[position])
+
+    def last_date(self):
+        """return: the date of the last price, or None."""
+        if len(self.dates) == 0:
+            return None
+        return date.fromordinal(self.dates[-1])
+
+    def __len__(self):
+        return len(self.dates)
+
+    def close(self):
+        self.dates.release()
+        self.coefficients.release()
+        self.exponents.release()
+        self.view.release()
+        self.map.close()
+        return
+
+
+class PriceHistory:
+    """
+    Holds the store with price histories in a directory; see the module
+    docstring.
+
+    Input arguments:
+    directory: the directory of the store. It is created if needed.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self.series_cache = {}
+        return
+
+    def filename(self, code):
+        return os.path.join(self.directory, quote(code, safe='') + SUFFIX)
+
+    def codes(self):
+        """return: sorted list with the codes in the store."""
+        return sorted(unquote(name[:-len(SUFFIX)]) for name in os.listdir(self.directory)
+                      if name.endswith(SUFFIX))
+
+    def series(self, code):
+        """
+        return: PriceSeries for code, or None if it has no prices. A
+            series is mapped again if prices were appended to its file
+            since it was mapped, e.g. by another process.
+        """
+        filename = self.filename(code)
+        try:
+            size = os.path.getsize(filename)
+        except OSError:
+            return None
+        series = self.series_cache.get(code)
+        if series is not None and len(series.map) != size:
+            series.close()
+            series = None
+        if series is None:
+            if size < RECORD.size:
+                return None
+            series = self.series_cache[code] = PriceSeries(filename)
+        return series
+
+    def price_on(self, code, day, exact=True):
+        """return: the price of code on day; see PriceSeries.price_on."""
+        series = self.series(code)
+        return None if series is None else series.price_on(day, exact)
+
+    def prices_on(self, day, codes=None, exact=True):
+        """
+        Looks up the prices of many codes on one date at once.
+
+        input arguments:
+        day: the date.
+        codes: iterable of codes; None for all codes in the store.
+        exact: see PriceSeries.price_on.
+
+        return: dict with the price by code, for the codes that have
+            one.
+        """
+        prices = {}
+        # One binary search per code: the codes are in separate files of
+        # different lengths, so there is no single array of dates to
+        # search at once, and building one would read every file in full.
+        for code in self.codes() if codes is None else codes:
+            price = self.price_on(code, day, exact)
+            if price is not None:
+                prices[code] = price
+        return prices
+
+    def append(self, prices, replace_last=False):
+        """
+        Appends prices to the store.
+
+        input arguments:
+        prices: iterable of (code, date, price) tuples, in any order.
+        replace_last: if True, a different price for the last date of a
+            code replaces the stored one, e.g. for a corrected closing
+            price. Otherwise, and for earlier dates, a different price
+            raises PriceHistoryError.
+
+        return: the number of prices that were added or replaced;
+            prices that are already in the store are skipped.
+        """
+        by_code = {}
+        for code, day, price in prices:
+            by_code.setdefault(code, {})
+            known = by_code[code].get(day)
+            if known is not None and Decimal(known) != Decimal(price):
+                raise PriceHistoryError('{} has prices {} and {} on {}'.format(
+                    code, known, price, day))
+            by_code[code][day] = price
+
+        added = 0
+        for code, code_prices in by_code.items():
+            series = self.series(code)
+            last_date = None if series is None else series.last_date()
+            records = []
+            last_record = None
+            for day in sorted(code_prices):
+                price = Decimal(code_prices[day])
+                if last_date is not None and day <= last_date:
+                    if series.price_on(day) == price:
+                        continue
+                    if not (replace_last and day == last_date):
+                        raise PriceHistoryError(
+                            'cannot add {} for {} on {}: the store only takes prices after '
+                            '{}'.format(price, code, day, last_date))
+                    last_record = RECORD.pack(day.toordinal(), *decimal_parts(price))
+                    continue
+                records.append(RECORD.pack(day.toordinal(), *decimal_parts(price)))
+            if last_record is not None:
+                with open(self.filename(code), 'r+b') as prices_file:
+                    prices_file.seek((len(series) - 1) * RECORD.size)
+                    prices_file.write(last_record)
+                added += 1
+                # The mapped series sees the new price at once, as the
+                # size of the file does not change.
+            if not records:
+                continue
+            with open(self.filename(code), 'ab') as prices_file:
+                prices_file.write(b''.join(records))
+            added += len(records)
+        return added
+
+    def import_csv(self, filename):
+        """
+        Appends the prices in a csv file with code, date and price
+        columns.
+
+        return: the number of prices that were added.
+        """
+        with open(filename, newline='') as prices_file:
+            return self.append((row['code'], date.fromisoformat(row['date']), row['price'])
+                               for row in csv.DictReader(prices_file))
+
+    def close(self):
+        for series in self.series_cache.values():
+            series.close()
+        self.series_cache = {}
+        return
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Import share prices into a price history')
+    parser.add_argument('directory', help='directory of the price history')
+    parser.add_argument('files', nargs='+', metavar='FILE',
+                        help='csv file with code, date and price columns')
+    args = parser.parse_args()
+    history = PriceHistory(args.directory)
+    for filename in args.files:
+        print('{}: {:,} prices added'.format(filename, history.import_csv(filename)))
+    history.close()
@@ -0,0 +1,166 @@
+"""
+Profiling support for FIF.py, used by its --profile option.
+
+A function (normally FIF.main) is run under cProfile, with tracemalloc
+tracing memory allocations at the same time. Afterwards the following
+files are written, all starting with the same prefix:
+- PREFIX.pstats: raw cProfile statistics, for use with pstats or tools
+  such as snakeviz;
+- PREFIX.txt: the top functions by cumulative and by internal time;
+- PREFIX.collapsed: collapsed stacks, one line per call path with its
+  time in microseconds, suitable for flamegraph.pl or speedscope.
+The function being profiled may write its own per-stage allocation
+report; FIF.main does that as PREFIX.stats.json.
+
+Note that tracemalloc slows the program down considerably, so the
+absolute times are inflated. The relative times are still useful.
+Profiling is paused between the stages of FIF.main, while allocation
+snapshots are compared, so the stages appear as the roots of the
+profile rather than main itself.
+"""
+
+import cProfile
+import inspect
+import os.path
+import pstats
+import tracemalloc
+
+
+MAXIMUM_STACK_DEPTH = 64
+MINIMUM_FRACTION = 1e-6
+# Call paths that carry less than this fraction of a function's own
+# time are dropped, to keep the collapsed stacks file readable.
+
+
+def profile_run(function, prefix, top=25, **kwargs):
+    """
+    Runs function(**kwargs) under cProfile and tracemalloc, and writes
+    the profile files described in the module docstring.
+
+    input arguments:
+    function: the function to profile.
+    prefix: path and start of the name for the files that are written.
+    top: number of functions to include in PREFIX.txt.
+    kwargs: keyword arguments for function. If function accepts a
+        profiler argument, it gets the cProfile.Profile instance as
+        well, so it can pause profiling for its own bookkeeping.
+
+    return: the return value from function.
+    """
+    tracemalloc.start()
+    profiler = cProfile.Profile()
+    if 'profiler' in inspect.signature(function).parameters:
+        kwargs['profiler'] = profiler
+    profiler.enable()
+    try:
+        result = function(**kwargs)
+    finally:
+        profiler.disable()
+        tracemalloc.stop()
+
+    profiler.dump_stats(prefix + '.pstats')
+    with open(prefix + '.txt', 'w') as report_file:
+        stats = pstats.Stats(profiler, stream=report_file)
+        stats.sort_stats('cumulative').print_stats(top)
+        stats.sort_stats('tottime').print_stats(top)
+    write_collapsed_stacks(pstats.Stats(profiler), prefix + '.collapsed')
+    return result
+
+
+def frame_label(func):
+    """
+    return: a label for a function key of pstats, such as
+        'FIF.py:1234(FX_rate)'. Semicolons are replaced, because they
+        separate frames in collapsed stacks.
+    """
+    filename, line_number, name = func
+    if filename == '~':
+        label = name
+        # Built-in function, e.g. <method 'quantize' of ...>
+    else:
+        label = '{}:{}({})'.format(os.path.basename(filename), line_number, name)
+    return label.replace(';', ',').replace(' ', '_')
+
+
+def collapsed_stacks(stats):
+    """
+    Converts pstats statistics into collapsed stacks.
+
+    cProfile only records caller-callee pairs, not complete stacks. The
+    internal time of a function is therefore first split over its
+    callers by the time recorded for each caller-callee pair, and then
+    further over the callers of those callers in proportion to their
+    cumulative time. For programs without recursion this reproduces the
+    real stacks whenever a function is called along a single path.
+
+    input arguments:
+    stats: a pstats.Stats instance.
+
+    return: dict with call paths (strings with frames separated by
+        semicolons, outermost frame first) as keys and time in
+        microseconds as values.
+    """
+    raw = stats.stats
+    caller_paths = {}
+    # Memo of paths leading to (and including) a function, with the
+    # fraction of the function's cumulative time for each path. With
+    # recursion, paths are cut where a function would repeat.
+
+    def paths_to(func, depth, visiting):
+        """
+        return: (tuple with) the list of (path, fraction) pairs, and
+            whether any path was cut short because of recursion.
+        """
+        if func in caller_paths:
+            return caller_paths[func], False
+        all_callers = raw[func][4] if func in raw else {}
+        callers = {caller: edge for caller, edge in all_callers.items()
+                   if caller not in visiting}
+        cut = len(callers) < len(all_callers)
+        if not callers or depth >= MAXIMUM_STACK_DEPTH:
+            result = [((func,), 1.0)]
+            cut = cut or depth >= MAXIMUM_STACK_DEPTH
+        else:
+            total = sum(edge[3] for edge in callers.values())
+            result = []
+            for caller, edge in callers.items():
+                share = edge[3] / total if total > 0 else 1 / len(callers)
+                caller_result, caller_cut = paths_to(caller, depth + 1, visiting | {func})
+                cut = cut or caller_cut
+                for path, fraction in caller_result:
+                    if fraction * share >= MINIMUM_FRACTION:
+                        result.append((path + (func,), fraction * share))
+        if not cut:
+            caller_paths[func] = result
+            # Only memoise paths that do not depend on where we came
+            # from, i.e. that were not cut short by recursion.
+        return result, cut
+
+    stacks = {}
+    for func, (cc, nc, tt, ct, callers) in raw.items():
+        if tt <= 0:
+            continue
+        if callers:
+            own_times = [(caller, edge[2]) for caller, edge in callers.items()]
+        else:
+            own_times = [(None, tt)]
+        for caller, own_time in own_times:
+            if caller is None:
+                paths = [((), 1.0)]
+            else:
+                paths = paths_to(caller, 1, frozenset([func]))[0]
+            for path, fraction in paths:
+                microseconds = own_time * fraction * 1e6
+                if microseconds < 1:
+                    continue
+                key = ';'.join(frame_label(frame) for frame in path + (func,))
+                stacks[key] = stacks.get(key, 0) + microseconds
+
+    return {key: int(round(value)) for key, value in stacks.items()}
+
+
+def write_collapsed_stacks(stats, filename):
+    with open(filename, 'w') as collapsed_file:
+        for path, microseconds in sorted(collapsed_stacks(stats).items()):
+            collapsed_file.write('{} {}\n'.format(path, microseconds))
+    return
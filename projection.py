@@ -0,0 +1,406 @@
+"""
+Projection of FIF income for every day of the tax year, answering the
+question "what would my FIF income be if I sold everything today?".
+
+For each day the projection is the FIF income for a tax year in which
+all trades and dividends up to and including that day have happened,
+and all remaining holdings are then sold at the price of that day
+(without trade costs). That gives:
+- Comparative Value income: dividends received plus the proceeds of
+  the sale, minus the opening value and the cost of trades;
+- Fair Dividend Rate income: 5% of the opening value plus any quick
+  sale adjustment, where the sale at the end of the day counts as a
+  quick sale for shares acquired during the year;
+- FIF income: the lowest of those two, as in FIF.print_FIF_income.
+All values are rounded in the same way as in FIF.py, so the projection
+for a day is exactly the result of a normal run with the trades up to
+that day plus the sale of all holdings at the end of it.
+
+The trades and dividends are processed only once, in date order. For
+each share the running totals (cost of trades, dividends, shares
+acquired and their cost, quick sale shares and proceeds, peak holding)
+are kept up to date, so the projection for a day only needs the sale on
+that day on top of them. The quick sale balances for the dividend gain
+(see FIF.calc_QSA) come from a stack of acquisitions that are matched
+with later sales, last in first out, with cumulative totals, so the
+part of the sale on the day that falls after a dividend is found with
+a bisect.
+
+Prices and exchange rates are given per day; the last value on or
+before a day is used (e.g. for weekends). Before the first price the
+opening price is used. Without daily exchange rates, the same rates as
+for trades (FIF.FX_rate) are used.
+
+Example:
+    python projection.py --prices daily_prices.csv
+where daily_prices.csv has code, date and price columns.
+"""
+
+import argparse
+from bisect import bisect_left
+from collections import namedtuple
+from contextlib import redirect_stdout
+import csv
+from datetime import date, datetime, time, timedelta
+from decimal import Decimal, ROUND_HALF_UP
+import io
+from operator import attrgetter
+
+import FIF
+
+
+projection = namedtuple('projection', 'day, CV_income, FDR_income, FIF_income')
+
+
+class DailySeries:
+    """
+    Values by date, read in date order: value_on returns the last value
+    on or before a day, for days that never go back in time.
+
+    Input arguments:
+    values: dict with a value by date.
+    initial: the value before the first date.
+    """
+
+    def __init__(self, values, initial):
+        self.items = sorted(values.items())
+        self.position = 0
+        self.value = initial
+        return
+
+    def value_on(self, day):
+        while self.position < len(self.items) and self.items[self.position][0] <= day:
+            self.value = self.items[self.position][1]
+            self.position += 1
+        return self.value
+
+
+class ShareProjection:
+    """
+    The running totals for one share, updated trade by trade and
+    dividend by dividend in date order.
+
+    Input arguments:
+    share: the share, with its opening_value as calculated by
+        FIF.process_opening_positions.
+    """
+
+    def __init__(self, share):
+        self.share = share
+        self.holding = share.opening_holding
+        self.real_holding = share.opening_holding
+        # The holding without quasi-trades (with a price of zero),
+        # which calc_QSA leaves out.
+        self.cost_of_trades = Decimal('0.00')
+        self.income_from_dividends = Decimal('0.00')
+        self.shares_acquired = False
+        self.quick_sale = False
+        # As in process_trades: True after a disposal that follows an
+        # acquisition.
+        self.trades = 0
+        # Number of trades (without quasi-trades) so far; also the
+        # position of the next trade.
+        self.acquired_shares = Decimal('0')
+        self.acquisitions_total = Decimal('0.00')
+        self.quick_sale_shares = Decimal('0')
+        self.quick_sale_total = Decimal('0.00')
+        self.peak_holding = None
+        self.lot_trades = []
+        self.lot_totals = []
+        # The stack of acquisitions that are not yet matched with a
+        # sale: the position of each, and the cumulative number of
+        # unmatched shares up to and including it.
+        self.dividends = []
+        # For each dividend: [position, date_paid, per_share, fx_rate,
+        # quick sale balance from sales before the projection day].
+        self.version = 0
+        self.cache = None
+        return
+
+    def add_trade(self, trade):
+        self.version += 1
+        self.holding += trade.number_of_shares
+        fx_rate = FIF.FX_rate(self.share.currency, trade.date_time.date())
+        cost = sum((charge / fx_rate).quantize(Decimal('0.01'), ROUND_HALF_UP)
+                   for _, charge in trade.fill_values())
+        self.cost_of_trades += cost
+        if trade.number_of_shares > Decimal('0'):
+            self.shares_acquired = True
+        elif self.shares_acquired and trade.number_of_shares < Decimal('0'):
+            self.quick_sale = True
+        if trade.share_price == Decimal('0'):
+            return
+
+        position = self.trades
+        self.trades += 1
+        for number_of_shares, _ in trade.fill_values():
+            self.real_holding += number_of_shares
+            if self.peak_holding is None or self.real_holding > self.peak_holding:
+                self.peak_holding = self.real_holding
+        if trade.number_of_shares > Decimal('0'):
+            self.acquired_shares += trade.number_of_shares
+            self.acquisitions_total += cost
+            self.lot_trades.append(position)
+            self.lot_totals.append(self.unmatched_shares() + trade.number_of_shares)
+        elif trade.number_of_shares < Decimal('0'):
+            portion = min(-trade.number_of_shares, self.acquired_shares - self.quick_sale_shares)
+            self.quick_sale_shares += portion
+            self.quick_sale_total += sum(
+                ((fill_portion / -number_of_shares) * -charge / fx_rate).quantize(
+                    Decimal('0.01'), ROUND_HALF_UP)
+                for fill_portion, number_of_shares, charge in FIF.fill_portions(trade, portion))
+            self.match(portion, position)
+        return
+
+    def unmatched_shares(self):
+        return self.lot_totals[-1] if self.lot_totals else Decimal('0')
+
+    def match(self, portion, position):
+        """
+        Matches a quick sale portion with the latest acquisitions, and
+        adds the matched shares to the quick sale balance of the
+        dividends paid between each acquisition and the sale.
+        """
+        while portion > Decimal('0'):
+            below = self.lot_totals[-2] if len(self.lot_totals) > 1 else Decimal('0')
+            matched = min(portion, self.lot_totals[-1] - below)
+            acquisition = self.lot_trades[-1]
+            for dividend in self.dividends:
+                if acquisition < dividend[0] <= position:
+                    dividend[4] += matched
+            if self.lot_totals[-1] - below == matched:
+                self.lot_trades.pop()
+                self.lot_totals.pop()
+            else:
+                self.lot_totals[-1] -= matched
+            portion -= matched
+        return
+
+    def add_dividend(self, dividend):
+        self.version += 1
+        fx_rate = FIF.FX_rate(self.share.currency, dividend.date_paid)
+        self.income_from_dividends += (dividend.gross_paid / fx_rate).quantize(
+            Decimal('0.01'), ROUND_HALF_UP)
+        self.dividends.append([self.trades, dividend.date_paid, dividend.per_share, fx_rate,
+                               Decimal('0')])
+        return
+
+    def unmatched_after(self, position):
+        """
+        return: the number of unmatched shares acquired at or after
+            position.
+        """
+        first = bisect_left(self.lot_trades, position)
+        below = self.lot_totals[first - 1] if first else Decimal('0')
+        return self.unmatched_shares() - below
+
+    def project(self, day, price, fx_rate):
+        """
+        return: (tuple with) the Comparative Value income and the quick
+            sale adjustment for this share, if all of it is sold at the
+            end of day.
+        """
+        key = (self.version, price, fx_rate,
+               bool(self.dividends) and self.dividends[-1][1] < day)
+        if self.cache is not None and self.cache[0] == key:
+            return self.cache[1]
+        sale = -self.holding
+        sale_cost = (sale * price / fx_rate).quantize(Decimal('0.01'), ROUND_HALF_UP)
+        CV_income = self.income_from_dividends - self.share.opening_value - \
+            self.cost_of_trades - sale_cost
+        # The closing value is zero after the sale.
+        quick_sale_adjustment = Decimal('0.00')
+        if self.quick_sale or (self.shares_acquired and sale < Decimal('0')):
+            quick_sale_adjustment = self.quick_sale_adjustment(day, price, fx_rate)
+        self.cache = (key, (CV_income, quick_sale_adjustment))
+        return CV_income, quick_sale_adjustment
+
+    def quick_sale_adjustment(self, day, price, fx_rate):
+        """
+        return: the quick sale adjustment, calculated as in FIF.calc_QSA
+            with the sale at the end of day as the last trade.
+        """
+        sale = -self.holding
+        real_sale = sale != Decimal('0') and price != Decimal('0')
+        real_holding = self.real_holding + (sale if real_sale else Decimal('0'))
+        if real_holding != Decimal('0'):
+            return Decimal('0.00')
+            # Quasi-trades, as in calc_QSA.
+        peak_holding = self.peak_holding
+        if real_sale and (peak_holding is None or real_holding > peak_holding):
+            peak_holding = real_holding
+        if peak_holding is None or peak_holding < Decimal('0'):
+            peak_holding = Decimal('0')
+
+        acquired_shares = self.acquired_shares
+        acquisitions_total = self.acquisitions_total
+        quick_sale_shares = self.quick_sale_shares
+        quick_sale_total = self.quick_sale_total
+        portion = Decimal('0')
+        if real_sale and sale > Decimal('0'):
+            acquired_shares += sale
+            acquisitions_total += (sale * price / fx_rate).quantize(Decimal('0.01'),
+                                                                    ROUND_HALF_UP)
+        elif real_sale:
+            portion = min(-sale, acquired_shares - quick_sale_shares)
+            quick_sale_shares += portion
+            quick_sale_total += ((portion / -sale) * (-sale * price) / fx_rate).quantize(
+                Decimal('0.01'), ROUND_HALF_UP)
+        if acquired_shares == Decimal('0'):
+            return Decimal('0.00')
+
+        dividends_gain = Decimal('0.00')
+        for position, date_paid, per_share, dividend_fx_rate, balance in self.dividends:
+            if date_paid >= day:
+                continue
+                # Paid after the sale at the end of day.
+            if portion:
+                balance += max(Decimal('0'), portion - self.unmatched_after(position))
+            if balance > Decimal('0'):
+                dividends_gain += (balance * per_share / dividend_fx_rate).quantize(
+                    Decimal('0.01'), ROUND_HALF_UP)
+
+        peak_differential = min(peak_holding - self.share.opening_holding, peak_holding)
+        average_cost_of_acquisition = acquisitions_total / acquired_shares
+        peak_holding_adjustment = (Decimal(FIF.FAIR_DIVIDEND_RATE) * peak_differential *
+                                   average_cost_of_acquisition).quantize(Decimal('0.01'),
+                                                                          ROUND_HALF_UP)
+        quick_sale_costs = (quick_sale_shares * average_cost_of_acquisition).quantize(
+            Decimal('0.01'), ROUND_HALF_UP)
+        quick_sale_gain = quick_sale_total - quick_sale_costs + dividends_gain
+        if quick_sale_gain < Decimal(0):
+            quick_sale_gain = Decimal('0.00')
+        return min(peak_holding_adjustment, quick_sale_gain)
+
+
+def project_FIF_income(shares, trades, dividends, prices, fx_rates=None, first_day=None,
+                       last_day=None):
+    """
+    Calculates the projected FIF income for every day in a period.
+
+    input arguments:
+    shares: list of shares after a normal run (FIF_result.shares), i.e.
+        with their opening_value and including shares acquired during
+        the year.
+    trades, dividends: lists of all trades and dividends for the year.
+    prices: dict with a dict of prices (as Decimals) by date for each
+        share code.
+    fx_rates: optional dict with a dict of exchange rates (as Decimals)
+        by date for each currency; if None, FIF.FX_rate is used.
+    first_day, last_day: the period; by default the whole tax year.
+
+    return: list of projections, one for each day.
+    """
+    if first_day is None:
+        first_day = FIF.previous_closing_date() + timedelta(days=1)
+    if last_day is None:
+        last_day = FIF.closing_date()
+    states = {share.code: ShareProjection(share) for share in shares}
+    share_trades = sorted((trade for trade in trades if trade.code in states),
+                          key=attrgetter('date_time'))
+    share_dividends = sorted((dividend for dividend in dividends if dividend.code in states),
+                             key=attrgetter('date_paid'))
+    price_series = {share.code: DailySeries(prices.get(share.code, {}), share.opening_price)
+                    for share in shares}
+    if fx_rates is not None:
+        rate_series = {currency: DailySeries(
+            fx_rates.get(currency, {}), FIF.FX_rate(currency, FIF.previous_closing_date()))
+            for currency in {share.currency for share in shares}}
+    FDR_basic_income = sum((share.opening_value * Decimal(FIF.FAIR_DIVIDEND_RATE)).quantize(
+        Decimal('0.01'), rounding=ROUND_HALF_UP) for share in shares)
+
+    projections = []
+    next_trade = 0
+    next_dividend = 0
+    day = first_day
+    while day <= last_day:
+        end_of_day = datetime.combine(day, time.max)
+        while next_trade < len(share_trades) and share_trades[next_trade].date_time <= end_of_day:
+            states[share_trades[next_trade].code].add_trade(share_trades[next_trade])
+            next_trade += 1
+        while next_dividend < len(share_dividends) and \
+                share_dividends[next_dividend].date_paid <= day:
+            states[share_dividends[next_dividend].code].add_dividend(
+                share_dividends[next_dividend])
+            next_dividend += 1
+
+        CV_income = Decimal('0.00')
+        FDR_income = FDR_basic_income
+        for code, state in states.items():
+            if fx_rates is not None:
+                fx_rate = rate_series[state.share.currency].value_on(day)
+            else:
+                fx_rate = FIF.FX_rate(state.share.currency, day)
+            share_CV_income, quick_sale_adjustment = state.project(
+                day, price_series[code].value_on(day), fx_rate)
+            CV_income += share_CV_income
+            FDR_income += quick_sale_adjustment
+        if FDR_income <= CV_income:
+            FIF_income = FDR_income
+        else:
+            FIF_income = max(CV_income, Decimal('0.00'))
+        projections.append(projection(day, CV_income, FDR_income, FIF_income))
+        day += timedelta(days=1)
+    return projections
+
+
+def read_daily_values(filename, key_column):
+    """
+    Reads a csv file with key_column (code or currency), date (in ISO
+    format) and price or rate columns.
+
+    return: dict with a dict of Decimal values by date for each key.
+    """
+    values = {}
+    with open(filename, newline='') as values_file:
+        for row in csv.DictReader(values_file):
+            value = row.get('price', row.get('rate'))
+            values.setdefault(row[key_column], {})[date.fromisoformat(row['date'])] = \
+                Decimal(value)
+    return values
+
+
+def print_projections(projections, every=1):
+    """Prints the projections, for every so many days (and the last day)."""
+    print('{v1:{w1}}{v2:>{w2}}{v3:>{w2}}{v4:>{w2}}'.format(
+        v1='sold on', w1=12, v2='CV income', v3='FDR income', v4='FIF income', w2=20))
+    for index, day_projection in enumerate(projections):
+        if index % every and index != len(projections) - 1:
+            continue
+        print('{v1:{w1}}{v2:>{w2},.2f}{v3:>{w2},.2f}{v4:>{w2},.2f}'.format(
+            v1=day_projection.day.strftime('%d %b %Y'), w1=12, w2=20,
+            v2=day_projection.CV_income, v3=day_projection.FDR_income,
+            v4=day_projection.FIF_income))
+    return
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Project FIF income for every day of the year')
+    parser.add_argument('--tax-year', type=int, default=FIF.tax_year)
+    parser.add_argument('--opening', default=FIF.opening_test_file)
+    parser.add_argument('--trades', default=FIF.trades_test_file)
+    parser.add_argument('--dividends', default=FIF.dividends_test_file)
+    parser.add_argument('--prices', required=True,
+                        help='csv file with code, date and price columns')
+    parser.add_argument('--daily-fx-rates',
+                        help='csv file with currency, date and rate columns')
+    parser.add_argument('--fx-rates', default=FIF.fx_rates_file)
+    parser.add_argument('--securities', default=FIF.securities_master_file)
+    parser.add_argument('--every', type=int, default=7,
+                        help='print every N days (default 7)')
+    args = parser.parse_args()
+
+    FIF.tax_year = args.tax_year
+    FIF.fx_rates = FIF.get_fx_rates(FIF.fx_rates, args.fx_rates)
+    FIF.securities = FIF.load_securities_master(args.securities)
+    trades = FIF.read_trades(args.trades)
+    dividends = FIF.read_dividends(args.dividends)
+    with redirect_stdout(io.StringIO()):
+        base = FIF.calculate_FIF_income(FIF.read_opening_positions(args.opening), trades,
+                                        dividends, [])
+    daily_fx_rates = None
+    if args.daily_fx_rates:
+        daily_fx_rates = read_daily_values(args.daily_fx_rates, 'currency')
+    print_projections(project_FIF_income(base.shares, trades, dividends,
+                                         read_daily_values(args.prices, 'code'),
+                                         daily_fx_rates), args.every)
@@ -0,0 +1,224 @@
+"""
+Scenario analysis for FIF.py: how FIF income changes with different
+closing prices and foreign exchange rates on 31 March.
+
+One normal run of FIF.py gives everything that does not depend on the
+closing prices: the opening value, the cost of trades, the gross
+income from dividends and the Fair Dividend Rate income (including any
+quick sale adjustments, which only depend on trades during the year).
+A scenario only changes the closing value, so thousands of scenarios
+are calculated at once with NumPy, as a matrix with a row per scenario
+and a column per share:
+
+    closing value = round(round(holding * price * price factor)
+                          / (rate * rate factor))
+
+rounded to cents per share (half up), as in process_closing_prices.
+Comparative Value income and FIF income then follow for each scenario
+as in calc_comparative_value_income and print_FIF_income. Calculations
+use floating point numbers, with rounding that allows for their
+representation errors, but in rare cases a value can still differ by a
+cent from a normal run.
+
+Shocks are factors for the closing price of each share and for the
+closing exchange rate of each currency; 1 means no change. They can be
+created with random_shocks, or be given directly.
+
+Example:
+    python scenarios.py --scenarios 10000 --price-volatility 0.2
+"""
+
+import argparse
+from collections import namedtuple
+from contextlib import redirect_stdout
+import io
+
+import FIF
+
+
+scenario_results = namedtuple('scenario_results', 'CV_income, FDR_income, FIF_income')
+# Arrays with a value for each scenario.
+MAXIMUM_CELLS = 4000000
+# Scenarios are evaluated in chunks of at most this many scenario and
+# share combinations, to limit memory use.
+
+
+def import_numpy():
+    try:
+        import numpy
+    except ImportError:
+        raise ImportError('numpy is needed for scenario analysis; ' +
+                          'install it with: pip install numpy') from None
+    return numpy
+
+
+def round_half_up(values):
+    """
+    return: values rounded to cents, with halves rounded away from zero
+        like ROUND_HALF_UP for Decimals.
+    """
+    numpy = import_numpy()
+    return numpy.sign(values) * numpy.floor(numpy.abs(values) * (100 * (1 + 1e-12)) + 0.5) / 100
+    # The tiny increase makes exact halves, such as 0.125 stored as
+    # 0.12499999..., round up as they do for Decimals.
+
+
+class ScenarioEngine:
+    """
+    Evaluates scenarios for a portfolio after a normal run.
+
+    Input arguments:
+    result: FIF_result from FIF.calculate_FIF_income.
+    closing_rates: optional dict with the closing exchange rate by
+        currency; otherwise the rates for 31 March in FIF.fx_rates are
+        used (which must be known).
+    """
+
+    def __init__(self, result, closing_rates=None):
+        numpy = import_numpy()
+        self.result = result
+        shares = [share for share in result.shares if share.holding]
+        self.codes = [share.code for share in shares]
+        self.currencies = sorted({share.currency for share in shares})
+        if closing_rates is None:
+            closing_rates = {currency: FIF.FX_rate(currency, FIF.closing_date())
+                             for currency in self.currencies}
+        self.holdings = numpy.array([float(share.holding) for share in shares])
+        self.prices = numpy.array([float(share.closing_price) for share in shares])
+        self.currency_index = numpy.array([self.currencies.index(share.currency)
+                                           for share in shares], dtype=numpy.intp)
+        self.rates = numpy.array([float(closing_rates[currency])
+                                  for currency in self.currencies])
+        self.fixed_income = float(result.gross_income_from_dividends - result.opening_value -
+                                  result.cost_of_trades)
+        # The part of Comparative Value income that does not depend on
+        # closing prices.
+        return
+
+    def closing_values(self, price_factors, rate_factors):
+        """
+        return: array with the total closing value in NZD for each
+            scenario.
+        """
+        foreign_values = round_half_up(self.holdings * (self.prices * price_factors))
+        NZD_values = round_half_up(foreign_values /
+                                   (self.rates * rate_factors)[:, self.currency_index])
+        return NZD_values.sum(axis=1)
+
+    def evaluate(self, price_factors=None, rate_factors=None):
+        """
+        Calculates FIF income for each scenario.
+
+        input arguments:
+        price_factors: array with a row for each scenario and a factor
+            for the closing price of each share in self.codes.
+        rate_factors: array with a row for each scenario and a factor
+            for the closing exchange rate of each currency in
+            self.currencies.
+        Either can be None for no change, but not both.
+
+        return: scenario_results with arrays of CV income, FDR income
+            and FIF income, with a value per scenario.
+        """
+        numpy = import_numpy()
+        if price_factors is None:
+            price_factors = numpy.ones((len(rate_factors), len(self.codes)))
+        if rate_factors is None:
+            rate_factors = numpy.ones((len(price_factors), len(self.currencies)))
+        price_factors = numpy.asarray(price_factors, dtype=float)
+        rate_factors = numpy.asarray(rate_factors, dtype=float)
+        if price_factors.shape[1:] != (len(self.codes),) or \
+                rate_factors.shape != (len(price_factors), len(self.currencies)):
+            raise ValueError('need a factor for each share and each currency in every scenario')
+
+        closing_values = numpy.empty(len(price_factors))
+        chunk = max(1, MAXIMUM_CELLS // max(1, len(self.codes)))
+        for start in range(0, len(price_factors), chunk):
+            closing_values[start:start + chunk] = self.closing_values(
+                price_factors[start:start + chunk], rate_factors[start:start + chunk])
+
+        CV_income = numpy.round(closing_values + self.fixed_income, 2)
+        FDR_income = numpy.full(len(CV_income), float(self.result.FDR_income))
+        FIF_income = numpy.where(FDR_income <= CV_income, FDR_income,
+                                 numpy.maximum(CV_income, 0))
+        # As in print_FIF_income: the lowest, but never negative.
+        return scenario_results(CV_income, FDR_income, FIF_income)
+
+    def random_shocks(self, scenarios, price_volatility=0.15, rate_volatility=0.08,
+                      market_weight=0.7, seed=0):
+        """
+        Creates random factors for evaluate: lognormal, with a market
+        factor that all shares have in common (with market_weight of
+        the variance) and a separate factor for each share. Exchange
+        rates have independent factors.
+
+        return: (tuple with) the price factors and the rate factors.
+        """
+        numpy = import_numpy()
+        generator = numpy.random.default_rng(seed)
+        market = generator.standard_normal((scenarios, 1))
+        own = generator.standard_normal((scenarios, len(self.codes)))
+        price_shocks = price_volatility * (numpy.sqrt(market_weight) * market +
+                                           numpy.sqrt(1 - market_weight) * own)
+        rate_shocks = rate_volatility * generator.standard_normal(
+            (scenarios, len(self.currencies)))
+        return (numpy.exp(price_shocks - price_volatility ** 2 / 2),
+                numpy.exp(rate_shocks - rate_volatility ** 2 / 2))
+        # Minus half the variance so the expected factor is 1.
+
+
+def print_distribution(results, percentiles=(1, 5, 25, 50, 75, 95, 99)):
+    """
+    Prints percentiles of the CV, FDR and FIF income over all scenarios,
+    and how often Comparative Value income is used.
+
+    return: None
+    """
+    numpy = import_numpy()
+    print('\nFIF income over {:,} scenarios'.format(len(results.FIF_income)))
+    print('{v1:>{w1}}{v2:>{w2}}{v3:>{w2}}{v4:>{w2}}'.format(
+        v1='percentile', w1=12, v2='CV income', v3='FDR income', v4='FIF income', w2=20))
+    for percentile in percentiles:
+        print('{v1:>{w1}}{v2:>{w2},.2f}{v3:>{w2},.2f}{v4:>{w2},.2f}'.format(
+            v1=percentile, w1=12, w2=20,
+            v2=numpy.percentile(results.CV_income, percentile),
+            v3=numpy.percentile(results.FDR_income, percentile),
+            v4=numpy.percentile(results.FIF_income, percentile)))
+    print('{v1:>{w1}}{v2:>{w2},.2f}{v3:>{w2},.2f}{v4:>{w2},.2f}'.format(
+        v1='mean', w1=12, w2=20, v2=results.CV_income.mean(),
+        v3=results.FDR_income.mean(), v4=results.FIF_income.mean()))
+    print('Comparative Value income is used in {:.1%} of scenarios'.format(
+        (results.CV_income < results.FDR_income).mean()))
+    return
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Scenario analysis of FIF income')
+    parser.add_argument('--tax-year', type=int, default=FIF.tax_year)
+    parser.add_argument('--opening', default=FIF.opening_test_file)
+    parser.add_argument('--trades', default=FIF.trades_test_file)
+    parser.add_argument('--dividends', default=FIF.dividends_test_file)
+    parser.add_argument('--closing', default=FIF.closing_test_file,
+                        help='the expected closing prices')
+    parser.add_argument('--fx-rates', default=FIF.fx_rates_file)
+    parser.add_argument('--securities', default=FIF.securities_master_file)
+    parser.add_argument('--scenarios', type=int, default=10000)
+    parser.add_argument('--price-volatility', type=float, default=0.15)
+    parser.add_argument('--fx-volatility', type=float, default=0.08)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    FIF.tax_year = args.tax_year
+    FIF.fx_rates = FIF.get_fx_rates(FIF.fx_rates, args.fx_rates)
+    FIF.securities = FIF.load_securities_master(args.securities)
+    with redirect_stdout(io.StringIO()):
+        base = FIF.calculate_FIF_income(FIF.read_opening_positions(args.opening),
+                                        FIF.read_trades(args.trades),
+                                        FIF.read_dividends(args.dividends),
+                                        FIF.read_closing_prices(args.closing))
+    print('With the expected closing prices FIF income is {:,.2f} '
+          '(CV income {:,.2f}, FDR income {:,.2f})'.format(base.FIF_income, base.CV_income,
+                                                           base.FDR_income))
+    engine = ScenarioEngine(base)
+    print_distribution(engine.evaluate(*engine.random_shocks(
+        args.scenarios, args.price_volatility, args.fx_volatility, seed=args.seed)))
@@ -0,0 +1,98 @@
+"""
+Securities master for FIF.py: a persistent store with the full name,
+currency and ISIN of every share code that has been seen before.
+
+The store is a pickle file, like saved_fx_rates.pickle, that is loaded
+once at the start of a run. It holds plain dicts, so it does not depend
+on any class in FIF.py. The codes are indexed by ISIN as well, because
+an ISIN identifies a share even if its code changes.
+"""
+
+from collections import namedtuple
+import os.path
+import pickle
+
+
+security_info = namedtuple('security_info', 'code, full_name, currency, isin')
+
+
+class SecuritiesMaster:
+    """
+    Holds the security_info for each share code.
+
+    Input arguments:
+    records: optional dict with a dict of full_name, currency and isin
+        for each code, as saved by save.
+    """
+
+    def __init__(self, records=None):
+        self.records = {}
+        self.codes_by_isin = {}
+        for code, record in (records or {}).items():
+            self.add(code, record.get('full_name', ''), record.get('currency', ''),
+                     record.get('isin'))
+        self.changed = False
+        return
+
+    def add(self, code, full_name, currency, isin=None):
+        """
+        Adds a share, or updates the information for it. Empty values
+        do not replace known ones.
+
+        return: None
+        """
+        old = self.records.get(code, {})
+        record = {'full_name': full_name or old.get('full_name', ''),
+                  'currency': currency or old.get('currency', ''),
+                  'isin': isin or old.get('isin')}
+        if record != old:
+            self.records[code] = record
+            if record['isin']:
+                self.codes_by_isin[record['isin']] = code
+            self.changed = True
+        return
+
+    def lookup(self, code):
+        """
+        return: security_info for code, or None if code is not known
+            (or its currency is not known).
+        """
+        record = self.records.get(code)
+        if record is None or not record['currency']:
+            return None
+        return security_info(code, record['full_name'], record['currency'], record['isin'])
+
+    def code_for_isin(self, isin):
+        """return: the code for a share with isin, or None."""
+        return self.codes_by_isin.get(isin)
+
+    def __contains__(self, code):
+        return self.lookup(code) is not None
+
+    def __len__(self):
+        return len(self.records)
+
+
+def load_securities_master(filename):
+    """
+    return: SecuritiesMaster with the shares saved in filename; empty
+        if the file does not exist yet.
+    """
+    if not os.path.isfile(filename):
+        return SecuritiesMaster()
+    with open(filename, 'rb') as master_file:
+        return SecuritiesMaster(pickle.load(master_file))
+
+
+def save_securities_master(master, filename):
+    """
+    Saves master to filename, if anything in it has changed.
+
+    return: None
+    """
+    if not master.changed:
+        return
+    with open(filename, 'wb') as master_file:
+        pickle.dump(master.records, master_file)
+    master.changed = False
+    return
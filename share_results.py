@@ -0,0 +1,175 @@
+"""
+The results of a run of FIF.py for each share, saved so that two runs
+can be compared share by share.
+
+A results file has a row for each share, keyed by share code and in
+code order, with the values that make up FIF income (opening value,
+cost of trades, gross income from dividends, closing value and quick
+sale adjustment, in NZD) and the holdings and prices they follow from.
+Values are kept exactly as the text of their Decimals. A file is a csv
+file, or a columnar file if its name ends in .parquet, .arrow or
+.feather (see columnar.py).
+
+diff_share_results joins two runs by share code with a dict, in one
+pass over each run, and converts values to Decimals only where their
+text differs. For every share with a changed value it reports the
+changed fields, and why they changed as far as the saved holdings and
+prices tell: a value that changed while they did not points at the
+exchange rates or at the rules of the calculation.
+
+Example:
+    python share_results.py results_2018_before.csv results_2018.csv
+"""
+
+import argparse
+from collections import namedtuple
+import csv
+from decimal import Decimal
+from operator import attrgetter, itemgetter
+
+from columnar import columnar_format, read_rows, write_rows
+
+
+POSITION_FIELDS = ['opening_holding', 'opening_price', 'holding', 'closing_price']
+VALUE_FIELDS = ['opening_value', 'cost_of_trades', 'gross_income_from_dividends',
+                'closing_value', 'quick_sale_adjustment']
+FIELDS = ['code'] + POSITION_FIELDS + VALUE_FIELDS
+REASONS = {'opening_holding': 'opening holding', 'opening_price': 'opening price',
+           'holding': 'trades', 'closing_price': 'closing price'}
+# The explanation for a change in each of the POSITION_FIELDS.
+share_result = namedtuple('share_result', FIELDS)
+# The results of one share, with every field as text.
+share_change = namedtuple('share_change', 'code, changes, reasons')
+# changes is a list of (field, old value, new value) tuples, with the
+# values as text ('' if there is none); reasons is a list of strings.
+
+
+def share_rows(shares):
+    """
+    return: list of share_result namedtuples for shares, in code order.
+        A quick sale adjustment of None becomes ''.
+    """
+    return [share_result(*('' if getattr(share, field) is None else str(getattr(share, field))
+                           for field in FIELDS))
+            for share in sorted(shares, key=lambda share: share.code)]
+
+
+def save_share_results(filename, rows):
+    """
+    Saves rows from share_rows; see the module docstring.
+
+    return: None
+    """
+    if columnar_format(filename):
+        write_rows(filename, FIELDS, [row._asdict() for row in rows])
+        return
+    with open(filename, 'w', newline='') as results_file:
+        writer = csv.writer(results_file)
+        writer.writerow(FIELDS)
+        writer.writerows(rows)
+    return
+
+
+def read_share_results(filename):
+    """
+    return: dict with the share_result of each share by code, from a
+        results file.
+    """
+    if columnar_format(filename):
+        return {row['code']: share_result(*(row.get(field, '') for field in FIELDS))
+                for row in read_rows(filename, FIELDS)}
+    with open(filename, newline='') as results_file:
+        reader = csv.reader(results_file)
+        header = next(reader, [])
+        if header == FIELDS:
+            return {row[0]: share_result._make(row) for row in reader}
+        columns = itemgetter(*(header.index(field) for field in FIELDS))
+        return {row[header.index('code')]: share_result._make(columns(row)) for row in reader}
+
+
+def same_value(old, new):
+    """return: whether two values as text are the same number (or both empty)."""
+    if old == new:
+        return True
+    if not old or not new:
+        return False
+    return Decimal(old) == Decimal(new)
+
+
+def values(row):
+    """return: list of (field, value) tuples for the VALUE_FIELDS of row."""
+    return [(field, getattr(row, field)) for field in VALUE_FIELDS]
+
+
+def diff_share_results(old, new):
+    """
+    Compares the results of two runs, share by share.
+
+    input arguments:
+    old, new: dicts with the share_result of each share by code, as
+        returned by read_share_results.
+
+    return: (tuple with) list of share_change namedtuples for the
+        shares with a changed value, in code order, and dict with the
+        (old, new) totals of each of the VALUE_FIELDS.
+    """
+    changed = []
+    for code, new_row in new.items():
+        old_row = old.get(code)
+        # Most shares do not change, and comparing whole rows is much
+        # quicker than comparing their fields one by one.
+        if old_row == new_row:
+            continue
+        if old_row is None:
+            changed.append(share_change(code, [(field, '', value) for field, value in
+                                               values(new_row) if value],
+                                        ['only in the new run']))
+            continue
+        changes = [(field, old_value, new_value) for (field, old_value), (_, new_value)
+                   in zip(values(old_row), values(new_row))
+                   if not same_value(old_value, new_value)]
+        if changes:
+            reasons = [REASONS[field] for field in POSITION_FIELDS
+                       if not same_value(getattr(old_row, field), getattr(new_row, field))]
+            changed.append(share_change(code, changes,
+                                        reasons or ['exchange rates or calculation rules']))
+    for code, old_row in old.items():
+        if code not in new:
+            changed.append(share_change(code, [(field, value, '') for field, value in
+                                               values(old_row) if value],
+                                        ['only in the old run']))
+    changed.sort(key=lambda change: change.code)
+    totals = {field: (column_total(old, field), column_total(new, field))
+              for field in VALUE_FIELDS}
+    return changed, totals
+
+
+def column_total(rows, field):
+    """return: the total of field over rows (a dict of share_results by code)."""
+    return sum(map(Decimal, filter(None, map(attrgetter(field), rows.values()))),
+               Decimal('0.00'))
+
+
+def print_diff(changed, totals, indent=''):
+    """Prints the result of diff_share_results."""
+    for change in changed:
+        print('{}{} ({})'.format(indent, change.code, ', '.join(change.reasons)))
+        for field, old_value, new_value in change.changes:
+            difference = Decimal(new_value or '0') - Decimal(old_value or '0')
+            print('{}    {:30}{:>20}{:>20}{:>20,.2f}'.format(indent, field, old_value or '-',
+                                                          new_value or '-', difference))
+    print('{}{} of the shares changed'.format(indent, len(changed)))
+    for field, (old_total, new_total) in totals.items():
+        print('{}{:34}{:>20,.2f}{:>20,.2f}{:>20,.2f}'.format(indent, 'total ' + field,
+                                                            old_total, new_total,
+                                                            new_total - old_total))
+    return
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare the results of two runs by share')
+    parser.add_argument('old', help='results file of the earlier run')
+    parser.add_argument('new', help='results file of the later run')
+    args = parser.parse_args()
+    print_diff(*diff_share_results(read_share_results(args.old),
+                                   read_share_results(args.new)))
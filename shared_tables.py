@@ -0,0 +1,336 @@
+"""
+Read-only tables of foreign exchange rates and share prices in shared
+memory, for worker processes of FIF.py.
+
+A worker that needs fx_rates (or closing prices) would otherwise get
+its own pickled copy of them for every task, which costs more than the
+task itself when the tasks are short. Instead the main process
+publishes a SharedTable once, and passes only its handle (the name of
+the shared memory block and the number of rows) to the workers, which
+attach to it without copying anything. Attaching takes the same time
+for a table with ten rates as for one with ten million.
+
+A table has a row for each (name, date) key, e.g. ('USD',
+date(2017, 5, 15)) for a rate or ('VEU', date(2018, 3, 31)) for a
+closing price, in three columns of 64-bit integers:
+- key: a 40-bit hash of the name, followed by the 20-bit ordinal of
+  the date, so keys sort by name and then by date. Rows are sorted by
+  key, and a value is found with a binary search (bisect).
+- coefficient and exponent: the value as coefficient * 10 ** exponent,
+  exactly as its Decimal, so it converts back to the same Decimal
+  (with the same number of decimals).
+
+Example, to compare the cost of starting workers with attached tables
+and with pickled copies, for stores of different sizes:
+    python shared_tables.py --sizes 1000 100000 1000000
+"""
+
+import argparse
+from bisect import bisect_left
+from concurrent.futures import ProcessPoolExecutor
+from datetime import date, timedelta
+from decimal import Decimal
+from hashlib import blake2b
+from multiprocessing import resource_tracker, shared_memory
+import pickle
+from time import perf_counter
+
+
+DATE_BITS = 20
+# Date ordinals are below 2 ** 20 until the year 2870.
+HASH_BYTES = 5
+COLUMNS = 3
+ITEM_SIZE = 8
+
+published = set()
+# Names of the blocks created by this process.
+attached = {}
+# The table this process attached to last, by name.
+
+
+def name_hash(name):
+    """return: a 40-bit hash of name, the same in every process."""
+    return int.from_bytes(blake2b(name.encode('utf-8'), digest_size=HASH_BYTES).digest(),
+                          'big')
+
+
+def table_key(name, day):
+    """return: the key of the row for name and day."""
+    return (name_hash(name) << DATE_BITS) | day.toordinal()
+
+
+def decimal_parts(value):
+    """
+    return: (tuple with) the integer coefficient and the exponent of
+        Decimal(value), so that value is coefficient * 10 ** exponent.
+        Raises ValueError if they do not fit in 64-bit integers.
+    """
+    sign, digits, exponent = Decimal(value).as_tuple()
+    coefficient = int(''.join(map(str, digits)) or '0') * (-1 if sign else 1)
+    if not isinstance(exponent, int) or abs(coefficient) >= 2 ** 63:
+        raise ValueError('{} does not fit in 64-bit integers'.format(value))
+    return coefficient, exponent
+
+
+def from_parts(coefficient, exponent):
+    """return: the Decimal for coefficient and exponent."""
+    return Decimal(coefficient).scaleb(exponent)
+
+
+class SharedTable:
+    """
+    Holds a table of Decimal values by (name, date) in shared memory.
+
+    Use SharedTable.publish in the main process and SharedTable.attach
+    (or the attach function) in workers; see the module docstring.
+
+    Input arguments:
+    memory: the SharedMemory block.
+    rows: the number of rows.
+    owner: True for the process that published the table; it removes
+        the block when the table is closed.
+    """
+
+    def __init__(self, memory, rows, owner):
+        self.memory = memory
+        self.rows = rows
+        self.owner = owner
+        view = memory.buf[:rows * COLUMNS * ITEM_SIZE]
+        if not owner:
+            view = view.toreadonly()
+        self.view = view.cast('q')
+        self.keys = self.view[:rows]
+        self.coefficients = self.view[rows:2 * rows]
+        self.exponents = self.view[2 * rows:]
+        return
+
+    @classmethod
+    def publish(cls, values):
+        """
+        Creates a table in a new shared memory block.
+
+        input arguments:
+        values: iterable of ((name, date), value) tuples, with each
+            value a Decimal or a string for one.
+
+        return: SharedTable.
+        """
+        rows = {}
+        for (name, day), value in values:
+            key = table_key(name, day)
+            if key in rows and rows[key][0] != name:
+                raise ValueError('the names {} and {} have the same hash'.format(
+                    rows[key][0], name))
+            coefficient, exponent = decimal_parts(value)
+            rows[key] = (name, coefficient, exponent)
+        keys = sorted(rows)
+        memory = shared_memory.SharedMemory(create=True,
+                                            size=max(1, len(keys)) * COLUMNS * ITEM_SIZE)
+        published.add(memory.name)
+        table = cls(memory, len(keys), True)
+        for position, key in enumerate(keys):
+            _, coefficient, exponent = rows[key]
+            table.keys[position] = key
+            table.coefficients[position] = coefficient
+            table.exponents[position] = exponent
+        return table
+
+    @classmethod
+    def attach(cls, handle):
+        """
+        return: SharedTable for the block of a published table, without
+            copying it.
+        """
+        name, rows = handle
+        try:
+            memory = shared_memory.SharedMemory(name=name, track=False)
+        except TypeError:
+            memory = shared_memory.SharedMemory(name=name)
+            # Before Python 3.13 every process that attaches registers
+            # the block with the resource tracker, which would remove
+            # it when that process ends, while others still use it.
+            if name not in published:
+                resource_tracker.unregister(memory._name, 'shared_memory')
+        return cls(memory, rows, False)
+
+    @property
+    def handle(self):
+        """The (small) tuple that workers need to attach to the table."""
+        return self.memory.name, self.rows
+
+    def find(self, name, day):
+        """return: the row for name and day, or None."""
+        key = table_key(name, day)
+        position = bisect_left(self.keys, key)
+        if position < self.rows and self.keys[position] == key:
+            return position
+        return None
+
+    def get(self, name, day, default=None):
+        """return: the value for name and day as a Decimal, or default."""
+        position = self.find(name, day)
+        if position is None:
+            return default
+        return from_parts(self.coefficients[position], self.exponents[position])
+
+    def close(self):
+        """Detaches from the block, and removes it if this is the owner."""
+        if self.memory is None:
+            return
+        self.keys.release()
+        self.coefficients.release()
+        self.exponents.release()
+        self.view.release()
+        self.memory.close()
+        if self.owner:
+            self.memory.unlink()
+            published.discard(self.memory.name)
+        self.memory = None
+        return
+
+    def __len__(self):
+        return self.rows
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exception):
+        self.close()
+        return False
+
+
+class CurrencyRates:
+    """The rates of one currency in a SharedTable, like a dict by date."""
+
+    def __init__(self, table, currency):
+        self.table = table
+        self.currency = currency
+        return
+
+    def __contains__(self, day):
+        return self.table.find(self.currency, day) is not None
+
+    def __getitem__(self, day):
+        rate = self.table.get(self.currency, day)
+        if rate is None:
+            raise KeyError(day)
+        return rate
+
+    def get(self, day, default=None):
+        return self.table.get(self.currency, day, default)
+
+
+class SharedFXRates:
+    """
+    A SharedTable of rates that can be used as FIF.fx_rates, i.e. as
+    fx_rates[currency][rate_date]. It cannot be changed.
+    """
+
+    def __init__(self, table):
+        self.table = table
+        return
+
+    def __contains__(self, currency):
+        return True
+        # Whether there is a rate is only known for a date.
+
+    def __getitem__(self, currency):
+        return CurrencyRates(self.table, currency)
+
+    def get(self, currency, default=None):
+        return CurrencyRates(self.table, currency)
+
+
+def publish_fx_rates(fx_rates):
+    """return: SharedTable with all rates in fx_rates (as in FIF.fx_rates)."""
+    return SharedTable.publish(((currency, rate_date), rate)
+                               for currency, rates in fx_rates.items()
+                               for rate_date, rate in (rates or {}).items())
+
+
+def publish_closing_prices(closing_prices, closing_date):
+    """
+    return: SharedTable with the price of each closing_price_info in
+        closing_prices, for closing_date.
+    """
+    return SharedTable.publish(((price_info.code, closing_date), price_info.price)
+                               for price_info in closing_prices)
+
+
+def attach(handle):
+    """
+    return: SharedTable for handle. A worker keeps the table it
+        attached to last, so tasks for the same table attach only
+        once.
+    """
+    name = handle[0]
+    if name not in attached:
+        for table in attached.values():
+            table.close()
+        attached.clear()
+        attached[name] = SharedTable.attach(handle)
+    return attached[name]
+
+
+def synthetic_fx_rates(size):
+    """return: fx_rates with size rates, for the benchmark."""
+    currencies = ['C{:03}'.format(number) for number in range(max(1, size // 3650))]
+    fx_rates = {currency: {} for currency in currencies}
+    first_day = date(2008, 1, 1)
+    for number in range(size):
+        fx_rates[currencies[number % len(currencies)]][
+            first_day + timedelta(days=number // len(currencies))] = \
+            '{:.4f}'.format(0.5 + number % 1000 / 2000)
+    return fx_rates
+
+
+def start_with_copy(fx_rates):
+    """Benchmark task: a worker that receives its own copy of fx_rates."""
+    started = perf_counter()
+    rates = pickle.loads(fx_rates)
+    return perf_counter() - started, len(rates)
+
+
+def start_with_table(handle):
+    """Benchmark task: a worker that attaches to a published table."""
+    started = perf_counter()
+    table = SharedTable.attach(handle)
+    rows = len(table)
+    table.close()
+    return perf_counter() - started, rows
+
+
+def benchmark(sizes, workers=4):
+    """
+    Measures the cost of starting a task in a worker, with fx_rates
+    pickled for the task and with an attached table, for stores with
+    each number of rates in sizes.
+
+    return: list of (size, seconds with a copy, seconds with a table)
+        tuples, with the mean over all workers. Pickling in the main
+        process is included for the copies.
+    """
+    results = []
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for size in sizes:
+            fx_rates = synthetic_fx_rates(size)
+            started = perf_counter()
+            pickled = pickle.dumps(fx_rates)
+            pickling = perf_counter() - started
+            copies = list(executor.map(start_with_copy, [pickled] * workers))
+            with publish_fx_rates(fx_rates) as table:
+                tables = list(executor.map(start_with_table, [table.handle] * workers))
+            results.append((size, pickling + sum(seconds for seconds, _ in copies) / workers,
+                            sum(seconds for seconds, _ in tables) / workers))
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark worker start-up with shared tables')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 100000, 1000000])
+    parser.add_argument('--workers', type=int, default=4)
+    args = parser.parse_args()
+    print('{:>12}{:>20}{:>20}'.format('rates', 'copy (ms)', 'shared table (ms)'))
+    for size, copy_seconds, table_seconds in benchmark(args.sizes, args.workers):
+        print('{:>12,}{:>20.3f}{:>20.3f}'.format(size, copy_seconds * 1000,
+                                                 table_seconds * 1000))
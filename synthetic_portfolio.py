@@ -0,0 +1,276 @@
+"""
+Generates synthetic, but internally consistent, input files for FIF.py.
+
+The files mimic the formats that FIF.py reads:
+- opening positions: csv with code, full_name, currency, holding and
+  closing_price (for the previous tax year);
+- trades: csv as exported by Interactive Brokers, with Header/Data rows
+  and sub-total rows that must be skipped;
+- dividends: csv as exported by Interactive Brokers;
+- closing prices: csv with code and price;
+- foreign exchange rates: a pickle file with the same nested dictionary
+  structure as saved_fx_rates.pickle.
+
+The generated portfolio never holds a negative number of shares, and
+dividends are always paid on the shares actually held on the payment
+date, so the files can be used both for benchmarks and for tests.
+
+The generator is deterministic for a given seed.
+"""
+
+from collections import namedtuple
+import csv
+from datetime import date, datetime, timedelta
+from decimal import Decimal, ROUND_HALF_UP
+import os.path
+import pickle
+import random
+
+
+CURRENCIES = ('USD', 'EUR', 'GBP', 'AUD', 'JPY')
+BASE_FX_RATES = {'USD': '0.7000', 'EUR': '0.6000', 'GBP': '0.5200', 'AUD': '0.9300',
+                 'JPY': '78.1000'}
+TRADES_FIELDS = ['Trades', 'Header', 'DataDiscriminator', 'Asset Category', 'Currency',
+                 'Symbol', 'Date/Time', 'Quantity', 'T. Price', 'C. Price', 'Proceeds',
+                 'Comm/Fee', 'Basis', 'Realized P/L', 'Code']
+DIVIDENDS_FIELDS = ['Currency', 'Date', 'Description', 'Amount']
+portfolio_files = namedtuple('portfolio_files',
+                             'opening, trades, dividends, closing, fx_rates')
+
+
+def tax_year_dates(tax_year):
+    """
+    return: (tuple with) the first and the last day of the tax period
+        ending on 31 March of tax_year.
+    """
+    return date(tax_year - 1, 4, 1), date(tax_year, 3, 31)
+
+
+def generate_fx_rates(tax_year, rng):
+    """
+    Creates foreign exchange rates for every currency in CURRENCIES, for
+    the 15th of every month in the tax period and for 31 March at the
+    start and the end of it.
+
+    input arguments:
+    tax_year: the year in which the tax period ends.
+    rng: an instance of random.Random.
+
+    return: a nested dictionary of fx_rates by currency and date, with
+        the rates as strings, in the same way as FIF.py stores them.
+    """
+    fx_rates = {}
+    rate_dates = [date(tax_year - 1, 3, 31), date(tax_year, 3, 31)]
+    first_day, last_day = tax_year_dates(tax_year)
+    month_start = first_day
+    while month_start <= last_day:
+        rate_dates.append(date(month_start.year, month_start.month, 15))
+        month_start = (month_start + timedelta(days=32)).replace(day=1)
+
+    for currency in CURRENCIES:
+        base = Decimal(BASE_FX_RATES[currency])
+        fx_rates[currency] = {}
+        for rate_date in rate_dates:
+            rate = (base * Decimal(str(rng.uniform(0.9, 1.1)))).quantize(
+                Decimal('0.0001'), ROUND_HALF_UP)
+            fx_rates[currency][rate_date] = str(rate)
+    return fx_rates
+
+
+def random_price(rng):
+    return Decimal(str(rng.uniform(1, 500))).quantize(Decimal('0.01'), ROUND_HALF_UP)
+
+
+def generate_portfolio(directory, tax_year=2018, number_of_shares=10, trades_per_share=10,
+                       dividends_per_share=4, seed=0, fills_per_trade=1):
+    """
+    Writes a complete set of synthetic input files into directory.
+
+    input arguments:
+    directory: an existing directory in which the files will be written.
+    tax_year: the year in which the tax period ends.
+    number_of_shares: the number of different shares in the portfolio.
+        About a quarter of those have a zero opening position and are
+        only acquired during the year.
+    trades_per_share: the number of trades (fills) for each share.
+    dividends_per_share: the number of dividend payments for each
+        share, as far as shares are held on the payment date.
+    seed: seed for the random number generator.
+    fills_per_trade: the maximum number of partial fills each trade is
+        split into, with the same date and time and slightly different
+        prices. With the default of 1, trades are not split.
+
+    return: a portfolio_files namedtuple with the names of the files
+        that were written.
+    """
+    rng = random.Random(seed)
+    first_day, last_day = tax_year_dates(tax_year)
+    days_in_year = (last_day - first_day).days
+    files = portfolio_files(
+        opening=os.path.join(directory, 'opening_positions.csv'),
+        trades=os.path.join(directory, 'trades.csv'),
+        dividends=os.path.join(directory, 'dividends.csv'),
+        closing=os.path.join(directory, 'closing_prices.csv'),
+        fx_rates=os.path.join(directory, 'fx_rates.pickle'))
+
+    opening_rows = []
+    trade_rows = []
+    dividend_rows = []
+    closing_rows = []
+
+    for number in range(number_of_shares):
+        code = 'S{:05d}'.format(number)
+        currency = CURRENCIES[number % len(CURRENCIES)]
+        if number % 4 == 3:
+            holding = 0
+            # Shares that are only acquired during the year. They are
+            # still listed with a zero opening position, so that FIF.py
+            # does not need to prompt for their currency and name.
+        else:
+            holding = rng.randint(1, 100) * 10
+        opening_rows.append({'code': code, 'full_name': 'Synthetic share ' + code,
+                             'currency': currency, 'holding': holding,
+                             'closing_price': random_price(rng)})
+
+        trade_moments = sorted(
+            datetime.combine(first_day, datetime.min.time()) +
+            timedelta(days=rng.randrange(days_in_year), hours=9, seconds=rng.randrange(25200))
+            for _ in range(trades_per_share))
+        dividend_days = sorted(first_day + timedelta(days=rng.randrange(days_in_year))
+                               for _ in range(dividends_per_share))
+        per_share = Decimal(str(rng.uniform(0.05, 2))).quantize(Decimal('0.0001'))
+
+        # Walk through trades and dividends together, so that we always
+        # know the holding on the payment date of a dividend.
+        for moment in trade_moments:
+            while dividend_days and dividend_days[0] <= moment.date():
+                dividend_rows.append(dividend_row(code, currency, dividend_days.pop(0),
+                                                  per_share, holding))
+
+            if holding > 0 and rng.random() < 0.4:
+                quantity = -rng.randint(1, holding)
+            else:
+                quantity = rng.randint(1, 100)
+            holding += quantity
+            price = random_price(rng)
+            commission = -Decimal(str(rng.uniform(0.5, 5))).quantize(Decimal('0.01'))
+            for fill_quantity, fill_price, fill_commission in split_into_fills(
+                    quantity, price, commission, fills_per_trade, rng):
+                trade_rows.append({'Trades': 'Trades', 'Header': 'Data',
+                                   'DataDiscriminator': 'Order', 'Asset Category': 'Stocks',
+                                   'Currency': currency, 'Symbol': code,
+                                   'Date/Time': moment.strftime('%Y-%m-%d, %H:%M:%S'),
+                                   'Quantity': fill_quantity, 'T. Price': fill_price,
+                                   'C. Price': fill_price,
+                                   'Proceeds': -fill_quantity * fill_price,
+                                   'Comm/Fee': fill_commission, 'Basis': '',
+                                   'Realized P/L': '', 'Code': 'O'})
+
+        for dividend_day in dividend_days:
+            dividend_rows.append(dividend_row(code, currency, dividend_day, per_share,
+                                              holding))
+
+        closing_rows.append({'code': code, 'price': random_price(rng)})
+
+    trade_rows.sort(key=lambda row: row['Date/Time'])
+    trade_rows.append({'Trades': 'Trades', 'Header': 'SubTotal', 'Date/Time': '',
+                       'Symbol': '', 'Quantity': '', 'T. Price': '', 'Comm/Fee': ''})
+    dividend_rows = sorted((row for row in dividend_rows if row is not None),
+                           key=lambda row: row['Date'])
+
+    write_csv(files.opening, ['code', 'full_name', 'currency', 'holding', 'closing_price'],
+              opening_rows)
+    write_csv(files.trades, TRADES_FIELDS, trade_rows)
+    write_csv(files.dividends, DIVIDENDS_FIELDS, dividend_rows)
+    write_csv(files.closing, ['code', 'price'], closing_rows)
+    with open(files.fx_rates, 'wb') as fx_rates_file:
+        pickle.dump(generate_fx_rates(tax_year, rng), fx_rates_file)
+
+    return files
+
+
+def split_into_fills(quantity, price, commission, fills_per_trade, rng):
+    """
+    return: list of (quantity, price, commission) tuples for the
+        partial fills of a trade, at most fills_per_trade of them. The
+        quantities add up to quantity; prices differ by a few cents.
+    """
+    number_of_fills = min(abs(quantity), rng.randint(1, fills_per_trade)) \
+        if fills_per_trade > 1 else 1
+    if number_of_fills == 1:
+        return [(quantity, price, commission)]
+        # No random numbers are drawn, so portfolios without partial
+        # fills stay the same for a given seed.
+    sign = 1 if quantity > 0 else -1
+    cuts = sorted(rng.sample(range(1, abs(quantity)), number_of_fills - 1))
+    sizes = [end - start for start, end in zip([0] + cuts, cuts + [abs(quantity)])]
+    fill_commission = (commission / number_of_fills).quantize(Decimal('0.01'))
+    return [(sign * size, max(price + Decimal(rng.randint(-5, 5)) / 100, Decimal('0.01')),
+             fill_commission) for size in sizes]
+
+
+def dividend_row(code, currency, date_paid, per_share, holding):
+    """
+    return: a dict for a row in the dividends csv file, or None if no
+        shares are held on the payment date.
+    """
+    if holding == 0:
+        return None
+    amount = (per_share * holding).quantize(Decimal('0.01'), ROUND_HALF_UP)
+    description = '{}(US{}) Cash Dividend {} {} per Share (Ordinary Dividend)'.format(
+        code, code[1:].rjust(10, '0'), currency, per_share)
+    return {'Currency': currency, 'Date': date_paid.isoformat(),
+            'Description': description, 'Amount': amount}
+
+
+def write_csv(filename, fieldnames, rows):
+    with open(filename, 'w', newline='') as csv_file:
+        writer = csv.DictWriter(csv_file, fieldnames=fieldnames, restval='')
+        writer.writeheader()
+        writer.writerows(rows)
+    return
+
+
+def write_activity_statement(files, filename):
+    """
+    Combines the trades, dividends and closing prices of a generated
+    portfolio into a single activity statement, in the multi-section
+    format of Interactive Brokers, with a few other sections that
+    FIF.py does not need.
+
+    input arguments:
+    files: a portfolio_files namedtuple as returned by
+        generate_portfolio.
+    filename: the name of the activity statement file to write.
+
+    return: None
+    """
+    with open(files.trades, newline='') as trades_file:
+        trade_rows = list(csv.reader(trades_file))
+    with open(files.dividends, newline='') as dividends_file:
+        dividend_rows = list(csv.reader(dividends_file))
+    with open(files.closing, newline='') as closing_file:
+        closing_rows = list(csv.DictReader(closing_file))
+
+    with open(filename, 'w', newline='') as statement_file:
+        writer = csv.writer(statement_file)
+        writer.writerow(['Statement', 'Header', 'Field Name', 'Field Value'])
+        writer.writerow(['Statement', 'Data', 'Title', 'Activity Statement'])
+        writer.writerow(['Account Information', 'Header', 'Field Name', 'Field Value'])
+        writer.writerow(['Account Information', 'Data', 'Base Currency', 'NZD'])
+        writer.writerows(trade_rows)
+        # The separate trades file already has the section name and
+        # the Header/Data column.
+        writer.writerow(['Dividends', 'Header'] + dividend_rows[0])
+        for row in dividend_rows[1:]:
+            writer.writerow(['Dividends', 'Data'] + row)
+        writer.writerow(['Dividends', 'Data', 'Total', '', '', '0'])
+        writer.writerow(['Open Positions', 'Header', 'DataDiscriminator', 'Asset Category',
+                         'Currency', 'Symbol', 'Quantity', 'Mult', 'Cost Price', 'Cost Basis',
+                         'Close Price', 'Value', 'Unrealized P/L', 'Code'])
+        for row in closing_rows:
+            writer.writerow(['Open Positions', 'Data', 'Summary', 'Stocks', '', row['code'],
+                             '', '1', '', '', row['price'], '', '', ''])
+        writer.writerow(['Open Positions', 'Total', '', 'Stocks', '', '', '', '', '', '', '',
+                         '', '', ''])
+    return
@@ -1,14 +1,58 @@
 """unit tests for FIF.py"""
 
 from FIF import *
+import FIF
+import benchmark_FIF
+import fif_service
+import fx_providers
+import watch_FIF
+import profile_FIF
+from holdings import HoldingsTimeline, ShareLots, build_holdings_timelines, reconcile_dividends
+import synthetic_portfolio
+from securities_master import SecuritiesMaster, load_securities_master, save_securities_master
+import columnar
+import mapped_csv
+import scenarios
+import projection
+import de_minimis
+import corporate_actions
+import shared_tables
+import price_history
+import preflight
+import audit_FIF
+import share_results
 import unittest
 from unittest import mock
 from unittest.mock import patch, MagicMock
 import io
+import asyncio
+import csv
+import json
+from contextlib import redirect_stdout
 from decimal import Decimal, ROUND_HALF_UP, ROUND_DOWN, getcontext
 from collections import namedtuple
-from datetime import date
+from fractions import Fraction
+from datetime import date, datetime, timedelta
+from operator import attrgetter
+import random
+import os
 import sys
+import tempfile
+import threading
+import http.server
+import time
+import cProfile
+import pstats
+import tracemalloc
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 
 class TestShare(unittest.TestCase):
@@ -546,6 +590,211 @@ class TestSaveClosingPositions(unittest.TestCase):
         pass
 
 
+class TestHoldingsTimeline(unittest.TestCase):
+
+    def setUp(self):
+        self.trades = [Trade('EMB', datetime(2017, 6, 1, 10), '100', '90'),
+                       Trade('EMB', datetime(2017, 5, 1, 10), '-40', '91'),
+                       Trade('EMB', datetime(2017, 6, 1, 10), '-150', '92'),
+                       Trade('EMB', datetime(2018, 1, 5, 15), '25', '93')]
+        self.timeline = HoldingsTimeline('100', self.trades)
+
+    def test_holding_at(self):
+        self.assertEqual(self.timeline.holding_at(date(2017, 4, 30)), Decimal('100'))
+        self.assertEqual(self.timeline.holding_at(date(2017, 5, 1)), Decimal('60'))
+        self.assertEqual(self.timeline.holding_at(datetime(2017, 6, 1, 10)), Decimal('10'))
+        self.assertEqual(self.timeline.holding_at(date(2018, 3, 31)), Decimal('35'))
+        self.assertEqual(self.timeline.closing_holding, Decimal('35'))
+
+    def test_holding_before(self):
+        self.assertEqual(self.timeline.holding_before(date(2017, 6, 1)), Decimal('60'))
+        self.assertEqual(self.timeline.holding_before(date(2017, 6, 2)), Decimal('10'))
+
+    def test_peak_and_min(self):
+        self.assertEqual(self.timeline.peak_in_interval(), Decimal('160'))
+        # The intermediate holding between two trades at the same moment
+        self.assertEqual(self.timeline.min_in_interval(), Decimal('10'))
+        self.assertEqual(self.timeline.peak_in_interval(date(2017, 6, 2)), Decimal('35'))
+        self.assertEqual(self.timeline.min_in_interval(None, date(2017, 5, 31)),
+                         Decimal('60'))
+        self.assertEqual(self.timeline.peak_in_interval(include_start=False), Decimal('160'))
+        self.assertIsNone(self.timeline.peak_in_interval(date(2018, 2, 1),
+                                                         include_start=False))
+
+    def test_against_replay(self):
+        rng = random.Random(1)
+        trades = [Trade('X', datetime(2017, 4, 1) + timedelta(hours=rng.randrange(8000)),
+                        rng.randint(-50, 60), '1') for _ in range(200)]
+        timeline = HoldingsTimeline('500', trades)
+        replay = [Decimal('500')]
+        for trade in sorted(trades, key=attrgetter('date_time')):
+            replay.append(replay[-1] + trade.number_of_shares)
+        self.assertEqual(timeline.peak_in_interval(), max(replay))
+        self.assertEqual(timeline.min_in_interval(), min(replay))
+        self.assertEqual(timeline.closing_holding, replay[-1])
+
+    def test_build_for_shares(self):
+        timelines = build_holdings_timelines([Share('EMB', opening_holding='100'),
+                                              Share('VEU')], self.trades)
+        self.assertEqual(timelines['EMB'].closing_holding, Decimal('35'))
+        self.assertEqual(timelines['VEU'].closing_holding, Decimal('0'))
+
+
+class TestReconcileDividends(unittest.TestCase):
+
+    def setUp(self):
+        trades = [Trade('EMB', datetime(2017, 6, 1, 10), '100', '90'),
+                  Trade('EMB', datetime(2017, 9, 1, 10), '-50', '91')]
+        self.timelines = build_holdings_timelines([Share('EMB', opening_holding='200')],
+                                                  trades)
+
+    def test_matching_dividends(self):
+        dividends = [Dividend('EMB', date(2017, 6, 1), '0.5', '100'),
+                     Dividend('EMB', date(2017, 7, 1), '0.5', '150'),
+                     Dividend('EMB', date(2018, 1, 1), '0.5', '125.2')]
+        self.assertEqual(reconcile_dividends(dividends, self.timelines), [])
+
+    def test_discrepancies(self):
+        missed = Dividend('EMB', date(2017, 9, 2), '0.5', '150')
+        unknown = Dividend('VEU', date(2017, 9, 2), '0.5', '150')
+        result = reconcile_dividends([unknown, missed], self.timelines)
+        self.assertEqual(result, [(missed, Decimal('250'), Decimal('50')),
+                                  (unknown, None, None)])
+        self.assertEqual(reconcile_dividends([missed], self.timelines, Decimal('60')), [])
+
+
+class TestCorporateActions(unittest.TestCase):
+
+    def setUp(self):
+        self.saved_globals = (FIF.tax_year, FIF.fx_rates, FIF.corporate_actions)
+        FIF.tax_year = 2018
+        FIF.fx_rates = {'USD': {date(2017, 5, 15): '0.5000', date(2017, 6, 15): '0.5000',
+                                date(2017, 7, 15): '0.5000'}}
+        self.index = corporate_actions.CorporateActionIndex([
+            corporate_actions.CorporateAction('AAA', date(2017, 6, 1), 'split', '2'),
+            corporate_actions.CorporateAction('AAA', date(2016, 6, 1), 'consolidation', '1',
+                                              '10'),
+            corporate_actions.CorporateAction('AAA', date(2017, 12, 1), 'split', '3')])
+
+    def test_factors(self):
+        self.assertEqual(self.index.factor('AAA', date(2017, 3, 31), date(2018, 3, 31)), 6)
+        self.assertEqual(self.index.factor('AAA', datetime(2017, 6, 1, 10),
+                                           date(2018, 3, 31)), 3)
+        self.assertEqual(self.index.factor('AAA', date(2017, 5, 31), date(2017, 6, 1)), 2)
+        self.assertEqual(self.index.factor('AAA', date(2018, 3, 31), date(2017, 3, 31)),
+                         Fraction(1, 6))
+        self.assertEqual(self.index.factor('BBB', date(2017, 3, 31), date(2018, 3, 31)), 1)
+        self.assertEqual(self.index.adjusted_holding('AAA', '100', date(2017, 3, 31),
+                                                     date(2018, 3, 31)), Decimal('600'))
+        self.assertEqual(self.index.adjusted_price('AAA', '9.00', date(2017, 3, 31),
+                                                   date(2018, 3, 31)), Decimal('1.5'))
+        self.assertFalse(self.index.has_actions('AAA', date(2017, 12, 1), date(2018, 3, 31)))
+
+    def test_read_corporate_actions(self):
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, 'actions.csv')
+            with open(filename, 'w', newline='') as actions_file:
+                actions_file.write('code,date,kind,new_shares,old_shares\n'
+                                   'AAA,2017-06-01,split,2,1\nAAA,2017-12-01,split,3,\n')
+            index = corporate_actions.read_corporate_actions(filename)
+        self.assertEqual(len(index), 2)
+        self.assertEqual(index.factor('AAA', date(2017, 3, 31), date(2018, 3, 31)), 6)
+        with self.assertRaises(ValueError):
+            corporate_actions.CorporateAction('AAA', date(2017, 6, 1), 'merger', '2')
+
+    def quick_sale_adjustment(self, trades, dividends):
+        share = Share('AAA', 'A', 'USD', '100', '10.00')
+        with redirect_stdout(io.StringIO()):
+            process_trades([share], trades)
+            timelines = build_holdings_timelines([share], trades, FIF.corporate_actions,
+                                                 FIF.previous_closing_date(), FIF.closing_date())
+            discrepancies = reconcile_dividends(dividends, timelines, Decimal('0.5'),
+                                                FIF.corporate_actions, FIF.closing_date())
+            adjustment = calc_QSA(share, trades, dividends, timelines['AAA'])
+        return share, discrepancies, adjustment
+
+    def test_split_during_the_year(self):
+        unsplit = self.quick_sale_adjustment(
+            [Trade('AAA', datetime(2017, 5, 1, 10), '100', '10.00'),
+             Trade('AAA', datetime(2017, 7, 1, 10), '-100', '12.00')],
+            [Dividend('AAA', date(2017, 6, 20), '1.00', '200.00')])
+        FIF.corporate_actions = corporate_actions.CorporateActionIndex([
+            corporate_actions.CorporateAction('AAA', date(2017, 6, 1), 'split', '2')])
+        trades = [Trade('AAA', datetime(2017, 5, 1, 10), '100', '10.00'),
+                  Trade('AAA', datetime(2017, 7, 1, 10), '-200', '6.00')]
+        share, discrepancies, adjustment = self.quick_sale_adjustment(
+            trades, [Dividend('AAA', date(2017, 6, 20), '0.50', '200.00')])
+        self.assertEqual(share.holding, Decimal('200'))
+        self.assertEqual(unsplit[0].holding, Decimal('100'))
+        self.assertEqual(discrepancies, [])
+        self.assertEqual(unsplit[1], [])
+        self.assertEqual(adjustment, unsplit[2])
+        self.assertTrue(adjustment > Decimal('0.00'))
+        self.assertEqual(trades[1].quick_sale_portion, Decimal('200'))
+        self.assertEqual(trades[0].number_of_shares, Decimal('100'))
+
+    def tearDown(self):
+        FIF.tax_year, FIF.fx_rates, FIF.corporate_actions = self.saved_globals
+
+
+class TestShareLots(unittest.TestCase):
+
+    def setUp(self):
+        self.saved_globals = (FIF.tax_year, FIF.fx_rates)
+        FIF.tax_year = 2018
+        FIF.fx_rates = {'USD': {date(2017, 5, 15): '0.5000', date(2017, 6, 15): '0.5000',
+                                date(2017, 7, 15): '0.5000', date(2017, 8, 15): '0.5000'}}
+        self.share = Share('AAA', 'A', 'USD', '100', '10.00')
+        self.trades = [Trade('AAA', datetime(2017, 5, 1, 10), '40', '10.00'),
+                       Trade('AAA', datetime(2017, 6, 1, 10), '60', '12.50'),
+                       Trade('AAA', datetime(2017, 7, 1, 10), '-70', '11.00'),
+                       Trade('AAA', datetime(2017, 8, 1, 10), '-80', '11.00')]
+
+    def test_fifo_with_split_lot(self):
+        lots = ShareLots('100')
+        portions = [lots.add_trade(trade, trade.charge * 2) for trade in self.trades]
+        self.assertEqual(portions, [None, None, Decimal('70'), Decimal('30')])
+        # The first sale uses up the first lot and 30 of the second; the
+        # second sale the rest of it, and 50 shares of the opening holding.
+        self.assertEqual(len(lots.lots), 0)
+        self.assertEqual(lots.opening_remaining, Decimal('50'))
+        self.assertEqual(lots.real_holding, Decimal('50'))
+        self.assertEqual(lots.quick_sale_shares, Decimal('100'))
+        self.assertEqual(lots.average_cost(), Decimal('2300.00') / Decimal('100'))
+
+    def test_partly_used_lot(self):
+        lots = ShareLots('0')
+        for trade in self.trades[:3]:
+            lots.add_trade(trade, trade.charge * 2)
+        self.assertEqual(len(lots.lots), 1)
+        self.assertEqual(lots.lots[0].remaining, Decimal('30'))
+        self.assertEqual(lots.remaining_cost(), Decimal('750.00'))
+
+    def test_quasi_trades_are_ignored(self):
+        lots = ShareLots('100')
+        self.assertIsNone(lots.add_trade(Trade('AAA', datetime(2017, 5, 1), '100', '0'),
+                                         Decimal('0.00')))
+        self.assertEqual(lots.real_holding, Decimal('100'))
+        self.assertEqual(lots.trade_count, 1)
+        self.assertIsNone(lots.average_cost())
+
+    def test_process_trades_sets_up_lots(self):
+        with redirect_stdout(io.StringIO()):
+            process_trades([self.share], self.trades)
+        self.assertEqual(self.share.lots.trade_count, 4)
+        self.assertEqual([trade.quick_sale_portion for trade in self.trades],
+                         [None, None, Decimal('70'), Decimal('30')])
+        with redirect_stdout(io.StringIO()):
+            from_lots = calc_QSA(self.share, self.trades, [])
+        self.share.lots = None
+        with redirect_stdout(io.StringIO()):
+            rebuilt = calc_QSA(self.share, self.trades, [])
+        self.assertEqual(from_lots, rebuilt)
+
+    def tearDown(self):
+        FIF.tax_year, FIF.fx_rates = self.saved_globals
+
+
 class TestGetNewShareNameAndCurrency(unittest.TestCase):
 
     def setUp(self):
@@ -567,6 +816,65 @@ class TestGetNewShareNameAndCurrency(unittest.TestCase):
         self.assertEqual(values[1], 'USD')
 
 
+class TestSecuritiesMaster(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.saved_globals = (FIF.securities, FIF.fx_rates, FIF.tax_year)
+        FIF.securities = SecuritiesMaster()
+        FIF.tax_year = 2018
+        FIF.securities.add('VEU', 'Vanguard All World ex US', 'USD')
+        self.moment = datetime(2017, 6, 1, 10, 0, 0)
+
+    def test_save_and_load(self):
+        filename = os.path.join(self.directory.name, 'master.pickle')
+        FIF.securities.add('VEU', '', '', 'US9220427754')
+        save_securities_master(FIF.securities, filename)
+        master = load_securities_master(filename)
+        self.assertEqual(master.lookup('VEU').isin, 'US9220427754')
+        self.assertEqual(master.lookup('VEU').currency, 'USD')
+        self.assertEqual(master.code_for_isin('US9220427754'), 'VEU')
+        self.assertFalse(master.changed)
+        self.assertEqual(len(load_securities_master(filename + '.missing')), 0)
+
+    def test_add_new_shares_from_master(self):
+        shares = [Share('EMB', 'emb', 'USD')]
+        trades = [Trade('VEU', self.moment, '10', '50.00'),
+                  Trade('EMB', self.moment, '10', '50.00'),
+                  Trade('VEU', self.moment, '5', '50.00')]
+        with mock.patch('builtins.input', side_effect=AssertionError('no prompt expected')):
+            add_new_shares(shares, trades)
+        self.assertEqual([(share.code, share.currency) for share in shares],
+                         [('EMB', 'USD'), ('VEU', 'USD')])
+
+    def test_unknown_shares_asked_in_one_batch(self):
+        FIF.fx_rates = {'USD': {}, 'EUR': {}}
+        shares = []
+        trades = [Trade('NEW1', self.moment, '10', '50.00'),
+                  Trade('VEU', self.moment, '10', '50.00'),
+                  Trade('NEW2', self.moment, '10', '50.00')]
+        output = io.StringIO()
+        with mock.patch('builtins.input', side_effect=['EUR', 'new one', 'USD', 'new two']), \
+                redirect_stdout(output):
+            add_new_shares(shares, trades)
+        self.assertIn('not yet in the system: NEW1, NEW2', output.getvalue())
+        self.assertEqual([share.code for share in shares], ['NEW1', 'VEU', 'NEW2'])
+        self.assertEqual(FIF.securities.lookup('NEW1').currency, 'EUR')
+        self.assertEqual(FIF.securities.lookup('NEW2').full_name, 'new two')
+
+    def test_isin_from_dividend(self):
+        dividend = dividend_from_row({'Currency': 'USD', 'Date': '2017-06-01',
+                                      'Description': 'VEU(US9220427754) Cash Dividend USD ' +
+                                                     '0.25 per Share', 'Amount': '25.00'})
+        self.assertEqual(dividend.isin, 'US9220427754')
+        update_securities_master([], [dividend])
+        self.assertEqual(FIF.securities.code_for_isin('US9220427754'), 'VEU')
+
+    def tearDown(self):
+        FIF.securities, FIF.fx_rates, FIF.tax_year = self.saved_globals
+        self.directory.cleanup()
+
+
 class TestCalcComparativeValueIncome(unittest.TestCase):
 
     def test_returns(self):
@@ -580,6 +888,1281 @@ class TestCalcComparativeValueIncome(unittest.TestCase):
         # by test above
 
 
+class TestPrintFIFIncome(unittest.TestCase):
+
+    def test_negative_CV_income(self):
+        with redirect_stdout(io.StringIO()):
+            FIF_income = print_FIF_income(Decimal('-10.00'), Decimal('25.00'))
+        self.assertEqual(FIF_income, Decimal('0.00'))
+        self.assertIsInstance(FIF_income, Decimal)
+        self.assertEqual(str(FIF_income), '0.00')
+
+
+class TestRunStatistics(unittest.TestCase):
+
+    def setUp(self):
+        self.saved_globals = (FIF.fx_rates, FIF.securities)
+
+    def tearDown(self):
+        FIF.run_stats = None
+        FIF.fx_rates, FIF.securities = self.saved_globals
+
+    def test_run_stage_without_statistics(self):
+        FIF.run_stats = None
+        self.assertEqual(run_stage(sorted, [2, 1]), [1, 2])
+
+    def test_run_stage_with_statistics(self):
+        FIF.run_stats = RunStatistics()
+        run_stage(sorted, [2, 1, 3])
+        run_stage(sorted, [2, 1, 3])
+        run_stage(sum, [2, 1], rows=2)
+        summary = FIF.run_stats.summary()
+        self.assertEqual(summary['stages']['sorted']['calls'], 2)
+        self.assertEqual(summary['stages']['sorted']['rows'], 6)
+        self.assertEqual(summary['stages']['sum']['rows'], 2)
+        json.dumps(summary)
+        # Must be convertible to JSON.
+
+    def test_fx_counters(self):
+        FIF.run_stats = RunStatistics()
+        FIF.fx_rates = {'USD': {date(2018, 3, 31): '0.7000'}}
+        FX_rate('USD', date(2018, 3, 31))
+        with mock.patch('builtins.input', side_effect=['0.7100']):
+            FX_rate('USD', date(2018, 2, 3))
+        self.assertEqual(FIF.run_stats.counters, {'fx_lookups': 2, 'fx_cache_misses': 1})
+
+    def test_main_resets_statistics(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        stats_file = os.path.join(directory.name, 'stats.json')
+
+        def get_fx_rates(fx_rates, filename):
+            raise MissingFXRateError('no rate')
+        with mock.patch.object(FIF, 'get_fx_rates', get_fx_rates):
+            with self.assertRaises(MissingFXRateError):
+                main(stats_file=stats_file)
+        self.assertIsNone(FIF.run_stats)
+        self.assertTrue(os.path.isfile(stats_file))
+
+        def load_input_files(statement_file):
+            return [], [], [], []
+        with mock.patch.object(FIF, 'get_fx_rates', lambda fx_rates, filename: {}), \
+                mock.patch.object(FIF, 'load_securities_master',
+                                  lambda filename: SecuritiesMaster()), \
+                mock.patch.object(FIF, 'load_input_files', load_input_files):
+            self.assertEqual(main(stats_file=stats_file, check_only=True,
+                                  actions=corporate_actions.CorporateActionIndex(),
+                                  price_history=directory.name), [])
+        self.assertIsNone(FIF.run_stats)
+        self.assertIsNone(FIF.corporate_actions)
+        self.assertIsNone(FIF.price_history_directory)
+        with open(stats_file) as saved:
+            self.assertIn('load_input_files', json.load(saved)['stages'])
+
+
+class TestProfiling(unittest.TestCase):
+
+    def test_collapsed_stacks(self):
+        def inner():
+            return sum(Decimal(number) for number in range(20000))
+
+        def outer():
+            return inner()
+
+        profiler = cProfile.Profile()
+        profiler.runcall(outer)
+        stacks = profile_FIF.collapsed_stacks(pstats.Stats(profiler))
+        self.assertTrue(all(isinstance(value, int) for value in stacks.values()))
+        self.assertTrue(any('(outer);' in path and '(inner)' in path for path in stacks))
+
+    def test_allocations_per_stage(self):
+        statistics = RunStatistics(allocation_top=3)
+        tracemalloc.start()
+        try:
+            statistics.run('build', lambda: [Decimal(number) for number in range(1000)], ())
+        finally:
+            tracemalloc.stop()
+        allocations = statistics.summary()['allocations']['build']
+        self.assertLessEqual(len(allocations), 3)
+        self.assertGreater(allocations[0]['size'], 0)
+
+
+class TestSyntheticPortfolio(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.files = synthetic_portfolio.generate_portfolio(self.directory.name, 2018, 8, 5, 2)
+        self.saved_globals = (FIF.testing, FIF.tax_year, FIF.opening_test_file,
+                              FIF.trades_test_file, FIF.dividends_test_file)
+        FIF.testing = True
+        FIF.tax_year = 2018
+        FIF.opening_test_file = self.files.opening
+        FIF.trades_test_file = self.files.trades
+        FIF.dividends_test_file = self.files.dividends
+
+    def test_files_can_be_read(self):
+        self.assertEqual(len(FIF.get_opening_positions()), 8)
+        self.assertEqual(len(FIF.get_trades()), 40)
+        # The SubTotal row must be skipped.
+        self.assertTrue(all(dividend.eligible_shares > 0 for dividend in FIF.get_dividends()))
+
+    def test_deterministic(self):
+        with open(self.files.trades) as trades_file:
+            first = trades_file.read()
+        synthetic_portfolio.generate_portfolio(self.directory.name, 2018, 8, 5, 2)
+        with open(self.files.trades) as trades_file:
+            self.assertEqual(trades_file.read(), first)
+
+    def test_fx_rates_cover_tax_year(self):
+        fx_rates = get_fx_rates({}, self.files.fx_rates)
+        self.assertIn(date(2017, 3, 31), fx_rates['USD'])
+        self.assertIn(date(2018, 3, 15), fx_rates['EUR'])
+
+    def tearDown(self):
+        (FIF.testing, FIF.tax_year, FIF.opening_test_file, FIF.trades_test_file,
+         FIF.dividends_test_file) = self.saved_globals
+        self.directory.cleanup()
+
+
+class TestParallelQSA(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.files = synthetic_portfolio.generate_portfolio(self.directory.name, 2018, 12, 8, 3)
+        self.saved_globals = (FIF.testing, FIF.tax_year, FIF.fx_rates, FIF.opening_test_file,
+                              FIF.trades_test_file, FIF.dividends_test_file)
+        FIF.testing = True
+        FIF.tax_year = 2018
+        FIF.opening_test_file = self.files.opening
+        FIF.trades_test_file = self.files.trades
+        FIF.dividends_test_file = self.files.dividends
+
+    def run_FDR(self, workers):
+        FIF.fx_rates = get_fx_rates({}, self.files.fx_rates)
+        output = io.StringIO()
+        with redirect_stdout(output):
+            shares = FIF.get_opening_positions()
+            FIF.process_opening_positions(shares)
+            trades = FIF.get_trades()
+            any_quick_sale_adjustment = FIF.process_trades(shares, trades)[1]
+            dividends = FIF.get_dividends()
+            FDR_income = FIF.determine_FDR_income(Decimal('0.00'), any_quick_sale_adjustment,
+                                                  shares, trades, dividends, workers)
+        return (FDR_income, output.getvalue(),
+                [share.quick_sale_adjustment for share in shares],
+                [trade.quick_sale_portion for trade in trades])
+
+    def test_same_as_serial(self):
+        serial = self.run_FDR(None)
+        self.assertGreater(serial[0], 0)
+        self.assertEqual(self.run_FDR(3), serial)
+
+    def tearDown(self):
+        (FIF.testing, FIF.tax_year, FIF.fx_rates, FIF.opening_test_file, FIF.trades_test_file,
+         FIF.dividends_test_file) = self.saved_globals
+        self.directory.cleanup()
+
+
+class TestSharedTables(unittest.TestCase):
+
+    def setUp(self):
+        self.saved_fx_rates = FIF.fx_rates
+        self.fx_rates = {'USD': {date(2017, 5, 15): '0.7254', date(2017, 6, 15): '0.700000'},
+                         'AUD': {date(2017, 5, 15): Decimal('0.9321')}, 'EUR': None}
+        self.table = shared_tables.publish_fx_rates(self.fx_rates)
+        self.addCleanup(self.table.close)
+
+    def test_exact_values(self):
+        self.assertEqual(len(self.table), 3)
+        self.assertEqual(str(self.table.get('USD', date(2017, 6, 15))), '0.700000')
+        self.assertEqual(self.table.get('AUD', date(2017, 5, 15)), Decimal('0.9321'))
+        self.assertIsNone(self.table.get('AUD', date(2017, 6, 15)))
+        self.assertIsNone(self.table.get('EUR', date(2017, 5, 15)))
+
+    def test_attached_table_as_fx_rates(self):
+        attached = shared_tables.SharedTable.attach(self.table.handle)
+        self.addCleanup(attached.close)
+        with self.assertRaises(TypeError):
+            attached.keys[0] = 0
+        FIF.fx_rates = shared_tables.SharedFXRates(attached)
+        self.assertEqual(FX_rate('USD', date(2017, 5, 2)), Decimal('0.7254'))
+        self.assertNotIn(date(2017, 7, 15), FIF.fx_rates['USD'])
+
+    def test_attach_in_worker(self):
+        with ProcessPoolExecutor(max_workers=1) as executor:
+            self.assertEqual(executor.submit(shared_tables.start_with_table,
+                                             self.table.handle).result()[1], 3)
+        self.assertEqual(self.table.get('USD', date(2017, 5, 15)), Decimal('0.7254'))
+
+    def test_closing_prices(self):
+        with shared_tables.publish_closing_prices([closing_price_info('VEU', '52.17')],
+                                                  date(2018, 3, 31)) as table:
+            self.assertEqual(table.get('VEU', date(2018, 3, 31)), Decimal('52.17'))
+
+    def tearDown(self):
+        FIF.fx_rates = self.saved_fx_rates
+
+
+class TestPriceHistory(unittest.TestCase):
+
+    def setUp(self):
+        self.saved_globals = (FIF.tax_year, FIF.fx_rates, FIF.price_history_directory)
+        FIF.tax_year = 2018
+        FIF.fx_rates = {'USD': {date(2018, 3, 31): '0.5000'}}
+        self.directory = tempfile.TemporaryDirectory()
+        self.history = price_history.PriceHistory(self.directory.name)
+        self.addCleanup(self.history.close)
+        filename = os.path.join(self.directory.name, 'prices.csv')
+        with open(filename, 'w', newline='') as prices_file:
+            prices_file.write('code,date,price\nVEU,2018-03-31,52.17\nVEU,2017-03-31,48.5\n'
+                              'BRK/B,2018-03-31,199.480\nEMB,2018-01-31,101.10\n')
+        self.assertEqual(self.history.import_csv(filename), 4)
+        self.assertEqual(self.history.import_csv(filename), 0)
+
+    def test_lookups(self):
+        self.assertEqual(self.history.codes(), ['BRK/B', 'EMB', 'VEU'])
+        self.assertEqual(self.history.prices_on(date(2018, 3, 31)),
+                         {'BRK/B': Decimal('199.480'), 'VEU': Decimal('52.17')})
+        self.assertEqual(str(self.history.price_on('BRK/B', date(2018, 3, 31))), '199.480')
+        self.assertIsNone(self.history.price_on('VEU', date(2017, 12, 31)))
+        self.assertEqual(self.history.price_on('VEU', date(2017, 12, 31), exact=False),
+                         Decimal('48.5'))
+        self.assertIsNone(self.history.price_on('VEU', date(2017, 1, 31), exact=False))
+
+    def test_append_only(self):
+        self.assertEqual(self.history.append([('VEU', date(2018, 4, 30), '53.00')]), 1)
+        self.assertEqual(self.history.price_on('VEU', date(2018, 4, 30)), Decimal('53.00'))
+        with self.assertRaises(price_history.PriceHistoryError):
+            self.history.append([('VEU', date(2017, 12, 31), '50.00')])
+        with self.assertRaises(price_history.PriceHistoryError):
+            self.history.append([('VEU', date(2018, 3, 31), '52.18')])
+        with self.assertRaises(price_history.PriceHistoryError):
+            self.history.append([('VEU', date(2018, 3, 31), '52.18')], replace_last=True)
+        self.assertEqual(self.history.append([('VEU', date(2018, 4, 30), '53.10')],
+                                             replace_last=True), 1)
+        self.assertEqual(self.history.price_on('VEU', date(2018, 4, 30)), Decimal('53.10'))
+        self.assertEqual(len(self.history.series('VEU')), 3)
+
+    def test_rerun_with_corrected_closing_price(self):
+        FIF.price_history_directory = self.directory.name
+        self.assertEqual(FIF.record_closing_prices([closing_price_info('VEU', '52.71')]), 1)
+        self.assertEqual(self.history.price_on('VEU', date(2018, 3, 31)), Decimal('52.71'))
+        self.assertEqual(FIF.record_closing_prices([closing_price_info('VEU', '52.71')]), 0)
+        self.assertEqual(self.history.append([('VEU', date(2018, 4, 30), '53.00')]), 1)
+        with redirect_stdout(io.StringIO()) as output:
+            self.assertEqual(FIF.record_closing_prices([closing_price_info('VEU', '52.17')]),
+                             0)
+        self.assertIn('Warning: closing prices not added', output.getvalue())
+        self.assertEqual(self.history.price_on('VEU', date(2018, 3, 31)), Decimal('52.71'))
+
+    def test_closing_prices_from_history(self):
+        FIF.price_history_directory = self.directory.name
+        shares = [Share('VEU', 'V', 'USD', '10'), Share('EMB', 'E', 'USD', '10'),
+                  Share('BRK/B', 'B', 'USD')]
+        self.assertEqual(get_closing_prices(shares),
+                         [closing_price_info('VEU', Decimal('52.17')),
+                          closing_price_info('BRK/B', Decimal('199.480'))])
+        trades = [Trade('BRK/B', datetime(2017, 6, 1), '2', '180.00')]
+        def unpriced(closing_prices):
+            return [problem.code for problem in check_inputs(shares, trades, [], closing_prices)
+                    if problem.source == 'closing prices']
+
+        completed = FIF.complete_closing_prices(shares, trades, [])
+        self.assertEqual(completed, [closing_price_info('VEU', Decimal('52.17')),
+                                     closing_price_info('BRK/B', Decimal('199.480'))])
+        with redirect_stdout(io.StringIO()) as output:
+            self.assertEqual(unpriced([]), ['VEU', 'EMB', 'BRK/B'])
+            self.assertEqual(unpriced(get_closing_prices(shares)), ['EMB'])
+            self.assertEqual(unpriced(completed), ['EMB'])
+            shares[2].holding = Decimal('2')
+            closing_value = process_closing_prices(shares, completed)
+        self.assertIn('no closing price for a closing holding of 10', output.getvalue())
+        self.assertEqual(closing_value, Decimal('1043.40') + Decimal('797.92'))
+        self.assertEqual(FIF.record_closing_prices([closing_price_info('EMB', '100.00')]), 1)
+        self.assertEqual(self.history.price_on('EMB', date(2018, 3, 31)), Decimal('100.00'))
+
+    def tearDown(self):
+        FIF.tax_year, FIF.fx_rates, FIF.price_history_directory = self.saved_globals
+        self.history.close()
+        self.directory.cleanup()
+
+
+class TestPreflight(unittest.TestCase):
+
+    def setUp(self):
+        self.saved_globals = (FIF.tax_year, FIF.fx_rates, FIF.securities, FIF.interactive)
+        FIF.tax_year = 2018
+        FIF.interactive = True
+        FIF.fx_rates = {'USD': {date(2017, 3, 31): '0.7000', date(2018, 3, 31): '0.7200',
+                                date(2017, 5, 15): '0.7100'},
+                        'AUD': {date(2017, 3, 31): '0.9000'}}
+        FIF.securities = SecuritiesMaster()
+        FIF.securities.add('NEW', 'New share', 'USD')
+        self.shares = [Share('VEU', 'V', 'USD', '100', '50.00'),
+                       Share('EMB', 'E', 'AUD', '10', '100.00'),
+                       Share('VEU', 'V', 'USD', '5', '50.00'),
+                       Share('CHF', 'C', 'CHF', '0')]
+        self.trades = [Trade('VEU', datetime(2017, 5, 2), '-150', '51.00'),
+                       Trade('NEW', datetime(2017, 5, 3), '10', '20.00'),
+                       Trade('XYZ', datetime(2018, 4, 3), '10', '20.00'),
+                       Trade('VEU', datetime(2017, 5, 4), '60', '0')]
+        self.dividends = [Dividend('EMB', date(2017, 3, 20), '0.50', '5.00'),
+                          Dividend('ABC', date(2017, 5, 20), '0.50', '5.00'),
+                          Dividend('NEW', date(2017, 5, 21), '0.50', '5.00')]
+        self.closing_prices = [closing_price_info('EMB', '101.00'),
+                               closing_price_info('EMB', '102.00'),
+                               closing_price_info('VEU', '0.00')]
+
+    def test_all_problems_in_one_pass(self):
+        with redirect_stdout(io.StringIO()) as output:
+            problems = check_inputs(self.shares, self.trades, self.dividends,
+                                    self.closing_prices, check_only=True)
+        self.assertEqual([(problem.severity, problem.source, problem.code)
+                          for problem in problems], [
+            ('error', 'opening positions', 'VEU'),
+            ('error', 'exchange rates', None),
+            ('error', 'trades', 'VEU'),
+            ('error', 'trades', 'XYZ'),
+            ('error', 'trades', 'XYZ'),
+            ('error', 'dividends', 'EMB'),
+            ('error', 'dividends', 'ABC'),
+            ('error', 'closing prices', 'EMB'),
+            ('error', 'closing prices', 'VEU'),
+            ('error', 'closing prices', 'NEW'),
+            ('error', 'closing prices', 'XYZ'),
+            ('error', 'exchange rates', None),
+            ('error', 'exchange rates', None),
+            ('warning', 'trades', 'VEU')])
+        self.assertIn('no rates at all for currency CHF', problems[1].description)
+        self.assertIn('holding becomes -50', problems[2].description)
+        self.assertEqual(problems[8].description, 'closing price of 0.00')
+        self.assertEqual(problems[11].description,
+                         'no AUD rate for 2018-03-31 (closing values)')
+        self.assertEqual(problems[12].description,
+                         'no AUD rate for 2017-03-15 (dividend on 2017-03-20)')
+        self.assertIn('13 errors and 1 warnings', output.getvalue())
+
+    def test_asked_information_is_a_warning(self):
+        shares = [Share('VEU', 'V', 'USD', '100', '50.00')]
+        trades = [Trade('XYZ', datetime(2017, 6, 2), '10', '20.00'),
+                  Trade('VEU', datetime(2017, 8, 2), '10', '51.00')]
+        prices = [closing_price_info('VEU', '52.00'), closing_price_info('XYZ', '21.00')]
+        expected = [('trades', 'XYZ', 'unknown share (no currency) for trade on 2017-06-02'),
+                    ('exchange rates', None, 'no USD rate for 2017-08-15 (trade on 2017-08-02)')]
+        with redirect_stdout(io.StringIO()):
+            for check_only, interactive, severity in [(False, True, 'warning'),
+                                                      (True, True, 'error'),
+                                                      (False, False, 'error')]:
+                FIF.interactive = interactive
+                problems = check_inputs(shares, trades, [], prices, check_only)
+                self.assertEqual([(problem.source, problem.code, problem.description)
+                                  for problem in problems], expected)
+                self.assertEqual({problem.severity for problem in problems}, {severity})
+
+    def test_no_problems(self):
+        shares = [Share('VEU', 'V', 'USD', '100', '50.00')]
+        with redirect_stdout(io.StringIO()) as output:
+            self.assertEqual(check_inputs(shares, self.trades[1:2], [],
+                                          [closing_price_info('VEU', '52.00'),
+                                           closing_price_info('NEW', '21.00')]), [])
+        self.assertEqual(output.getvalue(), '')
+
+    def test_invalid_closing_price(self):
+        shares = [Share('VEU', 'V', 'USD', '100', '50.00')]
+        with redirect_stdout(io.StringIO()):
+            problems = check_inputs(shares, [], [], [closing_price_info('VEU', ''),
+                                                     closing_price_info('VEU', 'n/a')])
+        self.assertEqual([(problem.source, problem.code, problem.description)
+                          for problem in problems], [
+            ('closing prices', 'VEU', "invalid closing price ''"),
+            ('closing prices', 'VEU', "invalid closing price 'n/a'"),
+            ('closing prices', 'VEU', 'no closing price for a closing holding of 100')])
+
+    def test_corporate_actions(self):
+        shares = [Share('VEU', 'V', 'USD', '100', '50.00')]
+        trades = [Trade('VEU', datetime(2017, 5, 2), '-150', '25.50')]
+        actions = corporate_actions.CorporateActionIndex(
+            [corporate_actions.CorporateAction('VEU', date(2017, 4, 10), 'split', '2')])
+        problems = preflight.validate_inputs(
+            shares, trades, [], [closing_price_info('VEU', '26.00')], FIF.fx_rates,
+            date(2017, 4, 1), date(2018, 3, 31), fx_rate_date, actions=actions)
+        self.assertEqual(problems, [])
+
+    def tearDown(self):
+        FIF.tax_year, FIF.fx_rates, FIF.securities, FIF.interactive = self.saved_globals
+
+
+class TestAuditFIF(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.portfolio = os.path.join(self.directory.name, 'client')
+        fx_rates = {}
+        for tax_year in (2017, 2018):
+            year_directory = os.path.join(self.portfolio, str(tax_year))
+            os.makedirs(year_directory)
+            files = synthetic_portfolio.generate_portfolio(year_directory, tax_year, 6, 5, 2,
+                                                           seed=tax_year)
+            for currency, rates in get_fx_rates({}, files.fx_rates).items():
+                fx_rates.setdefault(currency, {}).update(rates)
+        self.fx_rates_file = os.path.join(self.directory.name, 'fx_rates.pickle')
+        save_fx_rates(fx_rates, self.fx_rates_file)
+
+    def audit(self, save=False):
+        return audit_FIF.audit([self.portfolio], workers=2, fx_rates_file=self.fx_rates_file,
+                               securities_master_file=os.path.join(self.directory.name,
+                                                                   'none.pickle'),
+                               save=save)
+
+    def write_positions(self, tax_year, filename, positions):
+        synthetic_portfolio.write_csv(
+            os.path.join(self.portfolio, str(tax_year), filename),
+            ['code', 'full_name', 'currency', 'holding', 'closing_price'],
+            [{'code': item.code, 'full_name': item.full_name, 'currency': item.currency,
+              'holding': item.holding, 'closing_price': item.price} for item in positions])
+
+    def test_audit_follows_chain(self):
+        first, second = self.audit(save=True)
+        self.assertEqual((first.tax_year, second.tax_year), (2017, 2018))
+        self.assertIsNone(first.saved)
+        self.assertFalse(first.reopened)
+        self.assertTrue(second.reopened)
+        self.assertEqual(second.result.opening_positions, first.result.closing_positions)
+        self.assertIn('FIF income is:', second.result.report)
+
+        self.write_positions(2018, 'opening_positions.csv', first.result.closing_positions)
+        audits = self.audit()
+        self.assertEqual([(year.changes, year.reopened) for year in audits],
+                         [([], False), ([], False)])
+
+        held = [item for item in first.result.closing_positions
+                if Decimal(item.holding) > Decimal('0')][0]
+        with open(os.path.join(self.portfolio, '2017', 'closing_prices.csv'), 'w') as prices:
+            prices.write('code,price\n' + ''.join(
+                '{},{}\n'.format(item.code, Decimal(item.price) + (item is held))
+                for item in first.result.closing_positions))
+        first, second = self.audit()
+        self.assertIn('closing_value', [field for field, _, _ in first.changes])
+        self.assertTrue(second.reopened)
+        self.assertIn('opening_value', [field for field, _, _ in second.changes])
+        self.assertEqual([(change.code, change.reasons) for change in first.share_diff[0]],
+                         [(held.code, ['closing price'])])
+        self.assertEqual([(change.code, change.reasons) for change in second.share_diff[0]],
+                         [(held.code, ['opening price'])])
+        with redirect_stdout(io.StringIO()) as output:
+            audit_FIF.print_audits([first, second])
+        self.assertIn('recomputed from those', output.getvalue())
+
+    def test_errors_and_years(self):
+        os.remove(os.path.join(self.portfolio, '2017', 'opening_positions.csv'))
+        os.makedirs(os.path.join(self.portfolio, '2007'))
+        self.assertEqual(audit_FIF.stored_years(self.portfolio), [2017, 2018])
+        first, second = self.audit()
+        self.assertEqual(first.result.error, 'no stored opening positions')
+        self.assertFalse(second.reopened)
+        self.assertIsNone(second.result.error)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+
+class TestShareResults(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.shares = [Share('VEU', 'V', 'USD', '100', '50.00'),
+                       Share('EMB', 'E', 'USD', '10', '100.00'),
+                       Share('BRK/B', 'B', 'USD', '5', '200.00')]
+        for share in self.shares:
+            share.opening_value = share.opening_holding * share.opening_price
+            share.closing_price = share.opening_price
+            share.closing_value = share.opening_value
+        self.shares[0].quick_sale_adjustment = Decimal('12.34')
+
+    def keyed(self, shares):
+        return {row.code: row for row in share_results.share_rows(shares)}
+
+    def test_save_and_read(self):
+        filename = os.path.join(self.directory.name, 'results.csv')
+        rows = share_results.share_rows(self.shares)
+        self.assertEqual([row.code for row in rows], ['BRK/B', 'EMB', 'VEU'])
+        share_results.save_share_results(filename, rows)
+        saved = share_results.read_share_results(filename)
+        self.assertEqual(saved, self.keyed(self.shares))
+        self.assertEqual(saved['EMB'].quick_sale_adjustment, '')
+
+    def test_diff(self):
+        old = self.keyed(self.shares)
+        self.shares[0].closing_price = Decimal('51.00')
+        self.shares[0].closing_value = Decimal('5100.00')
+        self.shares[1].opening_value = Decimal('1000.0')
+        self.shares[2].cost_of_trades = Decimal('99.00')
+        self.shares[2].quick_sale_adjustment = Decimal('1.00')
+        new = self.keyed(self.shares[:2] + [Share('IVV', 'I', 'USD')])
+        new['BRK/B'] = self.keyed(self.shares)['BRK/B']._replace(holding='6')
+        changed, totals = share_results.diff_share_results(old, new)
+        self.assertEqual([(change.code, change.reasons, [field for field, _, _ in change.changes])
+                          for change in changed], [
+            ('BRK/B', ['trades'], ['cost_of_trades', 'quick_sale_adjustment']),
+            ('IVV', ['only in the new run'], ['opening_value', 'cost_of_trades',
+                                              'gross_income_from_dividends', 'closing_value']),
+            ('VEU', ['closing price'], ['closing_value'])])
+        self.assertEqual(totals['closing_value'], (Decimal('7000.00'), Decimal('7100.00')))
+        self.assertEqual(totals['quick_sale_adjustment'], (Decimal('12.34'), Decimal('13.34')))
+        with redirect_stdout(io.StringIO()) as output:
+            share_results.print_diff(changed, totals)
+        self.assertIn('3 of the shares changed', output.getvalue())
+
+        changed, _ = share_results.diff_share_results(new, old)
+        self.assertEqual(changed[1].reasons, ['only in the old run'])
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+
+class TestAggregateFills(unittest.TestCase):
+
+    def setUp(self):
+        self.moment = datetime(2017, 6, 1, 10, 0, 0)
+        self.directory = tempfile.TemporaryDirectory()
+        self.saved_globals = (FIF.testing, FIF.tax_year, FIF.fx_rates, FIF.opening_test_file,
+                              FIF.trades_test_file, FIF.dividends_test_file)
+        FIF.testing = True
+        FIF.tax_year = 2018
+
+    def test_merging_rules(self):
+        later = self.moment + timedelta(seconds=1)
+        trades = [Trade('VEU', self.moment, '10', '50.00', '1.00'),
+                  Trade('EMB', self.moment, '5', '20.00', '1.00'),
+                  Trade('VEU', self.moment, '30', '52.00', '2.00'),
+                  Trade('VEU', self.moment, '-5', '52.00', '1.00'),
+                  Trade('VEU', later, '-5', '0', '0'),
+                  Trade('VEU', later, '-5', '0', '0')]
+        aggregated = aggregate_fills(trades)
+        self.assertEqual([trade.number_of_shares for trade in aggregated],
+                         [40, 5, -5, -5, -5])
+        merged = aggregated[0]
+        self.assertEqual(merged.share_price, Decimal('51.5'))
+        self.assertEqual(merged.trade_costs, Decimal('3.00'))
+        self.assertEqual(merged.charge, Decimal('2063.00'))
+        self.assertEqual(merged.fill_values(), [(10, Decimal('501.00')),
+                                                (30, Decimal('1562.00'))])
+        self.assertEqual(fill_portions(merged, Decimal('15')),
+                         [(10, 10, Decimal('501.00')), (5, 30, Decimal('1562.00'))])
+
+    def test_same_results_as_separate_fills(self):
+        files = synthetic_portfolio.generate_portfolio(self.directory.name, 2018, 12, 8, 3,
+                                                       seed=3, fills_per_trade=5)
+        FIF.opening_test_file = files.opening
+        FIF.trades_test_file = files.trades
+        FIF.dividends_test_file = files.dividends
+
+        def run(aggregate):
+            FIF.fx_rates = get_fx_rates({}, files.fx_rates)
+            with redirect_stdout(io.StringIO()):
+                shares = FIF.get_opening_positions()
+                trades = FIF.get_trades()
+                if aggregate:
+                    trades = aggregate_fills(trades)
+                cost_of_trades, any_quick_sale_adjustment = FIF.process_trades(shares, trades)
+                dividends = FIF.get_dividends()
+                FDR_income = FIF.determine_FDR_income(Decimal('0.00'),
+                                                      any_quick_sale_adjustment, shares, trades,
+                                                      dividends)
+            return (len(trades), cost_of_trades, FDR_income,
+                    [share.quick_sale_adjustment for share in shares])
+
+        separate = run(False)
+        aggregated = run(True)
+        self.assertLess(aggregated[0], separate[0])
+        self.assertEqual(aggregated[1:], separate[1:])
+        self.assertTrue(any(separate[3]))
+
+    def tearDown(self):
+        (FIF.testing, FIF.tax_year, FIF.fx_rates, FIF.opening_test_file, FIF.trades_test_file,
+         FIF.dividends_test_file) = self.saved_globals
+        self.directory.cleanup()
+
+
+class TestActivityStatement(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.files = synthetic_portfolio.generate_portfolio(self.directory.name, 2018, 6, 5, 2)
+        self.statement = os.path.join(self.directory.name, 'statement.csv')
+        synthetic_portfolio.write_activity_statement(self.files, self.statement)
+        self.saved_globals = (FIF.testing, FIF.tax_year, FIF.opening_test_file,
+                              FIF.trades_test_file, FIF.dividends_test_file,
+                              FIF.closing_test_file)
+        FIF.testing = True
+        FIF.tax_year = 2018
+        FIF.opening_test_file = self.files.opening
+        FIF.trades_test_file = self.files.trades
+        FIF.dividends_test_file = self.files.dividends
+        FIF.closing_test_file = self.files.closing
+
+    def test_same_as_separate_files(self):
+        trades, dividends, closing_prices = get_activity_statement(self.statement)
+        self.assertEqual(repr(trades), repr(FIF.get_trades()))
+        self.assertEqual(repr(dividends), repr(FIF.get_dividends()))
+        self.assertEqual(closing_prices, FIF.get_closing_prices([]))
+
+    def test_load_input_files(self):
+        separate = [FIF.get_opening_positions(), FIF.get_trades(), FIF.get_dividends(),
+                    FIF.get_closing_prices([])]
+        self.assertEqual(repr(FIF.load_input_files()), repr(tuple(separate)))
+        self.assertEqual(repr(FIF.load_input_files(self.statement)), repr(tuple(separate)))
+
+    def test_load_input_files_with_statistics(self):
+        FIF.run_stats = FIF.RunStatistics()
+        try:
+            FIF.run_stage(FIF.load_input_files)
+            stages = FIF.run_stats.summary()['stages']
+        finally:
+            FIF.run_stats = None
+        self.assertEqual(stages['read_trades']['rows'], 30)
+        self.assertEqual(stages['read_opening_positions']['rows'], 6)
+        self.assertEqual(stages['load_input_files']['calls'], 1)
+
+    def test_closed_lots_and_forex_skipped(self):
+        self.assertIsNone(trade_from_row({'Header': 'Data', 'DataDiscriminator': 'ClosedLot'}))
+        self.assertIsNone(trade_from_row({'Header': 'Data', 'DataDiscriminator': 'Order',
+                                          'Asset Category': 'Forex'}))
+
+    def test_mark_to_market_prices(self):
+        row = {'Asset Category': 'Stocks', 'Symbol': 'VEU', 'Current Quantity': '1,200',
+               'Current Price': '1,050.5'}
+        self.assertEqual(closing_price_from_mark_to_market(row),
+                         closing_price_info('VEU', '1050.5'))
+        row['Current Quantity'] = '0'
+        self.assertIsNone(closing_price_from_mark_to_market(row))
+
+    def tearDown(self):
+        (FIF.testing, FIF.tax_year, FIF.opening_test_file, FIF.trades_test_file,
+         FIF.dividends_test_file, FIF.closing_test_file) = self.saved_globals
+        self.directory.cleanup()
+
+
+class TestMappedCsv(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.filename = os.path.join(self.directory.name, 'trades.csv')
+
+    def write(self, text):
+        with open(self.filename, 'w', newline='') as csv_file:
+            csv_file.write(text)
+
+    def rows(self):
+        return list(mapped_csv.read_csv_rows(self.filename, 'Date/Time', date(2017, 4, 1),
+                                             date(2018, 4, 1)))
+
+    def test_same_rows_as_dict_reader(self):
+        self.write('Trades,Header,Symbol,Date/Time,Notes\r\n'
+                   'Trades,Data,VEU,"2016-05-03, 09:30:00",old\r\n'
+                   'Trades,Data,VEU,"2017-05-03, 09:30:00","two\r\nlines, ""quoted"""\r\n'
+                   'Trades,SubTotal,VEU,,\r\n'
+                   'Trades,Data,EMB,"2018-03-31, 16:00:00"\r\n'
+                   'Trades,Data,EMB,"2018-04-01, 09:30:00",next year')
+        with open(self.filename, newline='') as csv_file:
+            expected = list(csv.DictReader(csv_file))
+        self.assertEqual(self.rows(), [expected[1], expected[3]])
+
+    def test_other_date_format_not_filtered(self):
+        self.write('Trades,Header,Symbol,Date/Time\n'
+                   'Trades,Data,VEU,"05/03/2017, 09:30:00"\n'
+                   'Trades,Data,VEU,"05/03/2016, 09:30:00"\n')
+        self.assertEqual(len(self.rows()), 2)
+
+    def test_empty_file(self):
+        self.write('')
+        self.assertEqual(self.rows(), [])
+
+    def test_year_months(self):
+        self.assertEqual(mapped_csv.year_months(date(2017, 11, 1), date(2018, 2, 1)),
+                         ['2017-11', '2017-12', '2018-01'])
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+
+@unittest.skipIf(pyarrow is None, 'pyarrow is not installed')
+class TestColumnarInput(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.files = synthetic_portfolio.generate_portfolio(self.directory.name, 2018, 6, 5, 2)
+        self.saved_globals = (FIF.testing, FIF.tax_year, FIF.trades_test_file,
+                              FIF.dividends_test_file)
+        FIF.testing = True
+        FIF.tax_year = 2018
+        FIF.trades_test_file = self.files.trades
+        FIF.dividends_test_file = self.files.dividends
+
+    def test_trades_with_native_types(self):
+        with open(self.files.trades, newline='') as trades_file:
+            rows = [row for row in csv.DictReader(trades_file) if row['Header'] == 'Data']
+        rows.append(dict(rows[0], **{'Date/Time': '2016-12-01, 10:00:00'}))
+        # A trade outside the tax period, which must be filtered out.
+        table = pyarrow.table({
+            'Symbol': [row['Symbol'] for row in rows],
+            'Date/Time': [datetime.strptime(row['Date/Time'], '%Y-%m-%d, %H:%M:%S')
+                          for row in rows],
+            'Quantity': [int(row['Quantity']) for row in rows],
+            'T. Price': [float(row['T. Price']) for row in rows],
+            'Comm/Fee': [float(row['Comm/Fee']) for row in rows],
+            'Proceeds': [row['Proceeds'] for row in rows]})
+        filename = os.path.join(self.directory.name, 'trades.parquet')
+        pyarrow.parquet.write_table(table, filename, row_group_size=4)
+        self.assertEqual(repr(FIF.read_trades(filename)), repr(FIF.get_trades()))
+
+    def test_dividends_as_strings(self):
+        with open(self.files.dividends, newline='') as dividends_file:
+            rows = list(csv.DictReader(dividends_file))
+        filename = os.path.join(self.directory.name, 'dividends.arrow')
+        columnar.write_rows(filename, synthetic_portfolio.DIVIDENDS_FIELDS, rows)
+        self.assertEqual(repr(FIF.read_dividends(filename)), repr(FIF.get_dividends()))
+
+    def test_save_closing_positions(self):
+        shares = FIF.read_opening_positions(self.files.opening)
+        filename = os.path.join(self.directory.name, 'closing_positions.parquet')
+        FIF.save_closing_positions(shares, filename)
+        self.assertEqual(repr(FIF.read_opening_positions(filename)), repr(shares))
+        self.assertEqual(pyarrow.parquet.read_schema(filename).names,
+                         list(shares[0].__dict__.keys()))
+
+    def tearDown(self):
+        (FIF.testing, FIF.tax_year, FIF.trades_test_file,
+         FIF.dividends_test_file) = self.saved_globals
+        self.directory.cleanup()
+
+
+class TestFIFService(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.files = synthetic_portfolio.generate_portfolio(self.directory.name, 2018, 8, 6, 2)
+        self.saved_globals = (FIF.testing, FIF.interactive, FIF.tax_year, FIF.fx_rates,
+                              FIF.securities)
+        FIF.tax_year = 2018
+        shares = FIF.read_opening_positions(self.files.opening)
+        self.payload = {
+            'tax_year': 2018,
+            'opening_positions': [{'code': share.code, 'full_name': share.full_name,
+                                   'currency': share.currency,
+                                   'holding': str(share.opening_holding),
+                                   'closing_price': str(share.opening_price)}
+                                  for share in shares],
+            'trades': [{'code': trade.code, 'date_time': trade.date_time.isoformat(),
+                        'number_of_shares': str(trade.number_of_shares),
+                        'share_price': str(trade.share_price),
+                        'trade_costs': str(trade.trade_costs)}
+                       for trade in FIF.read_trades(self.files.trades)],
+            'dividends': [{'code': dividend.code, 'date_paid': dividend.date_paid.isoformat(),
+                           'per_share': str(dividend.per_share),
+                           'gross_paid': str(dividend.gross_paid)}
+                          for dividend in FIF.read_dividends(self.files.dividends)],
+            'closing_prices': [price._asdict()
+                               for price in FIF.read_closing_prices(self.files.closing)]}
+
+        FIF.fx_rates = get_fx_rates({}, self.files.fx_rates)
+        with redirect_stdout(io.StringIO()):
+            self.expected = FIF.calculate_FIF_income(
+                shares, FIF.read_trades(self.files.trades),
+                FIF.read_dividends(self.files.dividends),
+                FIF.read_closing_prices(self.files.closing))
+
+    def run_service(self, requests_per_connection):
+        async def session(port, payloads):
+            reader, writer = await asyncio.open_connection('127.0.0.1', port)
+            responses = [await fif_service.post(reader, writer, path, payload)
+                         for path, payload in payloads]
+            writer.close()
+            return responses
+
+        async def run():
+            service = fif_service.FIFService(0, self.files.fx_rates,
+                                             os.path.join(self.directory.name, 'none.pickle'))
+            port = await service.start()
+            try:
+                return await asyncio.gather(*(session(port, payloads)
+                                              for payloads in requests_per_connection))
+            finally:
+                await service.stop()
+
+        return asyncio.run(run())
+
+    def test_concurrent_requests(self):
+        results = self.run_service([[('/health', None), ('/fif', self.payload)],
+                                    [('/fif', self.payload)], [('/fif', self.payload)]])
+        self.assertEqual(results[0][0], (200, {'status': 'ok'}))
+        for status, response in [results[0][1], results[1][0], results[2][0]]:
+            self.assertEqual(status, 200)
+            self.assertEqual(Decimal(response['FIF_income']), self.expected.FIF_income)
+            self.assertEqual(Decimal(response['FDR_income']), self.expected.FDR_income)
+            self.assertIn('FIF income is:', response['report'])
+            self.assertEqual(len(response['shares']), len(self.expected.shares))
+
+    def test_errors(self):
+        missing_rate = dict(self.payload, tax_year=2025)
+        unknown_share = dict(self.payload, opening_positions=[])
+        invalid = dict(self.payload, trades=[{'code': 'VEU'}])
+        results = self.run_service([[('/fif', missing_rate), ('/fif', unknown_share),
+                                     ('/fif', invalid), ('/other', None)]])[0]
+        self.assertEqual([status for status, _ in results], [422, 422, 400, 404])
+        self.assertIn('rate', results[0][1]['error'])
+        self.assertIn('unknown', results[1][1]['error'])
+
+    def test_unreadable_requests_close_the_connection(self):
+        async def send(port, data):
+            reader, writer = await asyncio.open_connection('127.0.0.1', port)
+            writer.write(data)
+            await writer.drain()
+            response = await reader.read()
+            # Only ends if the service closes the connection.
+            writer.close()
+            return response
+
+        async def run():
+            service = fif_service.FIFService(0, self.files.fx_rates,
+                                             os.path.join(self.directory.name, 'none.pickle'))
+            port = await service.start()
+            try:
+                return await asyncio.gather(
+                    send(port, b'POST /fif HTTP/1.1\r\nContent-Length: 20\r\n\r\n' +
+                         b'{"tax_year": 2018}  GET /health HTTP/1.1\r\n\r\n'),
+                    send(port, b'GARBAGE\r\n\r\n'),
+                    send(port, b'POST /fif HTTP/1.1\r\nContent-Length: x\r\n\r\n'))
+            finally:
+                await service.stop()
+
+        with patch.object(fif_service, 'MAXIMUM_BODY_SIZE', 10):
+            too_large, malformed, bad_length = asyncio.run(run())
+        self.assertTrue(too_large.startswith(b'HTTP/1.1 413 '))
+        self.assertIn(b'Connection: close', too_large)
+        self.assertEqual(too_large.count(b'HTTP/1.1'), 1)
+        self.assertTrue(malformed.startswith(b'HTTP/1.1 400 '))
+        self.assertIn(b'malformed request line', malformed)
+        self.assertTrue(bad_length.startswith(b'HTTP/1.1 400 '))
+        self.assertIn(b'Content-Length', bad_length)
+
+    def tearDown(self):
+        (FIF.testing, FIF.interactive, FIF.tax_year, FIF.fx_rates,
+         FIF.securities) = self.saved_globals
+        self.directory.cleanup()
+
+
+class TestWatchFIF(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.files = synthetic_portfolio.generate_portfolio(self.directory.name, 2018, 10, 6, 3)
+        self.saved_globals = (FIF.testing, FIF.interactive, FIF.tax_year, FIF.fx_rates,
+                              FIF.securities)
+        self.watcher = watch_FIF.PortfolioWatcher(
+            {'opening': self.files.opening, 'trades': self.files.trades,
+             'dividends': self.files.dividends, 'closing': self.files.closing},
+            self.files.fx_rates, 2018, os.path.join(self.directory.name, 'none.pickle'))
+
+    def full_run(self):
+        with redirect_stdout(io.StringIO()):
+            return FIF.calculate_FIF_income(FIF.read_opening_positions(self.files.opening),
+                                            FIF.read_trades(self.files.trades),
+                                            FIF.read_dividends(self.files.dividends),
+                                            FIF.read_closing_prices(self.files.closing))
+
+    def assert_same_totals(self):
+        expected = self.full_run()
+        totals = self.watcher.totals()
+        self.assertEqual(totals['CV_income'], expected.CV_income)
+        self.assertEqual(totals['FDR_income'], expected.FDR_income)
+        with redirect_stdout(io.StringIO()):
+            self.assertEqual(self.watcher.print_summary([], [], 0), expected.FIF_income)
+
+    def test_only_changed_shares_recalculated(self):
+        changed, recalculated = self.watcher.refresh()
+        self.assertEqual(changed, ['opening', 'trades', 'dividends', 'closing', 'fx_rates'])
+        self.assertEqual(len(recalculated), 10)
+        self.assert_same_totals()
+        self.assertEqual(self.watcher.refresh(), ([], []))
+
+        with open(self.files.dividends, newline='') as dividends_file:
+            rows = list(csv.DictReader(dividends_file))
+        removed_code = rows[0]['Description'].split('(')[0]
+        synthetic_portfolio.write_csv(self.files.dividends, synthetic_portfolio.DIVIDENDS_FIELDS,
+                                      rows[1:])
+        changed, recalculated = self.watcher.refresh()
+        self.assertEqual(changed, ['dividends'])
+        self.assertEqual(recalculated, [removed_code])
+        self.assert_same_totals()
+
+    def test_unreadable_file_keeps_previous_input(self):
+        self.watcher.refresh()
+        totals = self.watcher.totals()
+        with open(self.files.trades, 'a') as trades_file:
+            trades_file.write('Trades,Data,Order,Stocks,USD,S00001,"2017-06-01, 10:00:00",abc,1,1,1,-1\n')
+        changed, recalculated = self.watcher.refresh()
+        self.assertEqual((changed, recalculated), (['trades'], []))
+        self.assertIn('trades', self.watcher.read_errors)
+        self.assertEqual(self.watcher.totals(), totals)
+
+    def tearDown(self):
+        (FIF.testing, FIF.interactive, FIF.tax_year, FIF.fx_rates,
+         FIF.securities) = self.saved_globals
+        self.directory.cleanup()
+
+
+class TestFXProviders(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.files = synthetic_portfolio.generate_portfolio(self.directory.name, 2018, 6, 5, 2)
+        self.saved_globals = (FIF.testing, FIF.interactive, FIF.tax_year, FIF.fx_rates,
+                              FIF.fx_rates_file, FIF.fx_provider, FIF.securities)
+        FIF.tax_year = 2018
+        FIF.interactive = False
+        FIF.securities = SecuritiesMaster()
+        self.rates = get_fx_rates({}, self.files.fx_rates)
+        FIF.fx_rates = self.rates
+        self.expected = self.calculate()
+        FIF.fx_rates = {}
+        FIF.fx_rates_file = os.path.join(self.directory.name, 'written.pickle')
+
+    def calculate(self):
+        with redirect_stdout(io.StringIO()):
+            return FIF.calculate_FIF_income(FIF.read_opening_positions(self.files.opening),
+                                            FIF.read_trades(self.files.trades),
+                                            FIF.read_dividends(self.files.dividends),
+                                            FIF.read_closing_prices(self.files.closing))
+
+    def test_file_provider_writes_through(self):
+        FIF.fx_provider = fx_providers.provider_from_spec('file:' + self.files.fx_rates)
+        self.assertEqual(self.calculate()[:-1], self.expected[:-1])
+        written = get_fx_rates({}, FIF.fx_rates_file)
+        for currency, rates in written.items():
+            for rate_date, rate in rates.items():
+                self.assertEqual(rate, str(self.rates[currency][rate_date]))
+        FIF.fx_provider = None
+        self.assertEqual(self.calculate()[:-1], self.expected[:-1])
+        # All rates are known now, without a provider.
+
+    def test_missing_rate(self):
+        csv_file = os.path.join(self.directory.name, 'rates.csv')
+        with open(csv_file, 'w', newline='') as rates_file:
+            rates_file.write('currency,date,rate\nUSD,2017-03-31,0.7000\n')
+        FIF.fx_provider = fx_providers.provider_from_spec('file:' + csv_file)
+        self.assertEqual(FIF.FX_rate('USD', date(2017, 3, 31)), Decimal('0.7000'))
+        with self.assertRaises(MissingFXRateError):
+            FIF.FX_rate('USD', date(2017, 4, 3))
+
+    def serve_rates(self, handler):
+        """
+        Runs a stand-in rate service, with handler(keys) returning the
+        status and the rates, in a separate thread.
+
+        return: the URL and a dict with the number of connections and
+            requests.
+        """
+        counts = {'connections': 0, 'requests': 0}
+
+        class RequestHandler(http.server.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def setup(self):
+                counts['connections'] += 1
+                super().setup()
+
+            def do_POST(self):
+                counts['requests'] += 1
+                body = self.rfile.read(int(self.headers['Content-Length']))
+                keys = [(row['currency'], date.fromisoformat(row['date']))
+                        for row in json.loads(body)['rates']]
+                status, rates = handler(keys)
+                response = json.dumps({'rates': [
+                    {'currency': currency, 'date': rate_date.isoformat(), 'rate': rate}
+                    for (currency, rate_date), rate in rates.items()]}).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Length', str(len(response)))
+                self.end_headers()
+                self.wfile.write(response)
+
+            def log_message(self, *args):
+                pass
+
+        server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), RequestHandler)
+        server.daemon_threads = True
+        server.block_on_close = False
+        server.handle_error = lambda request, client_address: None
+        # The client closes connections that time out.
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        return 'http://127.0.0.1:{}/rates'.format(server.server_address[1]), counts
+
+    def test_http_provider_batches_and_retries(self):
+        known = {(currency, rate_date): str(rate)
+                 for currency, rates in self.rates.items() for rate_date, rate in rates.items()}
+
+        def handler(keys):
+            if counts['requests'] == 1:
+                return 503, {}
+            return 200, {key: known[key] for key in keys if key in known}
+
+        url, counts = self.serve_rates(handler)
+        FIF.fx_provider = fx_providers.HTTPProvider(url, backoff=0.01, batch_size=5,
+                                                    connections=1)
+        self.addCleanup(FIF.fx_provider.close)
+        self.assertEqual(self.calculate()[:-1], self.expected[:-1])
+        self.assertEqual(counts['connections'], 1)
+        self.assertEqual(counts['requests'], FIF.fx_provider.requests)
+        needed = sum(len(rates) for rates in get_fx_rates({}, FIF.fx_rates_file).values())
+        self.assertLessEqual(counts['requests'], 2 + -(-needed // 5))
+
+    def test_http_provider_timeout(self):
+        def handler(keys):
+            time.sleep(0.5)
+            return 200, {}
+
+        url, counts = self.serve_rates(handler)
+        provider = fx_providers.HTTPProvider(url, timeout=0.05, retries=2, backoff=0.01)
+        self.addCleanup(provider.close)
+        with self.assertRaises(fx_providers.FXProviderError):
+            provider.get_rates([('USD', date(2017, 4, 15))])
+        self.assertEqual(provider.requests, 3)
+
+    def test_provider_error(self):
+        class FailingProvider(fx_providers.FXProvider):
+            async def fetch(self, keys):
+                raise fx_providers.FXProviderError('service unavailable')
+
+        with self.assertRaises(TypeError):
+            fx_providers.FXProvider()
+        FIF.fx_provider = FailingProvider()
+        FIF.fx_rates = {'USD': {}}
+        with self.assertRaises(fx_providers.FXProviderError):
+            FIF.FX_rate('USD', date(2017, 4, 3))
+        FIF.interactive = True
+        with mock.patch('builtins.input', side_effect=['0.7100']), \
+                redirect_stdout(io.StringIO()) as output:
+            self.assertEqual(FIF.FX_rate('USD', date(2017, 4, 3)), Decimal('0.7100'))
+        self.assertIn('service unavailable', output.getvalue())
+
+    def tearDown(self):
+        (FIF.testing, FIF.interactive, FIF.tax_year, FIF.fx_rates, FIF.fx_rates_file,
+         FIF.fx_provider, FIF.securities) = self.saved_globals
+        self.directory.cleanup()
+
+
+@unittest.skipIf(numpy is None, 'numpy is not installed')
+class TestScenarios(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.files = synthetic_portfolio.generate_portfolio(self.directory.name, 2018, 40, 10, 3)
+        self.saved_globals = (FIF.testing, FIF.interactive, FIF.tax_year, FIF.fx_rates,
+                              FIF.securities)
+        FIF.tax_year = 2018
+        FIF.interactive = False
+        FIF.securities = SecuritiesMaster()
+        FIF.fx_rates = get_fx_rates({}, self.files.fx_rates)
+        self.base = self.calculate()
+        self.engine = scenarios.ScenarioEngine(self.base)
+
+    def calculate(self, price_factor=1, rate_factor=1):
+        closing_prices = [FIF.closing_price_info(price_info.code,
+                                                 str(Decimal(price_info.price) * price_factor))
+                          for price_info in FIF.read_closing_prices(self.files.closing)]
+        fx_rates = FIF.fx_rates
+        FIF.fx_rates = {currency: dict(rates) for currency, rates in fx_rates.items()}
+        for rates in FIF.fx_rates.values():
+            rates[closing_date()] = str(Decimal(rates[closing_date()]) * rate_factor)
+        try:
+            with redirect_stdout(io.StringIO()):
+                return FIF.calculate_FIF_income(FIF.read_opening_positions(self.files.opening),
+                                                FIF.read_trades(self.files.trades),
+                                                FIF.read_dividends(self.files.dividends),
+                                                closing_prices)
+        finally:
+            FIF.fx_rates = fx_rates
+
+    def test_same_as_normal_runs(self):
+        factors = [(1, 1), (Decimal('1.5'), 1), (Decimal('0.5'), 1), (1, Decimal('1.25')),
+                   (Decimal('0.75'), Decimal('0.8'))]
+        shares = len(self.engine.codes)
+        currencies = len(self.engine.currencies)
+        results = self.engine.evaluate(
+            numpy.array([[float(price_factor)] * shares for price_factor, _ in factors]),
+            numpy.array([[float(rate_factor)] * currencies for _, rate_factor in factors]))
+        for index, (price_factor, rate_factor) in enumerate(factors):
+            expected = self.calculate(price_factor, rate_factor)
+            self.assertEqual(Decimal(str(results.CV_income[index])), expected.CV_income)
+            self.assertEqual(Decimal(str(results.FDR_income[index])), expected.FDR_income)
+            self.assertEqual(Decimal(str(results.FIF_income[index])), expected.FIF_income)
+
+    def test_random_shocks(self):
+        price_factors, rate_factors = self.engine.random_shocks(2000, seed=1)
+        self.assertEqual(price_factors.shape, (2000, len(self.engine.codes)))
+        results = self.engine.evaluate(price_factors, rate_factors)
+        self.assertTrue((results.FIF_income <= results.FDR_income).all())
+        self.assertTrue((results.FIF_income >= 0).all())
+        with redirect_stdout(io.StringIO()) as output:
+            scenarios.print_distribution(results)
+        self.assertIn('2,000 scenarios', output.getvalue())
+        with self.assertRaises(ValueError):
+            self.engine.evaluate(price_factors[:, 1:])
+
+    def tearDown(self):
+        (FIF.testing, FIF.interactive, FIF.tax_year, FIF.fx_rates,
+         FIF.securities) = self.saved_globals
+        self.directory.cleanup()
+
+
+class TestProjection(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.files = synthetic_portfolio.generate_portfolio(self.directory.name, 2018, 12, 40, 4,
+                                                            seed=4)
+        self.saved_globals = (FIF.testing, FIF.interactive, FIF.tax_year, FIF.fx_rates,
+                              FIF.securities)
+        FIF.tax_year = 2018
+        FIF.interactive = False
+        FIF.securities = SecuritiesMaster()
+        FIF.fx_rates = get_fx_rates({}, self.files.fx_rates)
+        trades = FIF.read_trades(self.files.trades)
+        dividends = FIF.read_dividends(self.files.dividends)
+        with redirect_stdout(io.StringIO()):
+            self.base = FIF.calculate_FIF_income(
+                FIF.read_opening_positions(self.files.opening), trades, dividends, [])
+        for share in self.base.shares:
+            FIF.securities.add(share.code, share.full_name, share.currency)
+        generator = random.Random(4)
+        self.prices = {}
+        for share in self.base.shares:
+            price = share.opening_price or Decimal('10.00')
+            self.prices[share.code] = {}
+            for day in range(0, 365, 3):
+                price = (price * Decimal(str(generator.uniform(0.95, 1.05)))).quantize(
+                    Decimal('0.01'))
+                self.prices[share.code][date(2017, 4, 1) + timedelta(days=day)] = price
+        self.projections = projection.project_FIF_income(self.base.shares, trades, dividends,
+                                                         self.prices)
+
+    def sell_everything(self, day):
+        """return: FIF_result of a normal run with all holdings sold at the end of day."""
+        trades = [trade for trade in FIF.read_trades(self.files.trades)
+                  if trade.date_time.date() <= day]
+        holdings = {share.code: share.opening_holding for share in self.base.shares}
+        for trade in trades:
+            holdings[trade.code] += trade.number_of_shares
+        for share in self.base.shares:
+            prices = [price for price_date, price in sorted(self.prices[share.code].items())
+                      if price_date <= day]
+            if holdings[share.code]:
+                trades.append(FIF.Trade(share.code, datetime.combine(day, datetime.min.time()) +
+                                        timedelta(hours=23, minutes=59, seconds=59),
+                                        -holdings[share.code],
+                                        prices[-1] if prices else share.opening_price))
+        dividends = [dividend for dividend in FIF.read_dividends(self.files.dividends)
+                     if dividend.date_paid <= day]
+        with redirect_stdout(io.StringIO()):
+            return FIF.calculate_FIF_income(FIF.read_opening_positions(self.files.opening),
+                                            trades, dividends, [])
+
+    def test_same_as_normal_runs(self):
+        self.assertEqual(len(self.projections), 365)
+        self.assertEqual(self.projections[0].day, date(2017, 4, 1))
+        self.assertGreater(len({day.FDR_income for day in self.projections}), 100)
+        # Quick sale adjustments change during the year.
+        for day_projection in self.projections[5::60] + self.projections[-1:]:
+            expected = self.sell_everything(day_projection.day)
+            self.assertEqual((day_projection.CV_income, day_projection.FDR_income,
+                              day_projection.FIF_income),
+                             (expected.CV_income, expected.FDR_income, expected.FIF_income))
+
+    def test_daily_fx_rates(self):
+        fx_rates = {currency: {date(2017, 4, 1) + timedelta(days=day):
+                               FIF.FX_rate(currency, date(2017, 4, 1) + timedelta(days=day))
+                               for day in range(365)}
+                    for currency in FIF.fx_rates}
+        projections = projection.project_FIF_income(self.base.shares, [], [], self.prices,
+                                                    fx_rates, date(2017, 6, 1),
+                                                    date(2017, 6, 30))
+        self.assertEqual(len(projections), 30)
+        self.assertEqual([day.CV_income for day in projections],
+                         [day.CV_income for day in projection.project_FIF_income(
+                             self.base.shares, [], [], self.prices, None, date(2017, 6, 1),
+                             date(2017, 6, 30))])
+        with redirect_stdout(io.StringIO()) as output:
+            projection.print_projections(projections, 7)
+        self.assertEqual(len(output.getvalue().splitlines()), 7)
+
+    def tearDown(self):
+        (FIF.testing, FIF.interactive, FIF.tax_year, FIF.fx_rates,
+         FIF.securities) = self.saved_globals
+        self.directory.cleanup()
+
+
+class TestDeMinimis(unittest.TestCase):
+
+    def setUp(self):
+        self.saved_globals = (FIF.tax_year, FIF.fx_rates)
+        FIF.tax_year = 2018
+        FIF.fx_rates = {'USD': {date(2017, 5, 15): '0.5000', date(2017, 6, 15): '0.5000'}}
+        self.shares = [Share('AAA', 'A', 'USD', '100', '10.00'), Share('BBB', 'B', 'USD')]
+        self.shares[0].opening_value = Decimal('2000.00')
+        self.trades = [Trade('BBB', datetime(2017, 6, 1, 10), '1000', '10.00', '10.00'),
+                       Trade('AAA', datetime(2017, 5, 2, 10), '-50', '12.00', '1.00'),
+                       Trade('BBB', datetime(2017, 6, 20, 10), '-500', '9.00', '10.00'),
+                       Trade('BBB', datetime(2017, 6, 1, 11), '500', '10.00')]
+
+    def test_cost_base(self):
+        report = de_minimis.check_de_minimis('client', self.shares, self.trades,
+                                             {'AAA': '1500.00'}, Decimal('25000.00'))
+        self.assertEqual(report.opening_cost, Decimal('1500.00'))
+        # AAA: 1,500.00 - 750.00 (average cost of 50 of 100 sold) = 750.00
+        # BBB: 20,020.00 + 10,000.00, then one third sold: 20,013.33
+        self.assertEqual(report.peak_cost, Decimal('30770.00'))
+        self.assertEqual(report.peak_moment, datetime(2017, 6, 1, 11))
+        self.assertEqual(report.first_breach, datetime(2017, 6, 1, 11))
+        self.assertEqual(report.closing_cost, Decimal('20763.33'))
+        self.assertEqual(report.estimated_codes, [])
+
+    def test_uses_values_from_process_trades(self):
+        with redirect_stdout(io.StringIO()):
+            process_trades(self.shares, self.trades)
+        self.assertEqual(self.trades[0].NZD_value, Decimal('-1198.00'))
+        self.assertEqual(self.trades[1].NZD_value, Decimal('20020.00'))
+        self.trades[1].NZD_value = Decimal('10010.00')
+        reports = de_minimis.check_portfolios(
+            [de_minimis.taxpayer_portfolio('client', self.shares, self.trades, {})])
+        self.assertEqual(reports[0].opening_cost, Decimal('2000.00'))
+        self.assertEqual(reports[0].estimated_codes, ['AAA'])
+        self.assertEqual(reports[0].peak_cost, Decimal('21010.00'))
+        self.assertEqual(reports[0].closing_cost, Decimal('14340.00'))
+        self.assertIsNone(reports[0].first_breach)
+        with redirect_stdout(io.StringIO()) as output:
+            de_minimis.print_de_minimis_reports(reports)
+        self.assertIn('never (exempt)', output.getvalue())
+
+    def tearDown(self):
+        FIF.tax_year, FIF.fx_rates = self.saved_globals
+
+
+class TestBenchmarkCompare(unittest.TestCase):
+
+    def test_regressions(self):
+        baseline = {'10x10x4': {'get_trades': 1.0, 'process_trades': 1.0}}
+        results = {'10x10x4': {'get_trades': 1.1, 'process_trades': 2.0, 'total': 3.1},
+                   '99x9x9': {'get_trades': 5.0}}
+        self.assertEqual(benchmark_FIF.compare(results, baseline),
+                         [('10x10x4', 'process_trades', 1.0, 2.0)])
+
+    def test_parse_size(self):
+        self.assertEqual(benchmark_FIF.parse_size('100x20x4'), (100, 20, 4))
+
+
 @unittest.skip
 class TestMain(unittest.TestCase):
 
@@ -0,0 +1,286 @@
+"""
+Watch mode for FIF.py: keeps the FIF income up to date while the input
+files are being edited.
+
+The four input files (opening positions, trades, dividends and closing
+prices) and the saved foreign exchange rates are checked for changes
+every interval, by their modification time and size. When a file has
+changed only that file is read again. The input is then divided by
+share, and each share has a fingerprint made of all its input (its
+opening position, trades, dividends, closing price and the exchange
+rates for its currency). Only shares with a new fingerprint are
+calculated again; the results for all other shares are reused. This
+works because every result of FIF.py is a sum of results per share,
+rounded per share, so the totals are the same as for a complete run.
+
+Calculations never ask for input. A missing exchange rate or an
+unknown share is shown as an error for that share, which is retried
+when any of the files changes.
+
+Example:
+    python watch_FIF.py --tax-year 2018 --opening opening.csv \
+        --trades trades.csv --dividends dividends.csv --closing closing.csv
+"""
+
+import argparse
+from collections import namedtuple
+from contextlib import redirect_stdout
+import copy
+from datetime import datetime
+from decimal import Decimal
+import io
+import os
+import time
+
+import FIF
+
+
+share_result = namedtuple('share_result', 'code, fingerprint, result, report, error')
+INPUT_READERS = {'opening': FIF.read_opening_positions, 'trades': FIF.read_trades,
+                 'dividends': FIF.read_dividends, 'closing': FIF.read_closing_prices}
+
+
+class PortfolioWatcher:
+    """
+    Holds the input and the results per share between refreshes.
+
+    Input arguments:
+    filenames: dict with the names of the input files, by the keys of
+        INPUT_READERS.
+    fx_rates_file: the saved foreign exchange rates.
+    tax_year: the year in which the tax period ends.
+    securities_master_file: the saved securities master, for the
+        currency and name of shares acquired during the year. It is
+        only read at the start.
+    """
+
+    def __init__(self, filenames, fx_rates_file, tax_year,
+                 securities_master_file='securities_master.pickle'):
+        self.filenames = dict(filenames)
+        self.fx_rates_file = fx_rates_file
+        self.stamps = {}
+        # (modification time, size) of each file when last read.
+        self.inputs = {name: [] for name in INPUT_READERS}
+        self.currency_fingerprints = {}
+        self.results = {}
+        # share_result for each share code.
+        self.read_errors = {}
+        FIF.tax_year = tax_year
+        FIF.testing = True
+        FIF.interactive = False
+        FIF.securities = FIF.load_securities_master(securities_master_file)
+        return
+
+    def changed_files(self):
+        """
+        return: list with the names (keys) of the files that changed
+            since they were last read. Files that (temporarily) do not
+            exist, e.g. while an editor saves them, are not included.
+        """
+        changed = []
+        for name, filename in list(self.filenames.items()) + [('fx_rates', self.fx_rates_file)]:
+            try:
+                status = os.stat(filename)
+            except OSError:
+                continue
+            stamp = (status.st_mtime_ns, status.st_size)
+            if self.stamps.get(name) != stamp:
+                self.stamps[name] = stamp
+                changed.append(name)
+        return changed
+
+    def read(self, name):
+        """
+        Reads one input file again. If it cannot be read, e.g. because
+        it is only partly written, the previous input is kept and the
+        error is shown.
+        """
+        try:
+            if name == 'fx_rates':
+                FIF.fx_rates = FIF.get_fx_rates(FIF.fx_rates, self.fx_rates_file)
+                self.currency_fingerprints = {
+                    currency: tuple(sorted(rates.items()))
+                    for currency, rates in FIF.fx_rates.items()}
+            else:
+                self.inputs[name] = INPUT_READERS[name](self.filenames[name])
+            self.read_errors.pop(name, None)
+        except (Exception, SystemExit) as error:
+            self.read_errors[name] = '{}: {}'.format(type(error).__name__, error)
+        return
+
+    def inputs_by_share(self):
+        """
+        return: dict with, for each share code, a tuple with the
+            opening share (or None), and the lists of its trades,
+            dividends and closing prices.
+        """
+        by_code = {}
+        for share in self.inputs['opening']:
+            by_code[share.code] = (share, [], [], [])
+        for trade in self.inputs['trades']:
+            by_code.setdefault(trade.code, (None, [], [], []))[1].append(trade)
+        for dividend in self.inputs['dividends']:
+            if dividend.code in by_code:
+                by_code[dividend.code][2].append(dividend)
+            # Dividends for shares that were never held are ignored,
+            # as in FIF.process_dividends.
+        for price_info in self.inputs['closing']:
+            if price_info.code in by_code:
+                by_code[price_info.code][3].append(price_info)
+        return by_code
+
+    def fingerprint(self, code, share, trades, dividends, closing_prices):
+        """
+        return: a tuple with everything that the results for a share
+            depend on.
+        """
+        if share is not None:
+            currency = share.currency
+            opening = (share.full_name, share.currency, share.opening_holding,
+                       share.opening_price)
+        else:
+            info = FIF.securities.lookup(code)
+            currency = info.currency if info is not None else None
+            opening = info
+        return (opening, self.currency_fingerprints.get(currency),
+                tuple((trade.date_time, trade.number_of_shares, trade.share_price,
+                       trade.trade_costs) for trade in trades),
+                tuple((dividend.date_paid, dividend.per_share, dividend.gross_paid)
+                      for dividend in dividends),
+                tuple(closing_prices))
+
+    def calculate_share(self, code, fingerprint, share, trades, dividends, closing_prices):
+        """
+        return: share_result for one share, calculated on copies of its
+            input (processing changes shares and trades in place).
+        """
+        shares = [copy.copy(share)] if share is not None else []
+        trades = [copy.copy(trade) for trade in trades]
+        report = io.StringIO()
+        try:
+            with redirect_stdout(report):
+                result = FIF.calculate_FIF_income(shares, trades, list(dividends),
+                                                  list(closing_prices))
+        except (FIF.MissingFXRateError, FIF.UnknownShareError) as error:
+            return share_result(code, fingerprint, None, report.getvalue(), str(error))
+        return share_result(code, fingerprint, result, report.getvalue(), None)
+
+    def refresh(self):
+        """
+        Reads the changed files and calculates the shares that are
+        affected.
+
+        return: (tuple with) the list of changed files and the list of
+            codes of shares that were calculated again; both empty if
+            nothing changed.
+        """
+        changed = self.changed_files()
+        if not changed:
+            return [], []
+        for name in changed:
+            self.read(name)
+
+        recalculated = []
+        by_code = self.inputs_by_share()
+        for code, (share, trades, dividends, closing_prices) in by_code.items():
+            fingerprint = self.fingerprint(code, share, trades, dividends, closing_prices)
+            previous = self.results.get(code)
+            if previous is not None and previous.fingerprint == fingerprint and \
+                    previous.error is None:
+                continue
+            self.results[code] = self.calculate_share(code, fingerprint, share, trades,
+                                                      dividends, closing_prices)
+            recalculated.append(code)
+        for code in set(self.results) - set(by_code):
+            del self.results[code]
+        return changed, recalculated
+
+    def totals(self):
+        """
+        return: dict with the totals of CV_income, FDR_income and the
+            other values of FIF_result, over all shares without errors.
+        """
+        names = [name for name in FIF.FIF_result._fields
+                 if name not in ('shares', 'FIF_income')]
+        totals = {name: Decimal('0.00') for name in names}
+        for code_result in self.results.values():
+            if code_result.result is not None:
+                for name in names:
+                    totals[name] += getattr(code_result.result, name)
+        return totals
+
+    def print_summary(self, changed, recalculated, seconds, details=False):
+        """
+        Prints the results per share and the totals, and returns the
+        FIF income.
+        """
+        print('\n{} changed {}; recalculated {} of {} shares in {:.1f} ms'.format(
+            datetime.now().strftime('%X'), ', '.join(changed), len(recalculated),
+            len(self.results), seconds * 1000))
+        for name, error in self.read_errors.items():
+            print('Could not read {} ({}); using the previous version'.format(name, error))
+        if details:
+            for code in recalculated:
+                print(self.results[code].report)
+
+        line_format_string = '{v1:{w1}}{v2:>{w2},.2f}{v3:>{w3},.2f}   {v4}'
+        print('{v1:{w1}}{v2:>{w2}}{v3:>{w3}}'.format(
+            v1=FIF.outfmt['code'].header, w1=FIF.outfmt['code'].width,
+            v2='CV income', w2=20, v3='FDR income', w3=20))
+        for code, code_result in sorted(self.results.items()):
+            if code_result.result is None:
+                print('{v1:{w1}}{v2:>{w2}}   {v3}'.format(
+                    v1=code, w1=FIF.outfmt['code'].width, v2='-', w2=40,
+                    v3=code_result.error))
+                continue
+            print(line_format_string.format(
+                v1=code, w1=FIF.outfmt['code'].width,
+                v2=code_result.result.CV_income, w2=20,
+                v3=code_result.result.FDR_income, w3=20,
+                v4='*' if code in recalculated else ''))
+
+        totals = self.totals()
+        print('{v1:{w1}}{v2:>{w2},.2f}{v3:>{w3},.2f}'.format(
+            v1='total', w1=FIF.outfmt['code'].width, v2=totals['CV_income'], w2=20,
+            v3=totals['FDR_income'], w3=20))
+        if any(code_result.error for code_result in self.results.values()):
+            print('Totals exclude shares with errors.')
+        return FIF.print_FIF_income(totals['CV_income'], totals['FDR_income'])
+
+    def watch(self, interval=0.5, details=False):
+        """
+        Refreshes every interval seconds, and prints a summary whenever
+        something changed, until interrupted.
+        """
+        try:
+            while True:
+                start = time.perf_counter()
+                changed, recalculated = self.refresh()
+                if changed:
+                    self.print_summary(changed, recalculated, time.perf_counter() - start,
+                                       details)
+                time.sleep(interval)
+        except KeyboardInterrupt:
+            pass
+        return
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Recalculate FIF income when input files change')
+    parser.add_argument('--tax-year', type=int, default=FIF.tax_year)
+    parser.add_argument('--opening', default=FIF.opening_test_file)
+    parser.add_argument('--trades', default=FIF.trades_test_file)
+    parser.add_argument('--dividends', default=FIF.dividends_test_file)
+    parser.add_argument('--closing', default=FIF.closing_test_file)
+    parser.add_argument('--fx-rates', default='saved_fx_rates.pickle')
+    parser.add_argument('--securities', default=FIF.securities_master_file)
+    parser.add_argument('--interval', type=float, default=0.5,
+                        help='seconds between checks for changes (default 0.5)')
+    parser.add_argument('--details', action='store_true',
+                        help='also print the full report for every recalculated share')
+    args = parser.parse_args()
+    watcher = PortfolioWatcher({'opening': args.opening, 'trades': args.trades,
+                                'dividends': args.dividends, 'closing': args.closing},
+                               args.fx_rates, args.tax_year, args.securities)
+    print('Watching the input files; press Ctrl+C to stop')
+    watcher.watch(args.interval, args.details)